@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+""" Micro-benchmark of the entity-rewriting template filters on typical and entity-dense tweets, compared against the
+    original str.replace()-per-entity approach.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import random
+import timeit
+import types
+
+import jinja2
+
+# noinspection PyProtectedMember
+from twempest.filters import _tag_template, ALL_FILTERS, delink, relink
+
+
+class Context:
+    """ Minimal stand-in for the Jinja template context that the filters expect.
+    """
+    def __init__(self, tweet, environment):
+        self.parent = {'tweet': tweet}
+        self.environment = environment
+
+
+def dense_tweet(rng, hashtags=12, mentions=8, urls=4, filler=10):
+    """ Return a tweet-like object whose text is mostly entities, padded with the given number of filler words.
+    """
+    hashtag_texts = [f"tag{rng.randrange(1000)}" for _ in range(hashtags)]
+    mention_names = [f"user{rng.randrange(1000)}" for _ in range(mentions)]
+    url_urls = [f"https://t.co/{rng.randrange(10 ** 9):x}" for _ in range(urls)]
+    words = ['#' + h for h in hashtag_texts] + ['@' + m for m in mention_names] + url_urls + ["word"] * filler
+    rng.shuffle(words)
+    entities = {
+        'hashtags': [{'text': h} for h in hashtag_texts],
+        'user_mentions': [{'screen_name': m} for m in mention_names],
+        'urls': [{'url': u, 'display_url': u[8:], 'expanded_url': u} for u in url_urls],
+    }
+    return types.SimpleNamespace(text=" ".join(words), entities=entities)
+
+
+def replace_delink(ctx, text):
+    """ The original delink() implementation: one str.replace() per entity.
+    """
+    tweet_entities = ctx.parent['tweet'].entities
+
+    for hashtag in tweet_entities.get('hashtags', []):
+        text = text.replace('#' + hashtag['text'], hashtag['text'])
+
+    for url in tweet_entities.get('urls', []):
+        text = text.replace(url['url'], '')
+
+    return text
+
+
+def replace_relink(ctx, text, tag_format):
+    """ The original relink() implementation: one str.replace() per entity.
+    """
+    tweet_entities = ctx.parent['tweet'].entities
+    link_template = _tag_template(ctx.environment, tag_format)
+
+    for hashtag in tweet_entities.get('hashtags', []):
+        text = text.replace('#' + hashtag['text'], link_template.render(text='#' + hashtag['text'], url="u"))
+
+    for url in tweet_entities.get('urls', []):
+        text = text.replace(url['url'], link_template.render(text=url['display_url'], url=url['expanded_url']))
+
+    for mention in tweet_entities.get('user_mentions', []):
+        text = text.replace('@' + mention['screen_name'], link_template.render(text='@' + mention['screen_name'],
+                                                                               url="u"))
+
+    return text
+
+
+def bench(title, contexts, repeat):
+    """ Time each implementation of each filter over the given contexts.
+    """
+    tag_format = "[{{ text }}]({{ url }})"
+    cases = [
+        ("delink (str.replace)", lambda: [replace_delink(c, c.parent['tweet'].text) for c in contexts]),
+        ("delink (single pass)", lambda: [delink(c, c.parent['tweet'].text) for c in contexts]),
+        ("relink (str.replace)", lambda: [replace_relink(c, c.parent['tweet'].text, tag_format) for c in contexts]),
+        ("relink (single pass)", lambda: [relink(c, c.parent['tweet'].text, tag_format) for c in contexts]),
+    ]
+
+    print(title)
+
+    for name, case in cases:
+        seconds = min(timeit.repeat(case, number=1, repeat=repeat))
+        print(f"  {name:24} {seconds * 1e6 / len(contexts):8.1f} µs/tweet")
+
+
+def main(tweet_count=2000, repeat=5):
+    rng = random.Random(1)
+    env = jinja2.Environment()
+    env.filters.update(ALL_FILTERS)
+    bench("Typical tweet text, 4 entities:",
+          [Context(dense_tweet(rng, hashtags=2, mentions=1, urls=1, filler=20), env) for _ in range(tweet_count)],
+          repeat)
+    bench("Tweet-length text, 24 entities:", [Context(dense_tweet(rng), env) for _ in range(tweet_count)], repeat)
+    bench("Long text (~25,000 characters), 240 entities:",
+          [Context(dense_tweet(rng, hashtags=120, mentions=80, urls=40, filler=2500), env)
+           for _ in range(tweet_count // 20)], repeat)
+
+
+if __name__ == '__main__':
+    main()
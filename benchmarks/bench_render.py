@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+""" Benchmark suite for rendering synthetic tweet corpora (see corpus.py) of increasing size: rendering to the console
+    and to files, each template filter, path templating and image downloads from a local HTTP server. Each run is
+    appended to a results file and compared against the last comparable run recorded there, so that a regression
+    between versions shows up as a slowdown (and a non-zero exit status). Run from the repository root with, e.g.:
+
+        PYTHONPATH=. benchmarks/bench_render.py --sizes 1000 10000 100000 --label "$(git rev-parse --short HEAD)"
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import argparse
+import contextlib
+import datetime
+import http.server
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+
+from twempest import __version__
+from twempest.__main__ import CONFIG_OPTIONS
+from twempest.download import HttpDownloader
+from twempest.twempest import create_environment, PathTemplate, render
+
+from corpus import CorpusOptions, generate_corpus
+
+
+DEFAULT_RESULTS_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+DEFAULT_SIZES = (1000, 10000, 100000)
+# Image downloads are far slower than everything else, so only this many tweets are rendered with them by default.
+DEFAULT_MAX_DOWNLOAD_TWEETS = 1000
+# Size of each image served by the local HTTP server.
+IMAGE_BYTES = 16 * 1024
+# A case running this much slower than in the previous comparable run is flagged as a regression.
+REGRESSION_THRESHOLD = 0.10
+FILTER_TEMPLATES = {
+    'delink': "{{ tweet.text|delink }}",
+    'isodate': "{{ tweet.created_at|isodate }}",
+    'qescape': "{{ tweet.text|qescape }}",
+    'reimage': "{{ tweet.text|reimage('![{{ alt }}]({{ url }})') }}",
+    'relink': "{{ tweet.text|relink('[{{ text }}]({{ url }})') }}",
+    'slugify': "{{ tweet.text|slugify }}",
+}
+TEMPLATE_TEXT = """---
+id: {{ tweet.id }}
+date: {{ tweet.created_at|isodate }}
+---
+{{ tweet.text|delink|reimage('![{{ alt }}]({{ url }})') }}
+"""
+
+
+class ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Serve the same made-up image in response to every request.
+    """
+    protocol_version = "HTTP/1.1"
+    # Send each small response at once, rather than holding it back for the client's delayed acknowledgement.
+    disable_nagle_algorithm = True
+    body = bytes(range(256)) * (IMAGE_BYTES // 256)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_filters(corpus_func, repeat):
+    """ Return the {case name: seconds} timings of rendering each filter over the corpus.
+    """
+    env = create_environment()
+    timings = {}
+
+    for name, text in FILTER_TEMPLATES.items():
+        template = env.from_string(text)
+        timings[f"filter {name}"] = best_time(lambda tweets: [template.render(tweet=t) for t in tweets], corpus_func,
+                                              repeat)
+
+    return timings
+
+
+def bench_path_templates(corpus_func, repeat):
+    """ Return the {case name: seconds} timings of rendering a tweet-invariant and a per-tweet path template for each
+        tweet in the corpus.
+    """
+    env = create_environment()
+    timings = {}
+
+    for name, text in (('invariant', "posts/images"), ('per tweet', "{{ tweet.created_at|isodate }}-{{ tweet.id }}")):
+        def render_paths(tweets):
+            """ Render the path for each of the given tweets, with a fresh template each time.
+            """
+            path_template = PathTemplate(env, text)
+            return [path_template.render(tweet=t) for t in tweets]
+
+        timings[f"path template ({name})"] = best_time(render_paths, corpus_func, repeat)
+
+    return timings
+
+
+def bench_render(corpus_func, repeat, max_download_tweets, work_dir_path):
+    """ Return the {case name: seconds} timings of rendering the corpus to the console, to files and to files with
+        image downloads. The files are written to new directories in the given working directory, which are left for
+        the caller to remove so that deleting them isn't timed.
+    """
+    timings = {'render console': best_time(lambda tweets: render(tweets, bench_options(len(tweets)), TEMPLATE_TEXT,
+                                                                 download_nothing, null_echo), corpus_func, repeat)}
+
+    def render_files(tweets, image_url=None):
+        """ Render the given tweets to a file apiece in a new directory, downloading their images from the given URL, if
+            any.
+        """
+        dir_path = tempfile.mkdtemp(dir=work_dir_path)
+        options = bench_options(len(tweets))
+        options['render-path'] = os.path.join(dir_path, "posts")
+        options['render-file'] = "{{ tweet.created_at|isodate }}-{{ tweet.id }}.md"
+
+        if not image_url:
+            return render(tweets, options, TEMPLATE_TEXT, download_nothing, null_echo)
+
+        options['image-path'] = os.path.join(dir_path, "images")
+        options['image-url'] = "/images"
+        downloader = HttpDownloader(pool_size=options['download-workers'])
+
+        try:
+            return render(tweets, options, TEMPLATE_TEXT, downloader, null_echo)
+        finally:
+            downloader.close()
+
+    timings['render files'] = best_time(render_files, corpus_func, repeat)
+
+    if max_download_tweets:
+        with local_image_server() as url:
+            timings['render files with image downloads'] = best_time(
+                lambda tweets: render_files(tweets, url), lambda: corpus_func(max_download_tweets, media_base_url=url),
+                repeat)
+
+    return timings
+
+
+def bench_options(count):
+    """ Return the default rendering options for rendering the given number of tweets.
+    """
+    options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+    options['count'] = count
+    options['replies'] = True
+    return options
+
+
+def best_time(case_func, corpus_func, repeat):
+    """ Return the best time, in seconds per tweet, of the given number of calls of case_func(tweets), each with a
+        fresh corpus from corpus_func(), since rendering alters the tweets.
+    """
+    best = None
+
+    for _ in range(repeat):
+        tweets = corpus_func()
+        start = time.perf_counter()
+        case_func(tweets)
+        seconds = (time.perf_counter() - start) / len(tweets)
+        best = seconds if best is None else min(best, seconds)
+
+    return best
+
+
+def compare_results(record, previous_record):
+    """ Print the timings of the given benchmark run, alongside their change since the given previous run, if any.
+        Return the number of cases that regressed.
+    """
+    if previous_record:
+        print(f"Compared with {previous_record['version']} ({previous_record['label'] or 'unlabelled'}) run at "
+              f"{previous_record['timestamp']}:")
+
+    regressions = 0
+
+    for size, timings in record['results'].items():
+        print(f"{int(size):,} tweets:")
+        previous_timings = previous_record['results'].get(size, {}) if previous_record else {}
+
+        for name, seconds in timings.items():
+            line = f"  {name:36} {seconds * 1e6:10.1f} µs/tweet"
+            previous_seconds = previous_timings.get(name)
+
+            if previous_seconds:
+                change = seconds / previous_seconds - 1
+                line += f"  {change:+7.1%}"
+
+                if change > REGRESSION_THRESHOLD:
+                    line += "  REGRESSION"
+                    regressions += 1
+
+            print(line)
+
+    return regressions
+
+
+# noinspection PyUnusedLocal
+def download_nothing(url, file_path):
+    """ Don't download anything.
+    """
+    pass
+
+
+@contextlib.contextmanager
+def local_image_server():
+    """ Serve images over HTTP/1.1 on localhost in a background thread for the duration of the context. Yield the
+        server's base URL.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ImageRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/media"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# noinspection PyUnusedLocal
+def null_echo(message=None, **kwargs):
+    """ Discard the rendered tweets and warnings that would be written to the console.
+    """
+    pass
+
+
+def read_previous_record(results_file_path, record):
+    """ Return the most recent run recorded in the results file at the given path that is comparable to the given run
+        (i.e., has the same corpus options and Python version), or None if there isn't one.
+    """
+    previous_record = None
+
+    try:
+        with open(results_file_path) as f:
+            for line in f:
+                candidate = json.loads(line)
+
+                if candidate['corpus'] == record['corpus'] and candidate['python'] == record['python']:
+                    previous_record = candidate
+    except FileNotFoundError:
+        pass
+
+    return previous_record
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="corpus sizes to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="times to run each case, keeping the best")
+    parser.add_argument("--seed", type=int, default=1, help="corpus random number generator seed")
+    parser.add_argument("--entity-density", type=float, default=0.2, help="fraction of words that are entities")
+    parser.add_argument("--media-ratio", type=float, default=0.2, help="fraction of tweets with photos")
+    parser.add_argument("--max-media", type=int, default=4, help="maximum number of photos per tweet")
+    parser.add_argument("--reply-ratio", type=float, default=0.1, help="fraction of tweets that are replies")
+    parser.add_argument("--max-download-tweets", type=int, default=DEFAULT_MAX_DOWNLOAD_TWEETS,
+                        help="number of tweets to render with image downloads (0 to skip)")
+    parser.add_argument("--label", default="", help="label for the run in the results file, e.g., a commit ID")
+    parser.add_argument("--results", default=DEFAULT_RESULTS_FILE_PATH, help="results file path")
+    parser.add_argument("--no-record", action="store_true", help="don't record the run in the results file")
+    args = parser.parse_args()
+
+    corpus_options = CorpusOptions(seed=args.seed, entity_density=args.entity_density, media_ratio=args.media_ratio,
+                                   max_media=args.max_media, reply_ratio=args.reply_ratio)
+    record = {
+        'version': __version__,
+        'label': args.label,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'corpus': corpus_options.as_dict(),
+        'results': {},
+    }
+
+    for size in args.sizes:
+        def corpus_func(count=size, **kwargs):
+            """ Return a fresh corpus of the given number of tweets (by default, the current size), with the given
+                CorpusOptions overrides.
+            """
+            return list(generate_corpus(count, CorpusOptions(**dict(corpus_options.as_dict(), **kwargs))))
+
+        timings = record['results'][str(size)] = {}
+
+        with tempfile.TemporaryDirectory() as work_dir_path:
+            timings.update(bench_render(corpus_func, args.repeat, min(size, args.max_download_tweets), work_dir_path))
+
+        timings.update(bench_filters(corpus_func, args.repeat))
+        timings.update(bench_path_templates(corpus_func, args.repeat))
+
+    regressions = compare_results(record, read_previous_record(args.results, record))
+
+    if not args.no_record:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
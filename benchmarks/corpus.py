@@ -0,0 +1,128 @@
+""" Seeded generator of synthetic tweet corpora for the benchmarks: Status-like objects with the attributes that
+    Twempest's rendering, filters and image downloads use, in whatever size and mix is needed.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import datetime
+import random
+import types
+
+
+# Tweet IDs and creation times start from here and increase from tweet to tweet, as they do on Twitter.
+FIRST_TWEET_ID = 800000000000000000
+FIRST_CREATED_AT = datetime.datetime(2016, 11, 1, 12, 0, 0)
+# Where the images are "hosted", unless told otherwise.
+DEFAULT_MEDIA_BASE_URL = "https://pbs.twimg.com/media/"
+WORDS = ("the", "a", "twitter", "tweet", "blog", "post", "morning", "coffee", "code", "python", "template", "yukon",
+         "snow", "river", "winter", "light", "sky", "today", "again", "finally", "release", "version", "new", "old")
+
+
+class CorpusOptions:
+    """ The shape of a synthetic corpus. The entity_density is the fraction of words that are hashtags, mentions or
+        links; media_ratio the fraction of tweets with photos, each having from one to max_media of them; and
+        reply_ratio the fraction of tweets that are replies. Tweets have from min_words to max_words words.
+    """
+    def __init__(self, seed=1, entity_density=0.2, media_ratio=0.2, max_media=4, reply_ratio=0.1, min_words=5,
+                 max_words=40, media_base_url=DEFAULT_MEDIA_BASE_URL):
+        self.seed = seed
+        self.entity_density = entity_density
+        self.media_ratio = media_ratio
+        self.max_media = max_media
+        self.reply_ratio = reply_ratio
+        self.min_words = min_words
+        self.max_words = max_words
+        self.media_base_url = media_base_url
+
+    def as_dict(self):
+        """ Return the options as a dictionary, for recording alongside benchmark results.
+        """
+        return dict(vars(self))
+
+
+class SyntheticTweet(types.SimpleNamespace):
+    """ Stand-in for a tweepy Status object. Picklable, so that it can be written to a tweet stream or sent to a
+        rendering worker process.
+    """
+
+
+def generate_corpus(count, corpus_options=None):
+    """ Yield the given number of synthetic tweets, oldest first, shaped by the given CorpusOptions. The same options
+        (including the seed) always yield the same tweets.
+    """
+    corpus_options = corpus_options or CorpusOptions()
+    rng = random.Random(corpus_options.seed)
+    user = types.SimpleNamespace(id=1234, id_str="1234", screen_name="twempest", name="Twempest")
+    tweet_id = FIRST_TWEET_ID
+    created_at = FIRST_CREATED_AT
+
+    for _ in range(count):
+        tweet_id += rng.randrange(1, 10 ** 12)
+        created_at += datetime.timedelta(seconds=rng.randrange(60, 2 * 24 * 60 * 60))
+        yield synthetic_tweet(rng, corpus_options, tweet_id, created_at, user)
+
+
+def synthetic_tweet(rng, corpus_options, tweet_id, created_at, user):
+    """ Return a synthetic tweet with the given ID, creation time and user, drawing its text, entities, media and reply
+        status from the given random number generator.
+    """
+    words = []
+    text_length = 0
+    entities = {'hashtags': [], 'symbols': [], 'user_mentions': [], 'urls': []}
+    in_reply_to_status_id = None
+    in_reply_to_screen_name = None
+
+    def add_word(word):
+        """ Append the given word to the text, returning its [start, end] indices.
+        """
+        nonlocal text_length
+        start = text_length + 1 if words else 0
+        words.append(word)
+        text_length = start + len(word)
+        return [start, text_length]
+
+    if rng.random() < corpus_options.reply_ratio:
+        in_reply_to_status_id = tweet_id - rng.randrange(1, 10 ** 15)
+        in_reply_to_screen_name = f"friend{rng.randrange(1000)}"
+        entities['user_mentions'].append({'screen_name': in_reply_to_screen_name, 'name': in_reply_to_screen_name,
+                                          'indices': add_word('@' + in_reply_to_screen_name)})
+
+    for _ in range(rng.randint(corpus_options.min_words, corpus_options.max_words)):
+        if rng.random() >= corpus_options.entity_density:
+            add_word(rng.choice(WORDS))
+            continue
+
+        kind = rng.choice(('hashtags', 'user_mentions', 'urls'))
+
+        if kind == 'hashtags':
+            text = rng.choice(WORDS) + str(rng.randrange(100))
+            entities['hashtags'].append({'text': text, 'indices': add_word('#' + text)})
+        elif kind == 'user_mentions':
+            screen_name = f"user{rng.randrange(10000)}"
+            entities['user_mentions'].append({'screen_name': screen_name, 'name': screen_name,
+                                              'indices': add_word('@' + screen_name)})
+        else:
+            url = f"https://t.co/{rng.randrange(16 ** 10):010x}"
+            expanded_url = f"https://example.com/{rng.choice(WORDS)}/{rng.randrange(10 ** 6)}"
+            entities['urls'].append({'url': url, 'expanded_url': expanded_url, 'display_url': expanded_url[8:],
+                                     'indices': add_word(url)})
+
+    if rng.random() < corpus_options.media_ratio:
+        # All of a tweet's photos share the one t.co link at the end of its text.
+        url = f"https://t.co/{rng.randrange(16 ** 10):010x}"
+        indices = add_word(url)
+        entities['media'] = []
+
+        for _ in range(rng.randint(1, corpus_options.max_media)):
+            media_id = rng.randrange(10 ** 18)
+            image_url = f"{corpus_options.media_base_url.rstrip('/')}/{media_id:x}.jpg"
+            entities['media'].append({'id': media_id, 'type': 'photo', 'url': url, 'indices': indices,
+                                      'display_url': "pic.twitter.com/" + url[13:], 'expanded_url': url,
+                                      'media_url': image_url.replace("https:", "http:", 1),
+                                      'media_url_https': image_url})
+
+    return SyntheticTweet(id=tweet_id, id_str=str(tweet_id), created_at=created_at, text=" ".join(words),
+                          entities=entities, user=user, author=user, in_reply_to_status_id=in_reply_to_status_id,
+                          in_reply_to_screen_name=in_reply_to_screen_name, retweet_count=rng.randrange(10),
+                          favorite_count=rng.randrange(50), lang="en", source="Twempest Benchmarks")
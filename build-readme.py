@@ -24,7 +24,10 @@ if __name__ == '__main__':
     readme = readme.replace("@@TODAY@@", today)
     readme = readme.replace("@@VERSION@@", version)
 
-    help_text = subprocess.check_output(["twempest", "--help"]).decode("utf-8").strip()
+    # The group's help only lists the commands, so follow it with the render command's options.
+    help_texts = [subprocess.check_output(["twempest"] + args + ["--help"]).decode("utf-8").strip()
+                  for args in ([], ["render"])]
+    help_text = "\n\n".join(help_texts)
     readme = readme.replace("@@HELPTEXT@@", help_text)
 
     with open("twempest.config.sample", 'r') as f:
@@ -4,8 +4,17 @@
 # This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
 # License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
 
+import contextlib
+import http.server
 import os
 import pickle
+import shutil
+import ssl
+import subprocess
+import threading
+
+# noinspection PyPackageRequirements
+import pytest
 
 
 def tweets_fixture():
@@ -13,3 +22,43 @@ def tweets_fixture():
     """
     pickle_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "twempest.p")
     return pickle.load(open(pickle_path, "rb"))
+
+
+@contextlib.contextmanager
+def local_http_server(handler_class, certificate=None):
+    """ Serve HTTP/1.1 requests on localhost with the given request handler class in a background thread for the
+        duration of the context. Serve HTTPS instead if given the (certificate file path, private key file path) pair
+        of a certificate (see self_signed_certificate()). Yield the server's base URL.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    scheme = "http"
+
+    if certificate:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*certificate)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"{scheme}://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def self_signed_certificate(dir_path):
+    """ Create a self-signed certificate for 127.0.0.1 and its private key in the given directory, returning the
+        (certificate file path, private key file path) pair. Skip the calling test if the openssl command isn't
+        available to do so.
+    """
+    if not shutil.which("openssl"):
+        pytest.skip("The openssl command is needed to create a certificate for a local HTTPS server.")
+
+    certificate = (os.path.join(dir_path, "localhost.crt"), os.path.join(dir_path, "localhost.key"))
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+                    "-addext", "subjectAltName=IP:127.0.0.1", "-out", certificate[0], "-keyout", certificate[1]],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certificate
@@ -0,0 +1,186 @@
+""" Twempest Twitter archive reading unit tests.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+from click.testing import CliRunner
+import json
+import os
+
+# noinspection PyPackageRequirements
+import pytest
+
+import twempest.archive
+from twempest.archive import read_archive_records, TwitterArchive
+from twempest.twempest import retrieve_archive, TwempestError
+from twempest.__main__ import CONFIG_OPTIONS
+
+
+with open(os.path.join(os.path.dirname(__file__), os.pardir, "twempest.template.sample"), encoding='utf-8') as f:
+    SAMPLE_TEMPLATE_TEXT = f.read()
+
+
+def archive_record(tweet_id, full_text, media_url=None, **fields):
+    record = {'id': str(tweet_id), 'id_str': str(tweet_id), 'full_text': full_text,
+              'created_at': "Wed Oct 10 20:19:24 +0000 2018", 'favorite_count': "3",
+              'entities': {'hashtags': [], 'symbols': [], 'user_mentions': [], 'urls': []}}
+
+    if media_url:
+        record['entities']['media'] = [{'type': 'photo', 'url': "https://t.co/abc", 'media_url': media_url,
+                                        'media_url_https': media_url.replace("http:", "https:"),
+                                        'display_url': "pic.twitter.com/abc", 'expanded_url': "https://x.com/abc"}]
+
+    record.update(fields)
+    return {'tweet': record}
+
+
+ARCHIVE_ACCOUNT = [{'account': {'email': "twempest@example.com", 'createdVia': "web", 'username': "twempest",
+                                'accountId': "1234", 'createdAt': "2009-01-01T00:00:00.000Z",
+                                'accountDisplayName': "Twempest Tester"}}]
+ARCHIVE_RECORDS = [
+    archive_record(300, "Third tweet ☃ with a picture", media_url="http://pbs.twimg.com/media/Pic300.jpg"),
+    archive_record(100, "First tweet"),
+    archive_record(250, "RT @someone: A retweet"),
+    archive_record(200, "@someone A reply", in_reply_to_status_id="150", in_reply_to_status_id_str="150"),
+]
+
+
+@pytest.fixture
+def archive_dir():
+    with CliRunner().isolated_filesystem():
+        os.makedirs(os.path.join("archive", "data", "tweets_media"))
+
+        with open(os.path.join("archive", "data", "tweets.js"), 'w', encoding='utf-8') as f:
+            f.write("window.YTD.tweets.part0 = ")
+            f.write(json.dumps(ARCHIVE_RECORDS, indent=2, ensure_ascii=False))
+
+        with open(os.path.join("archive", "data", "account.js"), 'w', encoding='utf-8') as f:
+            f.write("window.YTD.account.part0 = ")
+            f.write(json.dumps(ARCHIVE_ACCOUNT, indent=2))
+
+        with open(os.path.join("archive", "data", "tweets_media", "300-Pic300.jpg"), 'wb') as f:
+            f.write(b"picture")
+
+        yield "archive"
+
+
+# noinspection PyShadowingNames
+def test_read_archive_records(archive_dir, monkeypatch):
+    file_path = os.path.join(archive_dir, "data", "tweets.js")
+    records = list(read_archive_records(file_path))
+    assert [record for record, _, _ in records] == [r['tweet'] for r in ARCHIVE_RECORDS]
+
+    with open(file_path, 'rb') as f:
+        for record, offset, length in records:
+            f.seek(offset)
+            assert json.loads(f.read(length)) == {'tweet': record}
+
+    # Split the records, and the multi-byte character, across many reads.
+    monkeypatch.setattr(twempest.archive, 'ARCHIVE_READ_SIZE', 7)
+    assert list(read_archive_records(file_path)) == records
+
+
+# noinspection PyShadowingNames
+def test_read_archive_records_fail(archive_dir):
+    file_path = os.path.join(archive_dir, "data", "tweets.js")
+
+    with open(file_path, 'r+') as f:
+        f.truncate(100)
+
+    with pytest.raises(TwempestError) as excinfo:
+        list(read_archive_records(file_path))
+
+    assert "Unable to parse Twitter archive file" in str(excinfo.value)
+
+
+# noinspection PyShadowingNames
+def test_twitter_archive_tweets(archive_dir):
+    archive = TwitterArchive(archive_dir)
+    tweets = list(archive.tweets())
+    assert [t.id for t in tweets] == [100, 200, 250, 300]
+    assert tweets[1].in_reply_to_status_id == 150
+    assert tweets[0].in_reply_to_status_id is None
+    assert tweets[0].favorite_count == 3
+    assert tweets[0].created_at.year == 2018
+    assert tweets[0].user.screen_name == "twempest"
+    assert tweets[0].user.name == "Twempest Tester"
+    assert tweets[0].user.id == 1234
+
+    tweets = list(archive.tweets(since_id="100", include_rts=False))
+    assert [t.id for t in tweets] == [200, 300]
+
+    archive = TwitterArchive(os.path.join(archive_dir, "data", "tweets.js"))
+    assert len(list(archive.tweets())) == 4
+
+
+# noinspection PyShadowingNames
+def test_twitter_archive_no_account(archive_dir):
+    os.remove(os.path.join(archive_dir, "data", "account.js"))
+    assert not any(hasattr(t, 'user') for t in TwitterArchive(archive_dir).tweets())
+
+
+# noinspection PyShadowingNames
+def test_twitter_archive_fail_account(archive_dir):
+    with open(os.path.join(archive_dir, "data", "account.js"), 'w') as f:
+        f.write("window.YTD.account.part0 = [ {} ]")
+
+    with pytest.raises(TwempestError) as excinfo:
+        TwitterArchive(archive_dir)
+
+    assert "Unable to parse Twitter archive file" in str(excinfo.value)
+
+
+def test_twitter_archive_fail_missing():
+    with CliRunner().isolated_filesystem():
+        with pytest.raises(TwempestError) as excinfo:
+            TwitterArchive("nonexistent")
+
+        assert "Unable to find a tweets.js file" in str(excinfo.value)
+
+
+# noinspection PyShadowingNames
+def test_twitter_archive_copy_image(archive_dir):
+    archive = TwitterArchive(archive_dir)
+    archive.copy_image("https://pbs.twimg.com/media/Pic300.jpg", "copied.jpg")
+
+    with open("copied.jpg", 'rb') as f:
+        assert f.read() == b"picture"
+
+    with pytest.raises(TwempestError) as excinfo:
+        archive.copy_image("https://pbs.twimg.com/media/Missing.jpg", "missing.jpg")
+
+    assert "Unable to find archived image file" in str(excinfo.value)
+
+
+# noinspection PyShadowingNames
+def test_retrieve_archive(archive_dir):
+    messages = []
+    options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+    options['image-path'] = "images"
+    options['image-url'] = "/images"
+    options['render-file'] = "{{ tweet.id }}.md"
+    options['render-path'] = "rendered"
+    template_text = "{{ tweet.text }}{% for m in tweet.entities.media %} {{ m.media_url }}{% endfor %}"
+    last_id = retrieve_archive(archive_dir, options, template_text, lambda *a, **kw: messages.append(a))
+    assert last_id == 300
+    assert sorted(os.listdir("rendered")) == ["100.md", "300.md"]
+    assert os.path.exists(os.path.join("images", "300-0.jpg"))
+
+    with open(os.path.join("rendered", "300.md"), encoding='utf-8') as f:
+        assert f.read() == "Third tweet ☃ with a picture /images/300-0.jpg"
+
+
+# noinspection PyShadowingNames
+def test_retrieve_archive_sample_template(archive_dir):
+    options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+    options['render-file'] = "{{ tweet.id }}.md"
+    options['render-path'] = "rendered"
+    last_id = retrieve_archive(archive_dir, options, SAMPLE_TEMPLATE_TEXT, lambda *a, **kw: None)
+    assert last_id == 300
+
+    with open(os.path.join("rendered", "100.md"), encoding='utf-8') as f:
+        text = f.read()
+
+    assert "author: 'Twempest Tester'" in text
+    assert "[tweet](https://twitter.com/twempest/status/100)" in text
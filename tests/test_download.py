@@ -0,0 +1,260 @@
+""" Twempest image downloading unit tests.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+from click.testing import CliRunner
+import hashlib
+import http.server
+import os
+import threading
+
+# noinspection PyPackageRequirements
+import pytest
+
+from twempest.download import DownloadPool, HttpDownloader, MediaCache
+from twempest.twempest import TwempestError
+from .fixtures import local_http_server
+
+
+def test_download_pool():
+    downloads = []
+    threads = set()
+    lock = threading.Lock()
+
+    def download(url, file_path):
+        with lock:
+            downloads.append((url, file_path))
+            threads.add(threading.current_thread().name)
+
+    with DownloadPool(download, 3) as pool:
+        for i in range(50):
+            pool(f"https://example.com/{i}.jpg", f"{i}.jpg")
+
+        pool.wait()
+
+    assert sorted(downloads) == sorted((f"https://example.com/{i}.jpg", f"{i}.jpg") for i in range(50))
+    assert 1 <= len(threads) <= 3
+
+
+def test_download_pool_fail():
+    def download(url, file_path):
+        if url.endswith("3.jpg"):
+            raise TwempestError(f"Unable to download image file: {url}")
+
+    with DownloadPool(download, 2) as pool:
+        for i in range(5):
+            pool(f"https://example.com/{i}.jpg", f"{i}.jpg")
+
+        with pytest.raises(TwempestError) as excinfo:
+            pool.wait()
+
+        assert "3.jpg" in str(excinfo.value)
+
+        # The failure is only raised once.
+        pool.wait()
+
+
+class ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Serve fake image files over keep-alive connections, counting connections and failing on request.
+    """
+    protocol_version = "HTTP/1.1"
+    # Send each small response at once, rather than holding it back for the client's delayed acknowledgement.
+    disable_nagle_algorithm = True
+    connections = set()
+    failures = {}
+
+    def do_GET(self):
+        ImageRequestHandler.connections.add(self.client_address)
+
+        if self.path.startswith("/missing"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if ImageRequestHandler.failures.get(self.path, 0) > 0:
+            ImageRequestHandler.failures[self.path] -= 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = self.path.encode('utf-8') * 10000
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def image_server():
+    ImageRequestHandler.connections.clear()
+    ImageRequestHandler.failures.clear()
+
+    with local_http_server(ImageRequestHandler) as url:
+        yield url
+
+
+# noinspection PyShadowingNames
+def test_http_downloader(image_server):
+    with CliRunner().isolated_filesystem():
+        downloader = HttpDownloader()
+
+        for i in range(5):
+            downloader(f"{image_server}/{i}.jpg", f"{i}.jpg")
+
+        downloader.close()
+
+        for i in range(5):
+            with open(f"{i}.jpg", "rb") as f:
+                assert f.read() == f"/{i}.jpg".encode('utf-8') * 10000
+
+        # All of the downloads should have shared a single keep-alive connection.
+        assert len(ImageRequestHandler.connections) == 1
+        assert not os.path.exists("0.jpg.part")
+
+
+# noinspection PyShadowingNames
+def test_http_downloader_retry(image_server):
+    with CliRunner().isolated_filesystem():
+        ImageRequestHandler.failures["/flaky.jpg"] = 2
+        downloader = HttpDownloader(retries=2, backoff=0)
+        downloader(f"{image_server}/flaky.jpg", "flaky.jpg")
+        assert os.path.exists("flaky.jpg")
+
+        ImageRequestHandler.failures["/flakier.jpg"] = 3
+
+        with pytest.raises(TwempestError) as excinfo:
+            downloader(f"{image_server}/flakier.jpg", "flakier.jpg")
+
+        assert "Unable to download image file:" in str(excinfo.value)
+        assert not os.path.exists("flakier.jpg")
+
+
+# noinspection PyShadowingNames
+def test_http_downloader_fail_url(image_server):
+    with CliRunner().isolated_filesystem():
+        with pytest.raises(TwempestError) as excinfo:
+            HttpDownloader()(f"{image_server}/missing.jpg", "missing.jpg")
+
+        assert "Unable to download image file:" in str(excinfo.value)
+        assert not os.path.exists("missing.jpg")
+
+
+# noinspection PyShadowingNames
+def test_http_downloader_fail_save(image_server):
+    with CliRunner().isolated_filesystem():
+        path = os.path.join("download", "test.jpg")
+        os.mkdir("download")
+
+        with pytest.raises(TwempestError) as excinfo:
+            HttpDownloader()(f"{image_server}/test.jpg", os.path.join("download", "nonexistent", "test.jpg"))
+
+        assert "Unable to write downloaded image file:" in str(excinfo.value)
+        assert not os.path.exists(path)
+
+
+class CountingDownload:
+    """ Fake download function that writes the URL as the file contents and counts the downloads of each URL.
+    """
+    def __init__(self):
+        self.counts = {}
+
+    def __call__(self, url, file_path):
+        self.counts[url] = self.counts.get(url, 0) + 1
+
+        with open(file_path, 'w') as f:
+            f.write(url * 100)
+
+
+def test_media_cache():
+    with CliRunner().isolated_filesystem():
+        download = CountingDownload()
+        cache = MediaCache("cache", max_bytes=1024 * 1024, download_func=download)
+        cache("https://example.com/a.jpg", "first-a.jpg")
+        cache("https://example.com/a.jpg", "second-a.jpg")
+
+        # A fresh cache instance (i.e., a later run) also reuses the cached file.
+        MediaCache("cache", max_bytes=1024 * 1024, download_func=download)("https://example.com/a.jpg", "third-a.jpg")
+
+        assert download.counts == {"https://example.com/a.jpg": 1}
+        assert cache.hits == 1
+
+        for path in ("first-a.jpg", "second-a.jpg", "third-a.jpg"):
+            with open(path, 'r') as f:
+                assert f.read() == "https://example.com/a.jpg" * 100
+
+        assert os.stat("first-a.jpg").st_ino == os.stat("second-a.jpg").st_ino
+
+
+def test_media_cache_verify():
+    with CliRunner().isolated_filesystem():
+        download = CountingDownload()
+        cache = MediaCache("cache", max_bytes=1024 * 1024, download_func=download)
+        cache("https://example.com/a.jpg", "first-a.jpg")
+
+        # Modifying a hard-linked file also modifies the cached copy, which must then not be reused.
+        with open("first-a.jpg", 'w') as f:
+            f.write("scribble")
+
+        cache("https://example.com/a.jpg", "second-a.jpg")
+        assert download.counts == {"https://example.com/a.jpg": 2}
+
+        with open("second-a.jpg", 'r') as f:
+            assert f.read() == "https://example.com/a.jpg" * 100
+
+
+def test_media_cache_evict():
+    with CliRunner().isolated_filesystem():
+        download = CountingDownload()
+        # Each file is 2500 bytes, so three fit in the cache, and an eviction goes down to no more than 7200 bytes.
+        cache = MediaCache("cache", max_bytes=8000, download_func=download)
+
+        for name in "abc":
+            cache(f"https://example.com/{name}.jpg", f"{name}.jpg")
+
+        # Mark 'b' as the most recently used before 'd' forces an eviction, which must leave its hard-linked copies be.
+        os.utime("b.jpg", (0, 0))
+        cache("https://example.com/b.jpg", "b2.jpg")
+        assert os.stat("b.jpg").st_mtime == 0
+        cache("https://example.com/d.jpg", "d.jpg")
+        assert cache.total_bytes == 5000
+
+        for name in "bd":
+            cache(f"https://example.com/{name}.jpg", f"{name}3.jpg")
+
+        assert download.counts == {f"https://example.com/{name}.jpg": 1 for name in "abcd"}
+
+        for name in "ac":
+            cache(f"https://example.com/{name}.jpg", f"{name}3.jpg")
+            assert download.counts[f"https://example.com/{name}.jpg"] == 2
+
+
+def test_media_cache_evict_later_run():
+    with CliRunner().isolated_filesystem():
+        download = CountingDownload()
+        cache = MediaCache("cache", max_bytes=8000, download_func=download)
+
+        for name in "abc":
+            cache(f"https://example.com/{name}.jpg", f"{name}.jpg")
+
+        # A later run takes the last uses from the URL keys: 'a' was used most recently.
+        for i, name in enumerate("bca"):
+            url_key = hashlib.sha1(f"https://example.com/{name}.jpg".encode('utf-8')).hexdigest()
+            url_key_path = os.path.join("cache", "urls", url_key)
+            os.utime(url_key_path, (i, i))
+
+        cache = MediaCache("cache", max_bytes=8000, download_func=download)
+        cache("https://example.com/d.jpg", "d.jpg")
+
+        for name in "ad":
+            cache(f"https://example.com/{name}.jpg", f"{name}2.jpg")
+
+        assert download.counts == {f"https://example.com/{name}.jpg": 1 for name in "abcd"}
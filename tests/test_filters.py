@@ -7,19 +7,22 @@
 import datetime
 import os
 import re
+import types
 
+import jinja2
 # noinspection PyPackageRequirements
 import pytest
 
-from twempest.filters import delink, qescape, isodate, reimage, relink, slugify
+from twempest.filters import ALL_FILTERS, delink, qescape, isodate, reimage, relink, slugify, TAG_TEMPLATE_CACHES
 from .fixtures import tweets_fixture
 
 
 class MockContext:
     """ Stand-in for Jinja template context object.
     """
-    def __init__(self, tweet):
+    def __init__(self, tweet, environment=None):
         self.parent = {'tweet': tweet}
+        self.environment = environment if environment else jinja2.Environment()
 
 
 @pytest.fixture
@@ -42,6 +45,19 @@ def test_delink(tweets):
             assert url['url'] not in delinked
 
 
+def test_delink_overlapping_entities():
+    tweet = types.SimpleNamespace(entities={'hashtags': [{'text': "tag"}, {'text': "tagged"}],
+                                            'urls': [{'url': "https://t.co/abc"}, {'url': "https://t.co/abcd"}]})
+    delinked = delink(ctx=MockContext(tweet), text="#tagged #tag https://t.co/abcd #tag.")
+    assert delinked == "tagged tag  tag."
+
+    # Entity texts of other shapes take a pattern of their own; text without any entities is returned as it is.
+    tweet.entities['urls'] = [{'url': "http://example.com/a"}, {'url': "http://example.com/a(b)"}]
+    delinked = delink(ctx=MockContext(tweet), text="#tag http://example.com/a(b) http://example.com/ab.")
+    assert delinked == "tag  http://example.com/ab."
+    assert delink(ctx=MockContext(tweet), text="#tagging (b)") == "#tagging (b)"
+
+
 @pytest.mark.parametrize('date,expected', [
     (datetime.datetime(2017, 2, 14, 12, 44, 57, 557000), "2017-02-14"),
     (datetime.datetime(2016, 1, 1, 14, 23, 44, 590), "2016-01-01"),
@@ -106,6 +122,33 @@ def test_relink(tweets):
             assert "@@{}@@{}@@".format(url['display_url'], url['expanded_url']) in relinked
 
 
+# noinspection PyShadowingNames
+def test_tag_template_cache(tweets):
+    env = jinja2.Environment(autoescape=True)
+    env.filters.update(ALL_FILTERS)
+
+    for tweet in tweets:
+        relinked = relink(ctx=MockContext(tweet, env), text=tweet.text, tag_format="{{'<'}}{{text|upper}}|{{url}}")
+        reimaged = reimage(ctx=MockContext(tweet, env), text=tweet.text, tag_format="{{'<'}}{{alt}}")
+
+        for url in tweet.entities.get('urls', []):
+            # The tag templates inherit the environment's autoescaping and filters.
+            assert "&lt;{}|{}".format(url['display_url'].upper(), url['expanded_url']) in relinked
+
+        for media in (m for m in tweet.entities.get('media', []) if m['type'] == 'photo'):
+            assert "&lt;" + os.path.splitext(os.path.basename(media['media_url_https']))[0] in reimaged
+
+    assert len(TAG_TEMPLATE_CACHES[env]) == 2
+
+
+def test_relink_overlapping_entities():
+    tweet = types.SimpleNamespace(entities={'hashtags': [{'text': "tag"}, {'text': "tagged"}],
+                                            'user_mentions': [{'screen_name': "bob"}, {'screen_name': "bobby"}]})
+    relinked = relink(ctx=MockContext(tweet), text="#tag @bobby #tagged @bob", tag_format="[{{text}}]({{url}})")
+    assert relinked == "[#tag](https://twitter.com/hashtag/tag) [@bobby](https://twitter.com/bobby) " \
+                       "[#tagged](https://twitter.com/hashtag/tagged) [@bob](https://twitter.com/bob)"
+
+
 # noinspection PyShadowingNames
 def test_slugify(tweets):
     only_allowed = re.compile(r"^[a-z0-9-]+$")
@@ -4,14 +4,81 @@
 # This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
 # License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
 
+import glob
+import json
 import os
 import re
+import signal
+import subprocess
+import sys
 
+import click
 from click.testing import CliRunner
+# noinspection PyPackageRequirements
+import pytest
 
 from twempest import __version__
+from twempest.errors import TwempestError
+from twempest.stream import TweetStreamWriter
 from twempest.__main__ import choose_config_path, choose_option_values, choose_since_id, last_tweet_id_file_name,\
-    CONFIG_FILE_NAME, CONFIG_OPTIONS, twempest
+    watch_twempest, CONFIG_FILE_NAME, CONFIG_OPTIONS, TEMPLATE_CACHE_DIR_NAME, twempest
+from .fixtures import tweets_fixture
+
+
+def test_batch():
+    with CliRunner().isolated_filesystem():
+        runner = CliRunner()
+
+        with open('template', 'w') as f:
+            f.write("{{ tweet.text }}")
+
+        for account, tweet_id in (("one", 123), ("two", 456)):
+            os.makedirs(account)
+
+            with open(os.path.join(account, "tweets.js"), 'w') as f:
+                f.write('window.YTD.tweets.part0 = [{{"tweet": {{"id_str": "{}", "full_text": "Tweet by {}", '
+                        '"created_at": "Wed Oct 10 20:19:24 +0000 2018"}}}}]'.format(tweet_id, account))
+
+            with open(os.path.join(account, CONFIG_FILE_NAME), 'w') as f:
+                f.write("[twempest]\nfrom-archive={}\n[twitter]\nconsumer_key={}\nconsumer_secret=b\n"
+                        "access_token=c\naccess_token_secret=d".format(account, account))
+
+        result = runner.invoke(twempest, ["batch", "template", "one", "two"])
+        assert "Tweet by one" in result.output
+        assert "Tweet by two" in result.output
+        assert "one: 1 tweet(s) rendered, 0 skipped, 0 image(s) downloaded, last tweet ID 123" in result.output
+        assert result.exit_code == 0
+
+        for account, tweet_id in (("one", 123), ("two", 456)):
+            with open(os.path.join(account, last_tweet_id_file_name(account))) as f:
+                assert f.read() == str(tweet_id)
+
+        result = runner.invoke(twempest, ["batch", "template", "one", "nonexistent"])
+        assert "nonexistent: Failed: Could not find readable twempest.conf" in result.output
+        assert "1 of 2 account(s) failed." in result.output
+        assert result.exit_code != 0
+
+        os.makedirs("three")
+
+        with open(os.path.join("three", CONFIG_FILE_NAME), 'w') as f:
+            f.write("[twempest]\nfrom-archive=one\ndry-run=true\n[twitter]\nconsumer_key=three\nconsumer_secret=b\n"
+                    "access_token=c\naccess_token_secret=d")
+
+        result = runner.invoke(twempest, ["batch", "template", "three"])
+        assert "three: Skipped, since the dry-run option is set." in result.output
+        assert "Tweet by one" not in result.output
+        assert not os.path.exists(os.path.join("three", last_tweet_id_file_name("three")))
+        assert result.exit_code == 0
+
+        os.makedirs("four")
+
+        with open(os.path.join("four", CONFIG_FILE_NAME), 'w') as f:
+            f.write("[twempest]\nsince-id=1\nwatch=60\n[twitter]\nconsumer_key=four\nconsumer_secret=b\n"
+                    "access_token=c\naccess_token_secret=d")
+
+        result = runner.invoke(twempest, ["batch", "template", "four"])
+        assert "four: Failed: The watch option cannot be used with the batch command." in result.output
+        assert result.exit_code != 0
 
 
 def test_choose_config_path():
@@ -71,7 +138,39 @@ def test_choose_since_id():
         assert since_id == "1234"
 
 
+def test_compile():
+    with CliRunner().isolated_filesystem():
+        runner = CliRunner()
+
+        with open('template', 'w') as f:
+            f.write("{{ tweet.text }}")
+
+        with open(CONFIG_FILE_NAME, 'w') as f:
+            f.write("[twempest]\nrender-file={{ tweet.id }}.md\n[twitter]")
+
+        result = runner.invoke(twempest, ["compile", "-c", ".", "template"])
+        assert result.exit_code == 0
+        assert "Compiled 2 template(s) into" in result.output
+        assert len(glob.glob(os.path.join(TEMPLATE_CACHE_DIR_NAME, "*.cache"))) == 2
+
+
+def test_compile_fail_template():
+    with CliRunner().isolated_filesystem():
+        runner = CliRunner()
+
+        with open('template', 'w') as f:
+            f.write("{{ }}")
+
+        with open(CONFIG_FILE_NAME, 'w') as f:
+            f.write("[twempest]\n[twitter]")
+
+        result = runner.invoke(twempest, ["compile", "-c", ".", "template"])
+        assert "Unable to compile template:" in result.output
+        assert result.exit_code != 0
+
+
 HELP_OPTION_REGEX = re.compile(r"^Usage: twempest.+Show this message and exit\.$")
+GROUP_HELP_OPTION_REGEX = re.compile(r"^Usage: twempest \[OPTIONS\] COMMAND.+Commands:.+batch.+compile.+render")
 
 
 def test_help_option_switch():
@@ -80,8 +179,14 @@ def test_help_option_switch():
         result = runner.invoke(twempest, [option_switch])
         assert result.exit_code == 0
         print(result.output)
+        match = GROUP_HELP_OPTION_REGEX.match(result.output.replace("\n", ""))
+        assert match is not None
+
+        result = runner.invoke(twempest, ["render", option_switch])
+        assert result.exit_code == 0
         match = HELP_OPTION_REGEX.match(result.output.replace("\n", ""))
         assert match is not None
+        assert "twempest batch --help" in result.output.replace("\n", " ").replace("  ", " ")
 
     version_option_switch("-h")
     version_option_switch("--help")
@@ -111,6 +216,194 @@ def test_twempest_dry_run():
         assert "since-id = 12345" in result.output
         assert result.exit_code == 0
 
+        result = runner.invoke(twempest, ["render", "-c", ".", "-s", "12345", "-D", "template"])
+        assert "since-id = 12345" in result.output
+        assert result.exit_code == 0
+
+
+def test_twempest_from_archive():
+    with CliRunner().isolated_filesystem():
+        runner = CliRunner()
+        os.makedirs("archive")
+
+        with open(os.path.join("archive", "tweets.js"), 'w') as f:
+            f.write('window.YTD.tweets.part0 = [{"tweet": {"id_str": "123", "full_text": "Archived", '
+                    '"created_at": "Wed Oct 10 20:19:24 +0000 2018"}}]')
+
+        with open('template', 'w') as f:
+            f.write("{{ tweet.text }}")
+
+        with open(CONFIG_FILE_NAME, 'w') as f:
+            f.write("[twempest]\n[twitter]")
+
+        result = runner.invoke(twempest, ["-c", ".", "--from-archive", "archive", "template"])
+        assert "Archived" in result.output
+        assert result.exit_code == 0
+
+
+def test_twempest_from_archive_older():
+    with CliRunner().isolated_filesystem():
+        runner = CliRunner()
+        os.makedirs("archive")
+
+        with open(os.path.join("archive", "tweets.js"), 'w') as f:
+            f.write('window.YTD.tweets.part0 = [{"tweet": {"id_str": "123", "full_text": "Archived", '
+                    '"created_at": "Wed Oct 10 20:19:24 +0000 2018"}}]')
+
+        with open('template', 'w') as f:
+            f.write("{{ tweet.text }}")
+
+        with open(CONFIG_FILE_NAME, 'w') as f:
+            f.write("[twempest]\ncheckpoint-every=1\n[twitter]\nconsumer_key=a\nconsumer_secret=b\naccess_token=c\n"
+                    "access_token_secret=d")
+
+        # A later tweet has already been retrieved from Twitter.
+        with open(last_tweet_id_file_name("a"), 'w') as f:
+            f.write("1500000000000000000")
+
+        result = runner.invoke(twempest, ["-c", ".", "--from-archive", "archive", "template"])
+        assert "Archived" in result.output
+        assert result.exit_code == 0
+
+        with open(last_tweet_id_file_name("a")) as f:
+            assert f.read() == "1500000000000000000"
+
+
+def test_twempest_from_archive_resume():
+    with CliRunner().isolated_filesystem():
+        runner = CliRunner()
+        os.makedirs("archive")
+
+        with open(os.path.join("archive", "tweets.js"), 'w') as f:
+            f.write('window.YTD.tweets.part0 = [{"tweet": {"id_str": "123", "full_text": "First", '
+                    '"created_at": "Wed Oct 10 20:19:24 +0000 2018"}}, {"tweet": {"id_str": "456", '
+                    '"full_text": "Second", "created_at": "Wed Oct 10 20:19:25 +0000 2018"}}]')
+
+        with open('template', 'w') as f:
+            f.write("{{ tweet.text }}")
+
+        with open(CONFIG_FILE_NAME, 'w') as f:
+            f.write("[twempest]\n[twitter]\nconsumer_key=a\nconsumer_secret=b\naccess_token=c\naccess_token_secret=d")
+
+        # As though an earlier run had been interrupted after checkpointing the first tweet.
+        with open(last_tweet_id_file_name("a"), 'w') as f:
+            f.write("123")
+
+        result = runner.invoke(twempest, ["-c", ".", "--from-archive", "archive", "--resume", "template"])
+        assert "First" not in result.output
+        assert "Second" in result.output
+        assert result.exit_code == 0
+
+        with open(last_tweet_id_file_name("a")) as f:
+            assert f.read() == "456"
+
+        result = runner.invoke(twempest, ["-c", ".", "--resume", "template"])
+        assert "The --resume option may only be specified if the --from-archive option is as well." in result.output
+        assert result.exit_code != 0
+
+
+def test_twempest_replay():
+    with CliRunner().isolated_filesystem():
+        runner = CliRunner()
+
+        with TweetStreamWriter("saved.p") as stream:
+            stream.write(tweets_fixture()[0])
+
+        with open('template', 'w') as f:
+            f.write("{{ tweet.id }}")
+
+        with open(CONFIG_FILE_NAME, 'w') as f:
+            f.write("[twempest]\n[twitter]\nconsumer_key=a\nconsumer_secret=b\naccess_token=c\naccess_token_secret=d")
+
+        result = runner.invoke(twempest, ["-c", ".", "--replay", "saved.p", "template"])
+        assert str(tweets_fixture()[0].id) in result.output
+        assert result.exit_code == 0
+        assert not os.path.exists(last_tweet_id_file_name("a"))
+
+        result = runner.invoke(twempest, ["-c", ".", "--replay", "saved.p", "--pickle", "--pickle-file", "saved.p",
+                                          "template"])
+        assert "The --pickle-file path must differ from the --replay path" in result.output
+        assert result.exit_code != 0
+
+
+def test_twempest_replay_profile():
+    with CliRunner().isolated_filesystem():
+        runner = CliRunner(mix_stderr=False)
+
+        with TweetStreamWriter("saved.p") as stream:
+            for tweet in tweets_fixture():
+                stream.write(tweet)
+
+        with open('template', 'w') as f:
+            f.write("{{ tweet.text|delink }}")
+
+        with open(CONFIG_FILE_NAME, 'w') as f:
+            f.write("[twempest]\nreplies=true\n[twitter]\nconsumer_key=a\nconsumer_secret=b\naccess_token=c\n"
+                    "access_token_secret=d")
+
+        result = runner.invoke(twempest, ["-c", ".", "--replay", "saved.p", "--render-file", "tweets.txt", "--profile",
+                                          "--cprofile-file", "run.pstats", "--tracemalloc-file", "run.tracemalloc",
+                                          "template"])
+        assert result.exit_code == 0
+
+        for phase in ("read", "render", "filter delink", "write", "flush", "Wall time"):
+            assert re.search(r"^{} +\d".format(phase), result.stderr, re.MULTILINE)
+
+        assert "{:,} byte(s) written".format(os.path.getsize("tweets.txt")) in result.stderr
+        assert "Slowest tweets:" in result.stderr
+        assert os.path.getsize("run.pstats") > 0
+        assert os.path.getsize("run.tracemalloc") > 0
+
+
+def test_twempest_replay_metrics():
+    with CliRunner().isolated_filesystem():
+        runner = CliRunner()
+        tweets = tweets_fixture()
+
+        with TweetStreamWriter("saved.p") as stream:
+            for tweet in tweets:
+                stream.write(tweet)
+
+        with open('template', 'w') as f:
+            f.write("{{ tweet.id }}")
+
+        with open(CONFIG_FILE_NAME, 'w') as f:
+            f.write("[twempest]\nrender-file={{ tweet.id % 2 }}.txt\nskip=^806\n[twitter]\nconsumer_key=a\n"
+                    "consumer_secret=b\naccess_token=c\naccess_token_secret=d")
+
+        with open("1.txt", 'w') as f:
+            f.write("Existing\n")
+
+        result = runner.invoke(twempest, ["-c", ".", "--replay", "saved.p", "--append", "--metrics-file",
+                                          "metrics.json", "template"])
+        assert result.exit_code == 0
+
+        with open("metrics.json") as f:
+            metrics = json.load(f)
+
+        replies = [t for t in tweets if t.in_reply_to_status_id and t.text[0] == '@']
+        skipped = [t for t in tweets if str(t.id).startswith("806") and t not in replies]
+        assert metrics['succeeded'] is True
+        assert metrics['tweets_fetched'] == len(tweets)
+        assert metrics['replies_excluded'] == len(replies)
+        assert metrics['tweets_skipped'] == len(skipped)
+        assert metrics['tweets_rendered'] == len(tweets) - len(replies) - len(skipped)
+        assert metrics['last_tweet_id'] == max(t.id for t in tweets if t not in replies + skipped)
+        assert metrics['files_created'] == 1 and metrics['files_appended'] == 1
+        assert metrics['bytes_written'] == os.path.getsize("0.txt") + os.path.getsize("1.txt") - len("Existing\n")
+        assert metrics['phases']['render']['calls'] == len(tweets) - len(replies)
+
+        # A failed run is recorded too.
+        result = runner.invoke(twempest, ["-c", ".", "--replay", "missing.p", "--metrics-file", "metrics.prom",
+                                          "template"])
+        assert result.exit_code != 0
+
+        with open("metrics.prom") as f:
+            metrics = f.read()
+
+        assert "# TYPE twempest_last_run_succeeded gauge\ntwempest_last_run_succeeded 0\n" in metrics
+        assert "\ntwempest_tweets_rendered 0\n" in metrics
+
 
 def test_twempest_fail_1_no_argument():
     with CliRunner().isolated_filesystem():
@@ -272,7 +565,47 @@ def test_twempest_fail_10_response_401():
         assert result.exit_code != 0
 
 
+def test_twempest_fail_11_download_workers_too_low():
+    with CliRunner().isolated_filesystem():
+        runner = CliRunner()
+
+        with open('template', 'w') as f:
+            f.write("{{ tweet.text }}")
+
+        with open(CONFIG_FILE_NAME, 'w') as f:
+            f.write("[twempest]\n[twitter]\nconsumer_key=a\nconsumer_secret=b\naccess_token=c\naccess_token_secret=d")
+
+        result = runner.invoke(twempest, ["-c", ".", "--download-workers", "0", "template"])
+        assert "The --download-workers option must be at least 1." in result.output
+        assert result.exit_code != 0
+
+
 VERSION_OPTION_REGEX = re.compile(r"Twempest version (\d+\.\d+\.\d+)Copyright.+See LICENSE\.$")
+# Most of the cold start budget goes to importing click; the rendering dependencies were once another 200 ms on top.
+STARTUP_IMPORT_BUDGET_MICROSECONDS = 150000
+STARTUP_UNWANTED_MODULES = {'jinja2', 'pytz', 'requests', 'tweepy', 'tzlocal', 'twempest.twempest'}
+
+
+def test_version_import_time():
+    # Run in a fresh interpreter, since this one has long since imported everything.
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             "import sys; from twempest.__main__ import twempest; "
+                             "sys.argv = ['twempest', '--version']; twempest()"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0
+    assert VERSION_OPTION_REGEX.match(result.stdout.replace("\n", ""))
+
+    # Each line reads "import time: <self us> | <cumulative us> | <indented module name>".
+    imports = {}
+
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+
+        if line.startswith("import time:") and fields[1].strip().isdigit():
+            imports[fields[2].strip()] = int(fields[1])
+
+    assert not STARTUP_UNWANTED_MODULES & set(imports)
+    assert imports['twempest.__main__'] < STARTUP_IMPORT_BUDGET_MICROSECONDS
 
 
 def test_version_option_switch():
@@ -285,3 +618,56 @@ def test_version_option_switch():
 
     version_option_switch("-V")
     version_option_switch("--version")
+
+
+def test_watch_twempest(monkeypatch):
+    runs = []
+
+    def mock_run_twempest(options, *args, **kwargs):
+        runs.append(options['since-id'])
+
+        if len(runs) == 2:
+            raise click.ClickException("Transient problem")
+
+        if len(runs) == 3:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        return 1000 + len(runs)
+
+    monkeypatch.setattr('twempest.__main__.run_twempest', mock_run_twempest)
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    messages = []
+    options = {'since-id': "1000", 'watch': 0.01, 'download-timeout': 1, 'download-retries': 0, 'download-workers': 1}
+    auth_keys = {'consumer_key': "a", 'consumer_secret': "b", 'access_token': "c", 'access_token_secret': "d"}
+    watch_twempest(options, auth_keys, ".", "{{ tweet.id }}", lambda m, **kw: messages.append(m))
+
+    # The second run failed, so the third carried on from the first.
+    assert runs == ["1000", "1001", "1001"]
+    assert options['since-id'] == "1003"
+    assert messages == ["Warning: Transient problem"]
+    assert signal.getsignal(signal.SIGTERM) == previous_handler
+
+
+def test_watch_twempest_interrupt(monkeypatch):
+    def mock_run_twempest(options, *args, scheduler=None, **kwargs):
+        # Asking to stop cuts a rate limit wait short...
+        os.kill(os.getpid(), signal.SIGTERM)
+
+        with pytest.raises(TwempestError) as excinfo:
+            scheduler.sleep(3600)
+
+        assert "Stopped watching while waiting" in str(excinfo.value)
+
+        # ...and a Ctrl-C after that interrupts the run at once.
+        os.kill(os.getpid(), signal.SIGINT)
+        raise AssertionError("The run was not interrupted.")
+
+    monkeypatch.setattr('twempest.__main__.run_twempest', mock_run_twempest)
+    previous_handlers = {s: signal.getsignal(s) for s in (signal.SIGINT, signal.SIGTERM)}
+    options = {'since-id': "1000", 'watch': 3600, 'download-timeout': 1, 'download-retries': 0, 'download-workers': 1}
+    auth_keys = {'consumer_key': "a", 'consumer_secret': "b", 'access_token': "c", 'access_token_secret': "d"}
+
+    with pytest.raises(KeyboardInterrupt):
+        watch_twempest(options, auth_keys, ".", "{{ tweet.id }}", lambda m, **kw: None)
+
+    assert {s: signal.getsignal(s) for s in previous_handlers} == previous_handlers
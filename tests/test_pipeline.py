@@ -0,0 +1,106 @@
+""" Twempest pipeline unit tests.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import os
+import signal
+import threading
+import time
+
+# noinspection PyPackageRequirements
+import pytest
+
+from twempest.pipeline import run_pipeline
+
+
+@pytest.mark.parametrize("threaded", [True, False])
+def test_run_pipeline(threaded):
+    results = []
+
+    def slow_double(n):
+        # Vary the time taken, so that the stages get out of step.
+        time.sleep(0.001 * (n % 3))
+        return n * 2
+
+    def collect(n):
+        results.append((n, threading.current_thread().name))
+
+    run_pipeline(range(200), [slow_double, collect], batch_size=8, queue_batches=2, threaded=threaded)
+    assert [n for n, _ in results] == [n * 2 for n in range(200)]
+    assert all(name.startswith("twempest-pipeline") for _, name in results) == threaded
+
+
+@pytest.mark.parametrize("threaded", [True, False])
+def test_run_pipeline_stop(threaded):
+    taken = []
+    results = []
+
+    def items():
+        for n in range(10000):
+            taken.append(n)
+            yield n
+
+    run_pipeline(items(), [lambda n: n, lambda n: results.append(n) or len(results) == 10], batch_size=4,
+                 queue_batches=2, threaded=threaded)
+    assert results == list(range(10))
+    # The bounded queues keep the items from being read too far ahead of the last stage.
+    assert len(taken) <= 10 + 4 * 2 * 3 + 4
+
+
+def test_run_pipeline_back_pressure():
+    taken = []
+
+    def items():
+        for n in range(1000):
+            taken.append(n)
+            yield n
+
+    def slow_collect(n):
+        time.sleep(0.01)
+        return n == 4
+
+    run_pipeline(items(), [slow_collect], batch_size=1, queue_batches=2)
+    assert len(taken) <= 5 + 2 + 2
+
+
+@pytest.mark.parametrize("threaded", [True, False])
+def test_run_pipeline_fail_stage(threaded):
+    def fail_at_five(n):
+        if n == 5:
+            raise ValueError("five")
+
+        return n
+
+    with pytest.raises(ValueError) as e:
+        run_pipeline(range(100), [fail_at_five, lambda n: False], batch_size=2, threaded=threaded)
+
+    assert "five" in str(e.value)
+
+
+def test_run_pipeline_fail_items():
+    def items():
+        yield from range(10)
+        raise KeyError("eleven")
+
+    with pytest.raises(KeyError):
+        run_pipeline(items(), [lambda n: n, lambda n: False], batch_size=3)
+
+
+def test_run_pipeline_interrupt():
+    def slow_items():
+        time.sleep(5)
+        yield 1
+
+    interrupter = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT))
+    interrupter.start()
+    start = time.monotonic()
+
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            run_pipeline(slow_items(), [lambda n: n, lambda n: False])
+    finally:
+        interrupter.cancel()
+
+    assert time.monotonic() - start < 2
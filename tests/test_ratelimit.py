@@ -0,0 +1,174 @@
+""" Twempest Twitter API rate limiting unit tests.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+from click.testing import CliRunner
+import http.server
+import json
+import os
+import time
+
+# noinspection PyPackageRequirements
+import pytest
+import tweepy
+
+from twempest.ratelimit import MAX_RATE_LIMIT_WAITS, RateLimitScheduler
+from twempest.twempest import fetch_timeline_pages, TwempestError
+from .fixtures import local_http_server, self_signed_certificate
+
+
+class MockClock:
+    """ Stand-in for time.time() and time.sleep() that only pretends to pass the time.
+    """
+    def __init__(self):
+        self.now = 1000000.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class MockResponse:
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+
+class MockRateLimitedAPI:
+    """ Stand-in for the tweepy API object, whose endpoint refuses requests beyond a budget of two per window.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.last_response = None
+        self.calls = []
+        self.reset = clock.now + 100
+        self.remaining = 2
+
+    def endpoint(self, **kwargs):
+        if self.clock.now >= self.reset:
+            self.reset = self.clock.now + 100
+            self.remaining = 2
+
+        headers = {'x-rate-limit-limit': "2", 'x-rate-limit-reset': str(int(self.reset))}
+
+        if self.remaining == 0:
+            headers['x-rate-limit-remaining'] = "0"
+            raise tweepy.RateLimitError("Rate limit exceeded", MockResponse(429, headers))
+
+        self.remaining -= 1
+        headers['x-rate-limit-remaining'] = str(self.remaining)
+        self.last_response = MockResponse(200, headers)
+        self.calls.append(kwargs)
+        return kwargs
+
+
+class TimelineRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Serve a two-page user timeline, refusing the first request for exceeding the rate limit.
+    """
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def do_GET(self):
+        TimelineRequestHandler.requests.append(self.path)
+
+        if len(TimelineRequestHandler.requests) == 1:
+            self.send_json(429, {'errors': [{'code': 88, 'message': "Rate limit exceeded"}]}, remaining=0)
+        elif "max_id" not in self.path:
+            self.send_json(200, [{'id': 12, 'created_at': "Wed Oct 10 20:19:24 +0000 2018", 'full_text': "Second"},
+                                 {'id': 11, 'created_at': "Wed Oct 10 20:19:23 +0000 2018", 'full_text': "First"}],
+                           remaining=898)
+        else:
+            self.send_json(200, [], remaining=897)
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status_code, data, remaining):
+        body = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-rate-limit-limit", "900")
+        self.send_header("x-rate-limit-remaining", str(remaining))
+        self.send_header("x-rate-limit-reset", str(int(time.time()) + 60))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_rate_limit_scheduler():
+    clock = MockClock()
+    api = MockRateLimitedAPI(clock)
+    messages = []
+    scheduler = RateLimitScheduler(api, echo=lambda m, **kw: messages.append(m), sleep=clock.sleep, clock=clock.clock)
+
+    for i in range(5):
+        assert scheduler.call("endpoint", api.endpoint, page=i) == {'page': i}
+
+    # The budget was spent after the second and fourth calls, so the scheduler waited out the window both times
+    # without ever being refused.
+    assert [c['page'] for c in api.calls] == list(range(5))
+    assert len(clock.sleeps) == 2
+    assert all(100 <= s <= 105 for s in clock.sleeps)
+    assert len(messages) == 2
+    assert scheduler.waits == 2 and scheduler.wait_seconds == sum(clock.sleeps)
+    assert "Reached the Twitter API rate limit for 'endpoint'" in messages[0]
+    assert scheduler.budget("endpoint").remaining == 1
+
+
+def test_rate_limit_scheduler_refused():
+    clock = MockClock()
+    api = MockRateLimitedAPI(clock)
+    api.remaining = 0
+    scheduler = RateLimitScheduler(api, sleep=clock.sleep, clock=clock.clock)
+
+    # Unaware of the budget being spent elsewhere, the first request is refused, and then retried after the reset.
+    assert scheduler.call("endpoint", api.endpoint, page=0) == {'page': 0}
+    assert len(clock.sleeps) == 1
+
+
+def test_rate_limit_scheduler_fail():
+    clock = MockClock()
+    scheduler = RateLimitScheduler(None, sleep=clock.sleep, clock=clock.clock)
+
+    def refuse(**kwargs):
+        raise tweepy.TweepError("Too many requests", MockResponse(429, {'retry-after': "10"}))
+
+    with pytest.raises(TwempestError) as excinfo:
+        scheduler.call("endpoint", refuse)
+
+    assert "was still exceeded after waiting" in str(excinfo.value)
+    assert len(clock.sleeps) == MAX_RATE_LIMIT_WAITS
+
+    def fail(**kwargs):
+        raise tweepy.TweepError("Not found", MockResponse(404, {}))
+
+    with pytest.raises(tweepy.TweepError):
+        scheduler.call("endpoint", fail)
+
+
+def test_rate_limit_scheduler_local_server(monkeypatch):
+    with CliRunner().isolated_filesystem():
+        certificate = self_signed_certificate(os.getcwd())
+        monkeypatch.setenv("REQUESTS_CA_BUNDLE", certificate[0])
+        clock = MockClock()
+        clock.clock = time.time
+        TimelineRequestHandler.requests = []
+
+        with local_http_server(TimelineRequestHandler, certificate) as url:
+            auth = tweepy.OAuthHandler("a", "b")
+            auth.set_access_token("c", "d")
+            api = tweepy.API(auth, host=url.split("://")[1])
+            scheduler = RateLimitScheduler(api, sleep=clock.sleep, clock=clock.clock)
+            pages = list(fetch_timeline_pages(api, since_id=10, include_rts=False, tweet_mode='extended',
+                                              scheduler=scheduler))
+
+        assert [[t.id for t in p] for p in pages] == [[12, 11]]
+        assert len(TimelineRequestHandler.requests) == 3
+        assert len(clock.sleeps) == 1 and 55 <= clock.sleeps[0] <= 65
+        assert scheduler.budget("statuses/user_timeline").remaining == 897
@@ -0,0 +1,108 @@
+""" Twempest tweet store unit tests.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+from click.testing import CliRunner
+import datetime
+import os
+
+# noinspection PyPackageRequirements
+import pytest
+
+from twempest.store import STORE_DATA_FILE_NAME, STORE_INDEX_FILE_NAME, TweetStore
+from twempest.twempest import TwempestError
+from twempest.view import TweetView
+from .fixtures import tweets_fixture
+
+
+@pytest.fixture
+def tweets():
+    return tweets_fixture()
+
+
+# noinspection PyShadowingNames
+def test_tweet_store(tweets):
+    with CliRunner().isolated_filesystem():
+        with TweetStore("store") as store:
+            assert len(store) == 0
+            assert store.max_id is None
+            assert list(store.tweets()) == []
+
+            # Pages arrive newest first, and may overlap.
+            with store.adding() as add:
+                add(reversed(tweets[8:]))
+                add(reversed(tweets[:10]))
+
+            assert len(store) == len(tweets)
+            assert store.max_id == tweets[-1].id
+            assert tweets[5].id in store
+            assert tweets[5].id + 1 not in store
+
+        with TweetStore("store") as store:
+            stored_tweets = list(store.tweets())
+            assert [t.id for t in stored_tweets] == [t.id for t in tweets]
+            assert all(isinstance(t, TweetView) for t in stored_tweets)
+            assert stored_tweets[6].text == tweets[6].text
+            assert stored_tweets[6].user.screen_name == tweets[6].user.screen_name
+
+            with store.adding() as add:
+                add(tweets[:3])
+
+            assert len(store) == len(tweets)
+
+
+# noinspection PyShadowingNames
+def test_tweet_store_ranges(tweets):
+    with CliRunner().isolated_filesystem():
+        with TweetStore("store") as store:
+            with store.adding() as add:
+                add(tweets)
+
+            assert [t.id for t in store.tweets(since_id=tweets[2].id)] == [t.id for t in tweets[3:]]
+            assert [t.id for t in store.tweets(since_id=str(tweets[2].id), max_id=tweets[5].id)] == \
+                [t.id for t in tweets[3:6]]
+            assert list(store.tweets(since_id=tweets[-1].id)) == []
+
+            since = tweets[4].created_at
+            until = tweets[9].created_at
+            assert [t.id for t in store.tweets(since=since, until=until)] == \
+                [t.id for t in tweets if since <= t.created_at < until]
+            assert list(store.tweets(since=tweets[-1].created_at + datetime.timedelta(seconds=1))) == []
+
+
+# noinspection PyShadowingNames
+def test_tweet_store_failed_adding(tweets):
+    with CliRunner().isolated_filesystem():
+        with TweetStore("store") as store:
+            with store.adding() as add:
+                add(tweets[:5])
+
+            data_size = os.path.getsize(os.path.join("store", STORE_DATA_FILE_NAME))
+
+            with pytest.raises(ValueError):
+                with store.adding() as add:
+                    add(tweets[5:])
+                    raise ValueError("API went away")
+
+            assert len(store) == 5
+            assert store.max_id == tweets[4].id
+            assert os.path.getsize(os.path.join("store", STORE_DATA_FILE_NAME)) == data_size
+            assert [t.id for t in store.tweets()] == [t.id for t in tweets[:5]]
+
+
+def test_tweet_store_fail_index():
+    with CliRunner().isolated_filesystem():
+        os.mkdir("store")
+
+        with open(os.path.join("store", STORE_DATA_FILE_NAME), 'wb'):
+            pass
+
+        with open(os.path.join("store", STORE_INDEX_FILE_NAME), 'wb') as f:
+            f.write(b"not an index")
+
+        with pytest.raises(TwempestError) as e:
+            TweetStore("store")
+
+        assert "not a tweet store index" in str(e.value)
@@ -0,0 +1,109 @@
+""" Twempest tweet stream unit tests.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+from click.testing import CliRunner
+import os
+import pickle
+
+# noinspection PyPackageRequirements
+import pytest
+
+from twempest.stream import TweetStreamReader, TweetStreamWriter
+from twempest.twempest import TwempestError
+from .fixtures import tweets_fixture
+
+
+@pytest.fixture
+def tweets():
+    return tweets_fixture()
+
+
+# noinspection PyShadowingNames
+def test_tweet_stream(tweets):
+    with CliRunner().isolated_filesystem():
+        with TweetStreamWriter("tweets.stream") as stream:
+            for tweet in tweets:
+                stream.write(tweet)
+
+        reader = TweetStreamReader("tweets.stream")
+        assert [t.id for t in reader] == [t.id for t in tweets]
+        assert [t.id for t in reader.tweets(since_id=tweets[-3].id)] == [t.id for t in tweets[-2:]]
+        assert reader.find(tweets[5].id).text == tweets[5].text
+        assert reader.find(1) is None
+
+
+# noinspection PyShadowingNames
+def test_tweet_stream_truncated(tweets):
+    with CliRunner().isolated_filesystem():
+        with TweetStreamWriter("tweets.stream") as stream:
+            for tweet in tweets[:3]:
+                stream.write(tweet)
+
+        # As though Twempest were killed while writing the last tweet.
+        with open("tweets.stream", 'r+b') as f:
+            f.truncate(os.path.getsize("tweets.stream") - 10)
+
+        assert [t.id for t in TweetStreamReader("tweets.stream")] == [t.id for t in tweets[:2]]
+
+
+# noinspection PyShadowingNames
+def test_tweet_stream_append(tweets):
+    with CliRunner().isolated_filesystem():
+        with TweetStreamWriter("tweets.stream") as stream:
+            for tweet in tweets[:3]:
+                stream.write(tweet)
+
+        # Cut the last record short, as though Twempest were killed while writing it.
+        with open("tweets.stream", 'r+b') as f:
+            f.truncate(os.path.getsize("tweets.stream") - 10)
+
+        with TweetStreamWriter("tweets.stream") as stream:
+            for tweet in tweets[3:5]:
+                stream.write(tweet)
+
+        assert [t.id for t in TweetStreamReader("tweets.stream")] == [t.id for t in tweets[:2] + tweets[3:5]]
+
+        # A legacy pickle, or an empty file, is replaced by a new stream.
+        for contents in (pickle.dumps(tweets), b""):
+            with open("twempest.p", 'wb') as f:
+                f.write(contents)
+
+            with TweetStreamWriter("twempest.p") as stream:
+                stream.write(tweets[0])
+
+            assert [t.id for t in TweetStreamReader("twempest.p")] == [tweets[0].id]
+
+
+# noinspection PyShadowingNames
+def test_tweet_stream_legacy_pickle(tweets):
+    with CliRunner().isolated_filesystem():
+        with open("twempest.p", 'wb') as f:
+            pickle.dump(tweets, f)
+
+        reader = TweetStreamReader("twempest.p")
+        assert [t.id for t in reader] == [t.id for t in tweets]
+        assert reader.find(tweets[2].id).id == tweets[2].id
+
+
+def test_tweet_stream_fail():
+    with CliRunner().isolated_filesystem():
+        with pytest.raises(TwempestError) as excinfo:
+            TweetStreamReader("nonexistent")
+
+        assert "Unable to read tweet stream:" in str(excinfo.value)
+
+        with open("garbage", 'wb') as f:
+            f.write(b"not a tweet stream")
+
+        with pytest.raises(TwempestError) as excinfo:
+            list(TweetStreamReader("garbage"))
+
+        assert "Unable to read tweet stream:" in str(excinfo.value)
+
+        with pytest.raises(TwempestError) as excinfo:
+            TweetStreamWriter(os.path.join("nonexistent", "tweets.stream"))
+
+        assert "Unable to write tweet stream:" in str(excinfo.value)
@@ -5,17 +5,24 @@
 # License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
 
 from click.testing import CliRunner
+import copy
 import glob
 import jinja2
 from jinja2.exceptions import TemplateError
 import os
-import pickle
 # noinspection PyPackageRequirements
 import pytest
 import re
-
-from twempest.twempest import PICKLE_FILE_NAME, cleanup_downloaded_images, download_from_url, download_images, render,\
-    TwempestError
+import time
+import tzlocal
+
+from twempest.twempest import create_environment, download_from_url, download_image_files,\
+    fetch_timeline_pages, is_tweet_invariant, make_dirs, oldest_first, PathTemplate, render, RenderFilePool, replay,\
+    rewritten_image_entities, stored_tweets, TweetRenderer, TwempestError
+from twempest.download import MediaCache
+from twempest.stats import RunStats
+from twempest.stream import PICKLE_FILE_NAME, TweetStreamReader
+from twempest.view import TweetView
 from twempest.__main__ import CONFIG_OPTIONS, echo_wrapper
 from .fixtures import tweets_fixture
 
@@ -64,34 +71,6 @@ def tweets():
     return tweets_fixture()
 
 
-# noinspection PyShadowingNames
-def test_cleanup_downloaded_images(mock_echo):
-    with CliRunner().isolated_filesystem():
-        image_file_paths = []
-
-        for i in range(4):
-            image_file_name = f"image{i}.jpg"
-            image_file_path = os.path.join(".", image_file_name)
-            image_file_paths.append(image_file_path)
-            with open(image_file_path, 'w') as f:
-                f.write("foo")
-
-        cleanup_downloaded_images(image_file_paths, mock_echo.echo)
-
-        for path in image_file_paths:
-            assert not os.path.exists(path)
-
-
-# noinspection PyShadowingNames
-def test_cleanup_downloaded_images_fail_cant_delete(mock_echo):
-    with CliRunner().isolated_filesystem():
-        image_file_path = os.path.join(".", "quux.jpg")
-        cleanup_downloaded_images([image_file_path], mock_echo.echo)
-        assert len(mock_echo.messages) == 1
-        assert mock_echo.messages[0].startswith("Warning: Unable to delete downloaded image file:")
-        assert image_file_path in mock_echo.messages[0]
-
-
 def test_download_from_url():
     with CliRunner().isolated_filesystem():
         path = os.path.join("download", "test.jpg")
@@ -127,7 +106,7 @@ def test_download_from_url_fail_save():
 
 
 # noinspection PyShadowingNames
-def test_download_images(mock_echo, tweets):
+def test_download_image_files(mock_echo, tweets):
     env = jinja2.Environment()
     image_dir_path_template = env.from_string("images")
     image_url_path_template = env.from_string("/images/")
@@ -136,8 +115,9 @@ def test_download_images(mock_echo, tweets):
     with CliRunner().isolated_filesystem():
         for tweet in tweets:
             render_file_name = f"tweet_{tweet.id}_file.md"
-            paths = download_images(tweet, image_dir_path_template, image_url_path_template, render_file_name,
-                                    mock_download, mock_echo.echo)
+            _, image_downloads = rewritten_image_entities(tweet, image_dir_path_template, image_url_path_template,
+                                                          render_file_name)
+            paths = download_image_files(image_downloads, mock_download, mock_echo.echo)
 
             if paths:
                 image_paths.append(paths[0])
@@ -154,23 +134,26 @@ def test_download_images(mock_echo, tweets):
 
 
 # noinspection PyShadowingNames
-def test_download_images_some_exist(mock_echo, tweets):
+def test_download_image_files_some_exist(mock_echo, tweets):
     env = jinja2.Environment()
     image_dir_path_template = env.from_string("images")
     image_url_path_template = env.from_string("/images/")
     image_paths = []
+    queued_file_paths = set()
 
     with CliRunner().isolated_filesystem():
         for tweet in tweets:
             render_file_name = f"tweet_{tweet.id}_file.md"
+            _, image_downloads = rewritten_image_entities(tweet, image_dir_path_template, image_url_path_template,
+                                                          render_file_name)
 
             if tweet.id == IMAGE_TWEET_IDS[-1]:
                 with open(os.path.join("images", f"tweet_{tweet.id}_file-0.jpg"), "wb") as f:
                     f.seek(1024 * 1024)
                     f.write(b'0')
 
-            paths = download_images(tweet, image_dir_path_template, image_url_path_template, render_file_name,
-                                    mock_download, mock_echo.echo)
+            paths = download_image_files(image_downloads, mock_download, mock_echo.echo,
+                                         queued_file_paths=queued_file_paths)
 
             if paths:
                 image_paths.append(paths[0])
@@ -181,42 +164,149 @@ def test_download_images_some_exist(mock_echo, tweets):
                 assert str(tweet.id) in mock_echo.messages[0]
 
         assert len(image_paths) == len(IMAGE_TWEET_IDS) - 1
+        assert queued_file_paths == set(image_paths)
+
+        # Images that are already queued for download are skipped, too, even though they may not exist yet.
+        os.remove(image_paths[0])
+        assert download_image_files([("https://example.com/a.jpg", image_paths[0])], mock_download, mock_echo.echo,
+                                    queued_file_paths=queued_file_paths) == []
+        assert not os.path.exists(image_paths[0])
+
+
+@pytest.mark.parametrize('text,expected', [
+    ("images", True),
+    ("~/blog/{{ 'media'|upper }}", True),
+    ("{% set d = 'x' %}{{ d }}", True),
+    ("{{ tweet.created_at|isodate }}", False),
+    ("images/{% if tweet.id > 5 %}big{% endif %}", False),
+    ("{{ 'foo'|slugify }}", False),
+])
+def test_is_tweet_invariant(text, expected):
+    assert is_tweet_invariant(create_environment(), text) == expected
 
 
 # noinspection PyShadowingNames
-def test_download_images_media_update(mock_echo, tweets):
-    env = jinja2.Environment()
-    image_dir_path_template = env.from_string("images")
-    image_url_path_template = env.from_string("/images/")
-    media_before = {}
-    media_after = {}
+def test_path_template(tweets):
+    env = create_environment()
+    invariant = PathTemplate(env, "images/{{ range(3)|list|length }}")
+    variant = PathTemplate(env, "images/{{ tweet.id }}")
+    assert invariant.render(tweet=tweets[0]) == "images/3"
+    assert variant.render(tweet=tweets[0]) == f"images/{tweets[0].id}"
+    invariant.template = None
+    assert invariant.render(tweet=tweets[1]) == "images/3"
+    assert variant.render(tweet=tweets[1]) == f"images/{tweets[1].id}"
+
+
+def test_make_dirs(monkeypatch):
+    with CliRunner().isolated_filesystem():
+        created_dir_paths = set()
+        calls = []
+        monkeypatch.setattr('os.makedirs', lambda path, exist_ok: calls.append(path))
+
+        for _ in range(3):
+            make_dirs(os.path.join("a", "b"), created_dir_paths)
+            make_dirs("c", created_dir_paths)
+
+        assert calls == [os.path.join("a", "b"), "c"]
+
+
+class MockTimelineAPI:
+    """ Stand-in for the tweepy API object that serves the user timeline, newest first, from the given tweets.
+    """
+    def __init__(self, tweets):
+        self.tweets = sorted(tweets, key=lambda t: t.id, reverse=True)
+        self.calls = 0
+
+    def user_timeline(self, since_id, max_id, count, **kwargs):
+        self.calls += 1
+        page = [t for t in self.tweets if t.id > since_id and (max_id is None or t.id <= max_id)]
+        return page[:count]
+
+
+# noinspection PyShadowingNames
+def test_fetch_timeline_pages(tweets, monkeypatch):
+    monkeypatch.setattr('twempest.twempest.TIMELINE_PAGE_SIZE', 5)
+    api = MockTimelineAPI(tweets)
+    pages = list(fetch_timeline_pages(api, since_id=tweets[2].id, include_rts=False, tweet_mode='extended'))
+    assert [len(p) for p in pages] == [5, 5, 5]
+    assert api.calls == 4
+    assert [t.id for p in pages for t in p] == [t.id for t in reversed(tweets[3:])]
+
+
+# noinspection PyShadowingNames
+def test_oldest_first(tweets):
+    newest_first = list(reversed(tweets))
+    pages = [newest_first[i:i + 4] for i in range(0, len(newest_first), 4)]
+    assert [t.id for t in oldest_first(iter(pages))] == [t.id for t in tweets]
+    assert list(oldest_first(iter([]))) == []
+
+
+# noinspection PyShadowingNames
+def test_stored_tweets(tweets):
+    fetched_since_ids = []
+
+    def fetch_pages(since_id):
+        fetched_since_ids.append(since_id)
+        newest_first = [t for t in reversed(tweets) if t.id > (since_id or 0)]
+        return [newest_first[i:i + 4] for i in range(0, len(newest_first), 4)]
 
     with CliRunner().isolated_filesystem():
-        for tweet in tweets:
-            render_file_name = f"tweet_{tweet.id}_file.md"
-            media_before[tweet.id] = [{'media_url': m['media_url'],
-                                       'media_url_https': m['media_url_https']}
-                                      for m in tweet.entities.get('media', []) if m['type'] == 'photo']
+        assert [t.id for t in stored_tweets("store", fetch_pages, since_id=tweets[9].id, include_rts=True)] == \
+            [t.id for t in tweets[10:]]
+        assert fetched_since_ids == [tweets[9].id]
 
-            download_images(tweet, image_dir_path_template, image_url_path_template, render_file_name, mock_download,
-                            mock_echo.echo)
+        # Only tweets newer than the store's newest are fetched, but earlier stored tweets may be rendered again.
+        assert [t.id for t in stored_tweets("store", fetch_pages, since_id=tweets[11].id, include_rts=False)] == \
+            [t.id for t in tweets[12:] if not hasattr(t, 'retweeted_status')]
+        assert fetched_since_ids[-1] == tweets[-1].id
 
-            media_after[tweet.id] = [{'media_url': m['media_url'],
-                                      'media_url_https': m['media_url_https'],
-                                      'original_media_url': m['original_media_url'],
-                                      'original_media_url_https': m['original_media_url_https']}
-                                     for m in tweet.entities.get('media', []) if m['type'] == 'photo']
 
-        for tweet_id in IMAGE_TWEET_IDS:
-            before = media_before[tweet_id]
-            after = media_after[tweet_id]
+def test_render_file_pool():
+    with CliRunner().isolated_filesystem():
+        with RenderFilePool(max_open=2) as render_files:
+            for i in range(30):
+                render_files.write(f"{i % 3}.txt", f"{i},")
+
+            assert len(render_files.files) == 2
 
-            for i, b in enumerate(before):
-                a = after[i]
-                assert b['media_url'] == a['original_media_url']
-                assert b['media_url'] != a['media_url']
-                assert b['media_url_https'] == a['original_media_url_https']
-                assert b['media_url_https'] != a['media_url_https']
+        assert not render_files.files
+
+        for n in range(3):
+            with open(f"{n}.txt", 'r') as f:
+                assert f.read() == "".join(f"{i}," for i in range(n, 30, 3))
+
+
+def test_render_file_pool_fail():
+    with CliRunner().isolated_filesystem():
+        with RenderFilePool() as render_files:
+            with pytest.raises(TwempestError) as excinfo:
+                render_files.write(os.path.join("nonexistent", "tweet.txt"), "foo")
+
+            assert "Unable to write rendered tweet:" in str(excinfo.value)
+
+
+# noinspection PyShadowingNames
+def test_render_checkpoint(mock_echo, tweets):
+    with CliRunner().isolated_filesystem():
+        checkpoints = []
+
+        def checkpoint(tweet_id):
+            # Everything up to the checkpointed tweet must already be on disk.
+            with open("tweets.txt") as f:
+                checkpoints.append((tweet_id, f.read()))
+
+        template_text = "{{ tweet.id }} "
+        options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+        options['append'] = True
+        options['checkpoint-every'] = 5
+        options['render-file'] = "tweets.txt"
+        options['replies'] = True
+        render(tweets, options, template_text, mock_download, mock_echo.echo, checkpoint)
+        assert len(checkpoints) == len(tweets) // 5
+
+        for i, (tweet_id, text) in enumerate(checkpoints):
+            assert tweet_id == tweets[5 * i + 4].id
+            assert text == "".join(f"{t.id} " for t in tweets[:5 * i + 5])
 
 
 # noinspection PyShadowingNames
@@ -230,6 +320,25 @@ def test_render_fail_template(mock_echo, tweets):
             assert last_id is None
 
 
+# noinspection PyShadowingNames
+def test_render_in_parallel(mock_echo, tweets):
+    with CliRunner().isolated_filesystem():
+        template_text = "{{ tweet.id }} {{ tweet.created_at }}"
+        options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+        options['count'] = len(tweets) - 1
+        options['render-file'] = "tweets.txt"
+        options['render-path'] = "serial"
+        serial_last_id = render(tweets, options, template_text, mock_download, mock_echo.echo)
+
+        options['jobs'] = 2
+        options['render-path'] = "parallel"
+        parallel_last_id = render(tweets, options, template_text, mock_download, mock_echo.echo)
+        assert parallel_last_id == serial_last_id
+
+        with open(os.path.join("serial", "tweets.txt")) as sf, open(os.path.join("parallel", "tweets.txt")) as pf:
+            assert pf.read() == sf.read()
+
+
 # noinspection PyShadowingNames
 def test_render_to_console(mock_echo, tweets):
     with CliRunner().isolated_filesystem():
@@ -245,6 +354,24 @@ def test_render_to_console(mock_echo, tweets):
             assert str(tweet.id) in rendered_ids
 
 
+# noinspection PyShadowingNames
+def test_render_template_cache(mock_echo, tweets):
+    with CliRunner().isolated_filesystem():
+        template_text = "{{ tweet.id }}"
+        options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+        options['replies'] = True
+        options['template-cache'] = "cache"
+        render(tweets, options, template_text, mock_download, mock_echo.echo)
+        cache_file_paths = glob.glob(os.path.join("cache", "*.cache"))
+        assert len(cache_file_paths) == 2
+        os.utime(cache_file_paths[0], (0, 0))
+        os.utime(cache_file_paths[1], (0, 0))
+
+        render(tweets, options, template_text, mock_download, mock_echo.echo)
+        assert [os.stat(p).st_mtime for p in cache_file_paths] == [0, 0]
+        assert len([m for m in mock_echo.messages if m]) == 2 * len(tweets)
+
+
 # noinspection PyShadowingNames
 def test_render_to_files(mock_echo, tweets):
     with CliRunner().isolated_filesystem():
@@ -265,6 +392,21 @@ def test_render_to_files(mock_echo, tweets):
                 assert str(tweet.id) == f.read()
 
 
+# noinspection PyShadowingNames
+def test_render_to_dated_dirs(mock_echo, tweets):
+    with CliRunner().isolated_filesystem():
+        template_text = "{{ tweet.id }}"
+        options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+        options['render-file'] = "{{ tweet.id }}.txt"
+        options['render-path'] = "{{ tweet.created_at|isodate }}"
+        options['replies'] = True
+        render(tweets, options, template_text, mock_download, mock_echo.echo)
+
+        for tweet in tweets:
+            created_at = TweetView(tweet, tzlocal.get_localzone()).created_at
+            assert os.path.exists(os.path.join(created_at.strftime('%Y-%m-%d'), f"{tweet.id}.txt"))
+
+
 # noinspection PyShadowingNames
 def test_render_no_replies(mock_echo, tweets):
     with CliRunner().isolated_filesystem():
@@ -339,6 +481,28 @@ def test_render_with_skip(mock_echo, tweets):
         assert len(tweets) - 1 == len(text_file_names)
 
 
+# noinspection PyShadowingNames
+def test_render_with_skip_no_download(mock_echo, tweets):
+    downloaded_urls = []
+
+    def recording_download(url, file_path):
+        downloaded_urls.append(url)
+        mock_download(url, file_path)
+
+    with CliRunner().isolated_filesystem():
+        template_text = "{{ tweet.id }}"
+        options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+        options['image-path'] = "images"
+        options['image-url'] = "/images/"
+        options['skip'] = re.compile(str(IMAGE_TWEET_IDS[0]))
+        options['render-file'] = "{{ tweet.id }}.txt"
+        options['replies'] = True
+        render(tweets, options, template_text, recording_download, mock_echo.echo)
+        assert len(downloaded_urls) == len(IMAGE_TWEET_IDS) - 1
+        assert not os.path.exists(os.path.join("images", f"{IMAGE_TWEET_IDS[0]}-0.jpg"))
+        assert os.path.exists(os.path.join("images", f"{IMAGE_TWEET_IDS[1]}-0.jpg"))
+
+
 # noinspection PyShadowingNames
 def test_render_skip_all(mock_echo, tweets):
     with CliRunner().isolated_filesystem():
@@ -352,6 +516,55 @@ def test_render_skip_all(mock_echo, tweets):
         assert "Warning: No tweets were retrieved." == mock_echo.messages[-1]
 
 
+# noinspection PyShadowingNames
+def test_render_stats_skip_all(mock_echo, tweets):
+    with CliRunner().isolated_filesystem():
+        stats = RunStats()
+        options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+        options['render-file'] = "{{ tweet.id }}.txt"
+        options['replies'] = True
+        options['skip'] = re.compile(".")
+        render(tweets, options, "{{ tweet.id }}", mock_download, mock_echo.echo, stats=stats)
+        assert glob.glob("*.txt") == []
+        assert stats.files_created == stats.files_appended == 0
+        assert stats.tweets_skipped == len(tweets)
+
+
+# noinspection PyShadowingNames
+def test_render_stats_images(mock_echo, tweets):
+    def failing_download(url, file_path):
+        raise TwempestError(f"Unable to download image file: {url}")
+
+    with CliRunner().isolated_filesystem():
+        options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+        options['render-file'] = "{{ tweet.id }}.txt"
+        options['image-url'] = "/images/"
+        cache = MediaCache("cache", max_bytes=100 * 1024 * 1024, download_func=mock_download)
+
+        options['image-path'] = "images"
+        stats = RunStats()
+        render(tweets, options, "{{ tweet.id }}", cache, mock_echo.echo, stats=stats)
+        assert stats.images_downloaded == len(IMAGE_TWEET_IDS) and stats.images_cached == 0
+        assert stats.bytes_downloaded == sum(os.path.getsize(p) for p in glob.glob(os.path.join("images", "*")))
+
+        # The same images again, under a new path, come from the cache rather than being downloaded.
+        options['image-path'] = "cached-images"
+        options['append'] = True
+        stats = RunStats()
+        render(tweets, options, "{{ tweet.id }}", cache, mock_echo.echo, stats=stats)
+        assert stats.images_cached == len(IMAGE_TWEET_IDS)
+        assert stats.images_downloaded == stats.bytes_downloaded == 0
+        assert stats.metrics()['images_reused'] == len(IMAGE_TWEET_IDS)
+
+        options['image-path'] = "failed-images"
+        stats = RunStats()
+
+        with pytest.raises(TwempestError):
+            render(tweets, options, "{{ tweet.id }}", failing_download, mock_echo.echo, stats=stats)
+
+        assert stats.images_downloaded == 0 and stats.images_failed >= 1
+
+
 # noinspection PyShadowingNames
 def test_render_pickle(mock_echo, tweets):
     with CliRunner().isolated_filesystem():
@@ -363,7 +576,7 @@ def test_render_pickle(mock_echo, tweets):
         render(tweets, options, template_text, mock_download, mock_echo.echo)
 
         assert os.path.exists(PICKLE_FILE_NAME)
-        pickled_tweets = pickle.load(open(PICKLE_FILE_NAME, "rb"))
+        pickled_tweets = list(TweetStreamReader(PICKLE_FILE_NAME))
         assert len(pickled_tweets) == 5
 
         for i, pickled_tweet in enumerate(pickled_tweets):
@@ -383,3 +596,126 @@ def test_render_html_entity_in_text(mock_echo, tweets):
     rendered = [m for m in mock_echo.messages if m]
     assert len(rendered) == 1
     assert rendered[0] == "That isn&#39;t Harry&#39;s sandwich &amp; apple."
+
+
+# noinspection PyShadowingNames
+def test_render_fail_download(mock_echo, tweets):
+    def failing_download(url, file_path):
+        raise TwempestError(f"Unable to download image file: {url}")
+
+    with CliRunner().isolated_filesystem():
+        template_text = "{{ tweet.id }}"
+        options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+        options['image-path'] = "images"
+        options['image-url'] = "/images/"
+        options['render-file'] = "{{ tweet.id }}.txt"
+
+        with pytest.raises(TwempestError) as excinfo:
+            render(tweets, options, template_text, failing_download, mock_echo.echo)
+
+        assert "Unable to download image file:" in str(excinfo.value)
+
+
+# noinspection PyShadowingNames
+def test_render_shared_image_path(mock_echo, tweets):
+    downloaded_file_paths = []
+
+    def slow_download(url, file_path):
+        # Write the file the way HttpDownloader does, slowly enough that the next tweet's downloads are queued first.
+        time.sleep(0.05)
+
+        with open(file_path + ".part", "wb") as f:
+            f.write(url.encode('utf-8'))
+
+        os.replace(file_path + ".part", file_path)
+        downloaded_file_paths.append(file_path)
+
+    with CliRunner().isolated_filesystem():
+        template_text = "{{ tweet.id }}"
+        options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+        options['image-path'] = "images"
+        options['image-url'] = "/images/"
+        # Every tweet is rendered to the one file, so every tweet's first image has the same file name.
+        options['render-file'] = "{{ tweet.created_at.year }}.md"
+        options['append'] = True
+        options['replies'] = True
+        render(tweets, options, template_text, slow_download, mock_echo.echo)
+        assert downloaded_file_paths == [os.path.abspath(os.path.join("images", "2016-0.jpg"))]
+        assert len([m for m in mock_echo.messages if "Skipping existing image file" in m]) == len(IMAGE_TWEET_IDS) - 1
+
+
+# noinspection PyShadowingNames
+def test_replay(mock_echo, tweets):
+    with CliRunner().isolated_filesystem():
+        template_text = "{{ tweet.id }}"
+        options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+        options['pickle'] = True
+        options['replies'] = True
+        last_id = render(tweets, options, template_text, mock_download, mock_echo.echo)
+
+        options['pickle'] = False
+        options['render-file'] = "{{ tweet.id }}.txt"
+        options['since-id'] = str(tweets[-4].id)
+        assert replay(PICKLE_FILE_NAME, options, template_text, mock_echo.echo) == last_id
+        assert sorted(glob.glob("*.txt")) == sorted(f"{t.id}.txt" for t in tweets[-3:])
+
+
+# noinspection PyShadowingNames
+def test_rewritten_image_entities(tweets):
+    options = {k: v.default for k, v in CONFIG_OPTIONS.items()}
+    options['render-file'] = "{{ tweet.id }}.md"
+    options['image-path'] = "images"
+    options['image-url'] = "/images/"
+    renderer = TweetRenderer(options, "{{ tweet.id }}")
+
+    for tweet in (t for t in tweets if t.id in IMAGE_TWEET_IDS):
+        view = TweetView(tweet)
+        original_entities = copy.deepcopy(view.entities)
+        rendered_tweet = renderer.render(view)
+
+        # The rewritten image URLs are built into a new view, leaving the given one as it was.
+        assert view.entities == original_entities
+        media = rendered_tweet.tweet.entities['media'][0]
+        assert media['media_url'].startswith(f"/images/{tweet.id}-0.")
+        assert media['original_media_url'] == original_entities['media'][0]['media_url']
+
+
+# noinspection PyShadowingNames
+def test_rewritten_image_entities_media_update(tweets):
+    env = jinja2.Environment()
+    image_dir_path_template = env.from_string("images")
+    image_url_path_template = env.from_string("/images/")
+
+    for tweet in (t for t in tweets if t.id in IMAGE_TWEET_IDS):
+        original_entities = copy.deepcopy(tweet.entities)
+        entities, image_downloads = rewritten_image_entities(tweet, image_dir_path_template, image_url_path_template,
+                                                             f"tweet_{tweet.id}_file.md")
+        assert tweet.entities == original_entities
+        photos = [(b, a) for b, a in zip(original_entities['media'], entities['media']) if b['type'] == 'photo']
+        assert len(image_downloads) == len(photos)
+
+        for (before, after), (url, file_path) in zip(photos, image_downloads):
+            assert url == before['media_url_https']
+            assert file_path.endswith(os.path.join("images", f"tweet_{tweet.id}_file-0.jpg"))
+            assert before['media_url'] == after['original_media_url']
+            assert before['media_url'] != after['media_url']
+            assert before['media_url_https'] == after['original_media_url_https']
+            assert before['media_url_https'] != after['media_url_https']
+
+
+# noinspection PyShadowingNames
+def test_rewritten_image_entities_replayed(tweets):
+    env = jinja2.Environment()
+    image_dir_path_template = env.from_string("images")
+    tweet = TweetView(next(t for t in tweets if t.id in IMAGE_TWEET_IDS))
+    original_urls = [m['media_url_https'] for m in tweet.entities['media'] if m['type'] == 'photo']
+
+    for image_url in ("https://example.com/first/", "https://example.com/second/"):
+        entities, image_downloads = rewritten_image_entities(tweet, image_dir_path_template,
+                                                             env.from_string(image_url), "tweet.md")
+        assert [url for url, _ in image_downloads] == original_urls
+        photos = [m for m in entities['media'] if m['type'] == 'photo']
+        assert all(m['media_url_https'].startswith(image_url) for m in photos)
+        assert [m['original_media_url_https'] for m in photos] == original_urls
+        # As though the rendered tweet were saved and then replayed.
+        tweet = TweetView(tweet, entities=entities)
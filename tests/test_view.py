@@ -0,0 +1,65 @@
+""" Twempest tweet view unit tests.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import copy
+import datetime
+import pickle
+
+# noinspection PyPackageRequirements
+import pytest
+import pytz
+
+from twempest.archive import ArchiveTweet
+from twempest.view import TweetView
+from .fixtures import tweets_fixture
+
+
+def test_tweet_view():
+    tweets = tweets_fixture()
+    tz = pytz.timezone('America/Whitehorse')
+
+    for tweet in tweets:
+        original = copy.deepcopy(tweet)
+        view = TweetView(tweet, tz)
+
+        assert view.id == tweet.id
+        assert view.text == getattr(tweet, 'text', getattr(tweet, 'full_text', None))
+        assert view.entities == tweet.entities
+        assert view.user.screen_name == tweet.user.screen_name
+        assert view.author is view.user
+        assert view.created_at.tzinfo.zone == 'America/Whitehorse'
+        assert view.created_at == tweet.created_at.astimezone(tz)
+        assert not hasattr(view, '_json')
+
+        # The view's media entities are its own.
+        for media in view.entities.get('media', []):
+            media['media_url'] = "rewritten"
+
+        assert tweet.entities == original.entities
+
+        with pytest.raises(AttributeError):
+            view.text = "Changed"
+
+        pickled_view = pickle.dumps(view)
+        assert len(pickled_view) < len(pickle.dumps(tweet))
+        assert pickle.loads(pickled_view).entities == view.entities
+
+    # Views are much smaller to pickle than the Status objects they're made from.
+    assert sum(len(pickle.dumps(TweetView(t))) for t in tweets) < sum(len(pickle.dumps(t)) for t in tweets) * 0.6
+
+    retweets = [t for t in tweets if hasattr(t, 'retweeted_status')]
+    assert retweets
+    assert all(isinstance(TweetView(t).retweeted_status, TweetView) for t in retweets)
+
+
+def test_tweet_view_archive():
+    tweet = ArchiveTweet({'id_str': "123", 'full_text': "Archived", 'created_at': "Wed Oct 10 20:19:24 +0000 2018"})
+    view = TweetView(tweet)
+
+    assert view.text == view.full_text == "Archived"
+    assert view.created_at == datetime.datetime(2018, 10, 10, 20, 19, 24, tzinfo=datetime.timezone.utc)
+    assert not hasattr(view, 'user')
+    assert not hasattr(view, 'author')
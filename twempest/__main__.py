@@ -6,19 +6,35 @@
 
 import collections
 import configparser
+import contextlib
 import hashlib
 import os
+import random
 import re
+import signal
+import threading
 
 import click
 
-from .twempest import retrieve, TwempestError
+from .errors import TwempestError
+from .stats import RunStats
+from .stream import PICKLE_FILE_NAME
+
+# The rendering modules, and the tweepy, jinja2 and requests packages that they depend upon, are slow to import, so
+# they are only imported by the functions that need them. That way, --help, --version and --dry-run start quickly.
 
 
 # Global config 'constants'.
 CONFIG_FILE_NAME = "twempest.config"
 DEFAULT_CONFIG_DIR_PATH = "~/.twempest"
 FALLBACK_CONFIG_DIR_PATH = "."
+TEMPLATE_CACHE_DIR_NAME = "template-cache"
+DEFAULT_BATCH_ACCOUNTS = 4
+# The node exporter's textfile collector only reads files with this extension.
+PROMETHEUS_FILE_EXTENSION = ".prom"
+# Each --watch poll comes within this fraction of the interval either side of the scheduled time.
+WATCH_JITTER = 0.1
+CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
 # Collect all configuration options (that may also appear in the config file) here so that they don't have to be
 # duplicated.
@@ -29,10 +45,36 @@ CONFIG_OPTIONS = {
                                      "version."),
     'append': ConfigOption('a', False, False, True,
                            "Append rendered tweet(s) to existing file(s) rather than skipping past with a warning."),
+    'checkpoint-every': ConfigOption(None, 100, True, False, "Record the ID of the last rendered tweet, so that an "
+                                                             "interrupted run can carry on from there, after rendering "
+                                                             "this many tweets."),
+    'checkpoint-seconds': ConfigOption(None, 30.0, True, False, "Also record the ID of the last rendered tweet after "
+                                                                "rendering for this many seconds."),
     'count': ConfigOption('n', 200, True, False, "Maximum number of tweets to retrieve. The actual number may be "
                                                  "lower."),
+    'cprofile-file': ConfigOption(None, None, False, False, "Profile the run with cProfile and dump the statistics to "
+                                                            "this file path, for analysis with the pstats module."),
+    'download-retries': ConfigOption(None, 3, True, False, "Number of times to retry a failed image download, waiting "
+                                                           "a little longer before each attempt."),
+    'download-timeout': ConfigOption(None, 30.0, True, False, "Seconds to wait for an image server to respond before "
+                                                              "giving up."),
+    'download-workers': ConfigOption(None, 4, True, False, "Number of images to download concurrently while "
+                                                           "rendering."),
     'dry-run': ConfigOption('D', False, False, True, "Display all configuration options and template contents without "
                                                      "retrieving tweets."),
+    'from-archive': ConfigOption(None, None, False, False, "Render the tweets of a downloaded Twitter archive, "
+                                                           "found at this directory (or tweets.js file) path, "
+                                                           "instead of retrieving them from Twitter. Images are "
+                                                           "copied from the archive. The --since-id option is not "
+                                                           "required."),
+    'image-cache': ConfigOption(None, None, False, False, "The directory path of a cache of downloaded image files "
+                                                          "that is shared across runs. Cached images are hard-linked "
+                                                          "(or copied) into the --image-path directory instead of "
+                                                          "being downloaded again. If omitted, images are always "
+                                                          "downloaded."),
+    'image-cache-size': ConfigOption(None, 1024, True, False, "Maximum size in megabytes of the --image-cache "
+                                                              "directory. The least recently used images are evicted "
+                                                              "beyond this size."),
     'image-path': ConfigOption('i', None, False, False, "The directory path (template tags allowed) to write "
                                                         "downloaded image (media type == 'photo') files. The directory "
                                                         "path will be created if it doesn't exist. Media file names "
@@ -41,9 +83,23 @@ CONFIG_OPTIONS = {
                                                         "If omitted, media files will not be downloaded."),
     'image-url': ConfigOption('u', None, False, False, "The URL path (template tags allowed) to use for all image "
                                                        "files downloaded via the --image-path option."),
-    'pickle': ConfigOption(None, False, False, True, "Serialize a list of the rendered tweet statuses as a standard "
-                                                     "Python pickle byte stream. The stream will be written to "
-                                                     "'twempest.p' in the current working directory."),
+    'jobs': ConfigOption('j', 1, True, False, "Number of processes to render tweets with. Tweets are still written "
+                                              "in timeline order."),
+    'metrics-file': ConfigOption(None, None, False, False, "Write the run's metrics (tweets rendered and skipped, "
+                                                           "files written, images downloaded, API requests, phase "
+                                                           "durations and so on) to this file path at the end of each "
+                                                           "run. The metrics are written in the Prometheus text format "
+                                                           "for the node exporter's textfile collector if the file "
+                                                           "name ends with .prom, and as a JSON document otherwise."),
+    'pickle': ConfigOption(None, False, False, True, "Serialize the rendered tweet statuses, each as it is "
+                                                     "rendered, to a stream of Python pickle records. The records will "
+                                                     "be appended to the stream at the --pickle-file path."),
+    'pickle-file': ConfigOption(None, PICKLE_FILE_NAME, True, False, "The file path of the --pickle stream. A "
+                                                                     "relative path is relative to the current "
+                                                                     "working directory."),
+    'profile': ConfigOption(None, False, False, True, "Time each phase of the run (retrieving, rendering, "
+                                                      "downloading, writing and so on) and display a summary, "
+                                                      "including the slowest tweets, at the end."),
     'quiet': ConfigOption('q', False, False, True, "Suppress warning messages."),
     'render-file': ConfigOption('f', None, False, False, "The file name (template tags allowed) for the rendered "
                                                          "tweets. If omitted, tweets will be rendered to STDOUT."),
@@ -51,14 +107,51 @@ CONFIG_OPTIONS = {
                                                        "rendered tweet files. The directory path will be created if "
                                                        "it doesn't exist."),
     'replies': ConfigOption('@', False, False, True, "Include @replies in the list of retrieved tweets."),
+    'replay': ConfigOption(None, None, False, False, "Render the tweets saved to this --pickle-file path by an earlier "
+                                                     "--pickle run, instead of retrieving them from Twitter. Useful "
+                                                     "for trying out template changes. The --since-id option is not "
+                                                     "required and the recorded last tweet ID is left unchanged."),
+    'resume': ConfigOption(None, False, False, True, "Carry on with an interrupted --from-archive run from the last "
+                                                     "recorded tweet ID, rather than starting from the beginning of "
+                                                     "the archive."),
     'retweets': ConfigOption('r', False, False, True, "Include retweets in the list of retrieved tweets."),
     'since-id': ConfigOption('s', None, False, False, "Retrieve tweets that follow this ID in the timeline. "
                                                       "Required, unless the ID has already been recorded in the config "
                                                       "path directory after a previous run of Twempest."),
     'skip': ConfigOption('k', None, False, False, "Skip any rendered tweets that contain this regular expression "
                                                   "pattern."),
+    'store': ConfigOption(None, None, False, False, "Keep every retrieved tweet in a local tweet store in this "
+                                                    "directory path, and only retrieve the tweets that are newer than "
+                                                    "those already in it. Tweets are rendered from the store, so "
+                                                    "earlier tweets may be rendered again with a lower --since-id "
+                                                    "without retrieving them from Twitter."),
+    'tracemalloc-file': ConfigOption(None, None, False, False, "Trace memory allocations during the run and dump a "
+                                                               "tracemalloc snapshot to this file path."),
+    'watch': ConfigOption(None, None, False, False, "Keep running, checking for new tweets to render about every this "
+                                                    "many seconds, until stopped with Ctrl-C or SIGTERM."),
 }
 
+# The options whose values are themselves templates.
+TEMPLATE_OPTIONS = ('image-path', 'image-url', 'render-file', 'render-path')
+
+
+class DefaultCommandGroup(click.Group):
+    """ Command group that runs the default command whenever the first argument isn't the name of another command, so
+        that 'twempest TEMPLATE' works alongside 'twempest compile TEMPLATE'. A lone help option shows the group's own
+        help, listing all of the commands.
+    """
+    def __init__(self, *args, default_command_name, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command_name = default_command_name
+
+    def parse_args(self, ctx, args):
+        is_group_help = len(args) == 1 and args[0] in ctx.help_option_names
+
+        if not is_group_help and (not args or args[0] not in self.commands):
+            args.insert(0, self.default_command_name)
+
+        return super().parse_args(ctx, args)
+
 
 def choose_config_path(cli_dir_path, default_dir_path, fallback_dir_path, file_name):
     """ Choose the most likely configuration path from, in order: the CLI config-path option, the default path, and the
@@ -99,6 +192,94 @@ def choose_option_values(config_options, cli_options, config):
     return options
 
 
+def choose_run_options(config_dir_path, config_file_path, config, cli_options):
+    """ Choose and check the option values for a run of Twempest with the given configuration (see read_config()) and
+        CLI options. Return the options and the Twitter authentication credentials (or None if they aren't needed and
+        weren't given) as a tuple. Raise a ClickException if anything is amiss.
+    """
+    try:
+        twitter_config = config['twitter']
+        twempest_config = config['twempest']
+    except KeyError as e:
+        raise click.ClickException("Could not find required '[{}]' section in '{}'".format(str(e).strip("'"),
+                                                                                           config_file_path))
+
+    options = choose_option_values(config_options=CONFIG_OPTIONS, cli_options=cli_options, config=twempest_config)
+    is_offline = options['from-archive'] or options['replay']
+
+    if options['from-archive'] and options['replay']:
+        raise click.ClickException("The --from-archive and --replay options cannot be used together.")
+
+    try:
+        auth_keys = {k: twitter_config[k] for k in ('consumer_key', 'consumer_secret', 'access_token',
+                                                    'access_token_secret')}
+    except KeyError as e:
+        # Twitter isn't contacted when rendering an archive or replaying saved tweets.
+        if not is_offline:
+            raise click.ClickException("Could not find required Twitter authentication credential {} in '{}'"
+                                       .format(str(e), config_file_path))
+
+        auth_keys = None
+
+    options['config-path'] = config_file_path
+    options['template-cache'] = os.path.join(config_dir_path, TEMPLATE_CACHE_DIR_NAME)
+
+    convert_option_value(options, 'checkpoint-every', int, "an integer", minimum=1)
+    convert_option_value(options, 'checkpoint-seconds', float, "a number", minimum=0)
+    convert_option_value(options, 'count', int, "an integer", minimum=1)
+    convert_option_value(options, 'download-retries', int, "an integer", minimum=0)
+    convert_option_value(options, 'download-timeout', float, "a number", minimum=0.001)
+    convert_option_value(options, 'download-workers', int, "an integer", minimum=1)
+    convert_option_value(options, 'image-cache-size', int, "an integer", minimum=1)
+    convert_option_value(options, 'jobs', int, "an integer", minimum=1)
+
+    if options['watch'] is not None:
+        convert_option_value(options, 'watch', float, "a number", minimum=1)
+
+        if is_offline:
+            raise click.ClickException("The --watch option cannot be used with the --from-archive or --replay "
+                                       "options.")
+
+    if options['image-path'] and not options['render-file']:
+        raise click.ClickException("Cannot download images unless the --render-file option is also specified.")
+
+    if options['image-url'] and not options['image-path']:
+        raise click.ClickException("The --image-url option may only be specified if the --image-path option is as "
+                                   "well.")
+
+    if options['resume'] and not options['from-archive']:
+        raise click.ClickException("The --resume option may only be specified if the --from-archive option is as "
+                                   "well. Other runs always carry on from the last recorded tweet ID.")
+
+    if options['resume'] and not auth_keys:
+        raise click.ClickException("The --resume option requires the Twitter authentication credentials in '{}' in "
+                                   "order to find the last recorded tweet ID.".format(config_file_path))
+
+    if not is_offline or options['resume']:
+        options['since-id'] = choose_since_id(cli_since_id=options['since-id'],
+                                              user_id=twitter_config['consumer_key'], config_dir_path=config_dir_path)
+
+    if not options['since-id'] and not is_offline:
+        raise click.ClickException("The --since-id option is required since the ID was not recorded in '{}' after a "
+                                   "previous run of Twempest. To find the ID, open a specific tweet on the Twitter "
+                                   "website and view the page's address: the long number following 'status/' is that "
+                                   "tweet's ID.".format(config_dir_path))
+
+    if options['replay'] and options['pickle'] and \
+            os.path.abspath(os.path.expanduser(options['replay'])) == os.path.abspath(options['pickle-file']):
+        raise click.ClickException("The --pickle-file path must differ from the --replay path, which would otherwise "
+                                   "be overwritten while it is read.")
+
+    if options['skip'] is not None:
+        try:
+            # Replace skip option with compiled regular expression.
+            options['skip'] = re.compile(options['skip'])
+        except re.error as e:
+            raise click.ClickException("Syntax problem with --skip regular expression: {}".format(e))
+
+    return options, auth_keys
+
+
 def choose_since_id(cli_since_id, user_id, config_dir_path):
     """ Choose the most likely since ID value from, in order: the CLI since-id option, and a record of the ID written to
         a file in the config directory using the given user_id to distinguish it from others.
@@ -120,6 +301,27 @@ def choose_since_id(cli_since_id, user_id, config_dir_path):
     return since_id
 
 
+def config_path_option(fn):
+    """ Decorate the given command function with the --config-path option.
+    """
+    return click.option("--config-path", "-c", default=DEFAULT_CONFIG_DIR_PATH, show_default=True,
+                        help="Twempest configuration directory path, which must be writable, and must also contain "
+                             "the twempest.conf file.")(fn)
+
+
+def convert_option_value(options, option, convert_func, type_description, minimum):
+    """ Convert the value of the given option in place using convert_func(). Raise a ClickException if the value can't
+        be converted or is less than the given minimum.
+    """
+    try:
+        options[option] = convert_func(options[option])
+    except ValueError as e:
+        raise click.ClickException("The --{} option must be {}: {}".format(option, type_description, e))
+
+    if options[option] < minimum:
+        raise click.ClickException("The --{} option must be at least {}.".format(option, minimum))
+
+
 def decorate_config_options(options):
     """ Return a decorator with all of the CONFIG_OPTIONS items as a chain of click.option decorators, sorted by option
         name.
@@ -170,34 +372,55 @@ def last_tweet_id_file_name(user_id):
     return "twempest-last-{}.id".format(hashlib.sha1(user_id.encode('utf-8')).hexdigest())
 
 
-# noinspection PyUnusedLocal
-def show_version(ctx, param, value):
-    """ Display the version message.
+@contextlib.contextmanager
+def profiling(options):
+    """ Profile the body of the context with cProfile and trace its memory allocations with tracemalloc, if the
+        cprofile-file and tracemalloc-file options, respectively, are set. Dump the results to those file paths.
     """
-    if not value or ctx.resilient_parsing:
-        return  # pragma: no cover
-    from twempest import __version__
-    click.echo("Twempest version {}".format(__version__))
-    click.echo("Copyright 2018 Dave Rogers. Licensed under the GPLv3. See LICENSE.")
-    ctx.exit()
+    profiler = None
 
+    if options['cprofile-file']:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
-@click.option("--config-path", "-c", default=DEFAULT_CONFIG_DIR_PATH, show_default=True,
-              help="Twempest configuration directory path, which must be writable, and must also contain the "
-                   "twempest.conf file.")
-@decorate_config_options(CONFIG_OPTIONS)
-@click.option("--version", "-V", is_flag=True, callback=show_version, expose_value=False, is_eager=True,
-              help="Show version and exit.")
-@click.argument("template", type=click.File('r'))
-def twempest(**kwargs):
-    """ Download a sequence of recent Twitter tweets and convert these, via the given template file, to text format.
-        Twempest uses the Jinja template syntax throughout: http://jinja.pocoo.org/docs/2.10/templates/
+    if options['tracemalloc-file']:
+        import tracemalloc
+        tracemalloc.start()
+
+    try:
+        yield
+    finally:
+        snapshot = None
+
+        if profiler:
+            profiler.disable()
+
+        if options['tracemalloc-file']:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        try:
+            if profiler:
+                profiler.dump_stats(os.path.expanduser(options['cprofile-file']))
+
+            if snapshot:
+                snapshot.dump(os.path.expanduser(options['tracemalloc-file']))
+        except OSError as e:
+            raise click.ClickException("Unable to write profile file: {}".format(e))
+
+
+def read_config(cli_dir_path, is_strict=False):
+    """ Read the configuration file from the most likely configuration path (see choose_config_path()), or only from the
+        given CLI path if is_strict is True. Return the configuration directory path, configuration file path, and the
+        parsed configuration as a tuple.
     """
     config = configparser.RawConfigParser(allow_no_value=True)
-    config_dir_path, possible_paths = choose_config_path(cli_dir_path=kwargs['config_path'],
-                                                         default_dir_path=DEFAULT_CONFIG_DIR_PATH,
-                                                         fallback_dir_path=FALLBACK_CONFIG_DIR_PATH,
+    config_dir_path, possible_paths = choose_config_path(cli_dir_path=cli_dir_path,
+                                                         default_dir_path=cli_dir_path if is_strict else
+                                                         DEFAULT_CONFIG_DIR_PATH,
+                                                         fallback_dir_path=cli_dir_path if is_strict else
+                                                         FALLBACK_CONFIG_DIR_PATH,
                                                          file_name=CONFIG_FILE_NAME)
 
     if not config_dir_path:
@@ -206,61 +429,201 @@ def twempest(**kwargs):
 
     config_file_path = os.path.join(config_dir_path, CONFIG_FILE_NAME)
     config.read(config_file_path)
+    return config_dir_path, config_file_path, config
 
-    try:
-        twitter_config = config['twitter']
-        twempest_config = config['twempest']
-    except KeyError as e:
-        raise click.ClickException("Could not find required '[{}]' section in '{}'".format(str(e).strip("'"),
-                                                                                           config_file_path))
 
+def read_template(template_file):
+    """ Return the contents of the given template file.
+    """
     try:
-        auth_keys = {k: twitter_config[k] for k in ('consumer_key', 'consumer_secret', 'access_token',
-                                                    'access_token_secret')}
-    except KeyError as e:
-        raise click.ClickException("Could not find required Twitter authentication credential {} in '{}'"
-                                   .format(str(e), config_file_path))
+        return template_file.read()
+    except OSError as e:
+        raise click.ClickException("Unable to read template file: {}".format(e))
 
-    options = choose_option_values(config_options=CONFIG_OPTIONS, cli_options=kwargs, config=twempest_config)
-    options['config-path'] = config_file_path
+
+def run_twempest(options, auth_keys, config_dir_path, template_text, echo, downloader=None, stats=None,
+                 scheduler=None):
+    """ Render the tweets chosen by the given options (see choose_run_options()) with the given template text, then
+        record the ID of the last one rendered in the config directory. Optionally, share the given HttpDownloader and
+        RateLimitScheduler between runs and count what was done in the given RunStats. Display the profile report at
+        the end if the profile option is set, and write the run metrics, whether the run succeeds or not, if the
+        metrics-file option is set. Return the last tweet ID.
+    """
+    from .twempest import replay, retrieve, retrieve_archive
+
+    stats = stats or RunStats()
+    is_succeeded = False
+
+    # Record the last archived tweet ID too, so that later runs against Twitter carry on from there, but never move the
+    # recorded ID back (e.g., when rendering an archive that is older than the tweets already retrieved), which would
+    # have the next run retrieve and render those tweets all over again. Replayed tweets have been retrieved before, so
+    # leave the recorded ID alone.
+    if auth_keys and not options['replay']:
+        recorded_id = choose_since_id(None, user_id=auth_keys['consumer_key'], config_dir_path=config_dir_path)
+        recorded_id = int(recorded_id) if recorded_id and recorded_id.strip().isdigit() else 0
+
+        def checkpoint(tweet_id):
+            """ Record the given tweet ID as the last one rendered, unless a later one is already recorded.
+            """
+            nonlocal recorded_id
+
+            if int(tweet_id) > recorded_id:
+                write_last_tweet_id(tweet_id, user_id=auth_keys['consumer_key'], config_dir_path=config_dir_path)
+                recorded_id = int(tweet_id)
+    else:
+        checkpoint = None
 
     try:
-        options['count'] = int(options['count'])
-    except ValueError as e:
-        raise click.ClickException("The --count option must be an integer: {}".format(e))
+        with profiling(options):
+            if options['replay']:
+                last_tweet_id = replay(stream_path=options['replay'], options=options, template_text=template_text,
+                                       echo=echo, checkpoint=checkpoint, downloader=downloader, stats=stats)
+            elif options['from-archive']:
+                last_tweet_id = retrieve_archive(archive_path=options['from-archive'], options=options,
+                                                 template_text=template_text, echo=echo, checkpoint=checkpoint,
+                                                 stats=stats)
+            else:
+                last_tweet_id = retrieve(auth_keys=auth_keys, options=options, template_text=template_text,
+                                         echo=echo, checkpoint=checkpoint, downloader=downloader, stats=stats,
+                                         scheduler=scheduler)
+
+        if last_tweet_id and checkpoint:
+            checkpoint(last_tweet_id)
+
+        is_succeeded = True
+    except TwempestError as e:
+        raise click.ClickException(e)
+    finally:
+        if options['metrics-file']:
+            write_metrics(stats, options['metrics-file'], is_succeeded)
+
+    if options['profile']:
+        echo(stats.profile_report(), err=True)
+
+    return last_tweet_id
 
-    if options['count'] < 1:
-        raise click.ClickException("The --count option must be at least 1.")
 
-    if options['image-path'] and not options['render-file']:
-        raise click.ClickException("Cannot download images unless the --render-file option is also specified.")
+# noinspection PyUnusedLocal
+def show_version(ctx, param, value):
+    """ Display the version message.
+    """
+    if not value or ctx.resilient_parsing:
+        return  # pragma: no cover
+    from twempest import __version__
+    click.echo("Twempest version {}".format(__version__))
+    click.echo("Copyright 2018 Dave Rogers. Licensed under the GPLv3. See LICENSE.")
+    ctx.exit()
 
-    if options['image-url'] and not options['image-path']:
-        raise click.ClickException("The --image-url option may only be specified if the --image-path option is as "
-                                   "well.")
 
-    options['since-id'] = choose_since_id(cli_since_id=options['since-id'], user_id=twitter_config['consumer_key'],
-                                          config_dir_path=config_dir_path)
+def watch_twempest(options, auth_keys, config_dir_path, template_text, echo):
+    """ Run Twempest (see run_twempest()) over and over, about every options['watch'] seconds, until SIGINT or SIGTERM.
+        The authenticated API, rate limit budget, HTTP connections and compiled templates are all kept between runs,
+        and each run carries on from the last tweet ID of the one before. A signal received in the middle of a run
+        lets it finish first, unless the run is waiting for a rate limit to reset, which is cut short. A second SIGINT
+        interrupts the run at once.
+    """
+    from .download import HttpDownloader
+    from .ratelimit import RateLimitScheduler
+    from .twempest import authenticate_twitter_api
 
-    if not options['since-id']:
-        raise click.ClickException("The --since-id option is required since the ID was not recorded in '{}' after a "
-                                   "previous run of Twempest. To find the ID, open a specific tweet on the Twitter "
-                                   "website and view the page's address: the long number following 'status/' is that "
-                                   "tweet's ID.".format(config_dir_path))
+    stop = threading.Event()
 
-    if options['skip'] is not None:
-        try:
-            # Replace skip option with compiled regular expression.
-            options['skip'] = re.compile(options['skip'])
-        except re.error as e:
-            raise click.ClickException("Syntax problem with --skip regular expression: {}".format(e))
+    # noinspection PyUnusedLocal
+    def request_stop(signal_number, frame):
+        """ Stop watching once the current run, if any, is done, or at once if Ctrl-C is pressed again.
+        """
+        if stop.is_set() and signal_number == signal.SIGINT:
+            raise KeyboardInterrupt
 
-    template_file = kwargs['template']
+        stop.set()
+
+    def sleep_unless_stopped(seconds):
+        """ Sleep for the given number of seconds while the rate limit resets, but give up on the run if watching is
+            stopped in the meantime, rather than waiting out the rest.
+        """
+        if stop.wait(seconds):
+            raise TwempestError("Stopped watching while waiting for the Twitter API rate limit to reset.")
+
+    previous_handlers = {s: signal.signal(s, request_stop) for s in (signal.SIGINT, signal.SIGTERM)}
+    scheduler = RateLimitScheduler(authenticate_twitter_api(**auth_keys), echo, sleep=sleep_unless_stopped)
+    downloader = HttpDownloader(timeout=options['download-timeout'], retries=options['download-retries'],
+                                pool_size=options['download-workers'])
 
     try:
-        template_text = template_file.read()
+        while not stop.is_set():
+            try:
+                last_tweet_id = run_twempest(options, auth_keys, config_dir_path, template_text, echo=echo,
+                                             downloader=downloader, scheduler=scheduler)
+            except click.ClickException as e:
+                # Keep watching, as whatever went wrong (e.g., a network outage) may well have cleared up by next time.
+                echo("Warning: {}".format(e.format_message()), warning=True)
+            else:
+                if last_tweet_id:
+                    options['since-id'] = str(last_tweet_id)
+
+            # Spread the polls out a little so that several watchers don't all hit Twitter at the same moment.
+            stop.wait(options['watch'] * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER))
+    finally:
+        downloader.close()
+
+        for signal_number, handler in previous_handlers.items():
+            signal.signal(signal_number, handler)
+
+
+def write_last_tweet_id(last_tweet_id, user_id, config_dir_path):
+    """ Record the given last tweet ID in a file in the config directory, using the given user_id to distinguish it from
+        others. The file is replaced atomically, so that it's never left half-written, even if Twempest is killed.
+    """
+    from .download import write_atomically
+
+    try:
+        write_atomically(os.path.join(config_dir_path, last_tweet_id_file_name(user_id=user_id)), str(last_tweet_id))
     except OSError as e:
-        raise click.ClickException("Unable to read template file: {}".format(e))
+        raise click.ClickException("Unable to write last tweet ID file: {}".format(e))
+
+
+def write_metrics(stats, metrics_file_path, is_succeeded):
+    """ Write the metrics in the given RunStats, and whether the run succeeded, to the file at the given path, in the
+        Prometheus text format if its name ends with PROMETHEUS_FILE_EXTENSION, or else as JSON. The file is replaced
+        atomically, so that a collector never reads it half-written.
+    """
+    from .download import write_atomically
+
+    metrics_file_path = os.path.expanduser(metrics_file_path)
+
+    if metrics_file_path.endswith(PROMETHEUS_FILE_EXTENSION):
+        text = stats.metrics_prometheus(is_succeeded)
+    else:
+        text = stats.metrics_json(is_succeeded)
+
+    try:
+        write_atomically(metrics_file_path, text)
+    except OSError as e:
+        raise click.ClickException("Unable to write metrics file: {}".format(e))
+
+
+@click.group(cls=DefaultCommandGroup, default_command_name="render", context_settings=CONTEXT_SETTINGS)
+def twempest():
+    """ Twitter to text via template. The 'render' command is the default, so 'twempest TEMPLATE' is short for
+        'twempest render TEMPLATE'. See 'twempest render --help' for its options.
+    """
+
+
+@twempest.command(name="render", context_settings=CONTEXT_SETTINGS)
+@config_path_option
+@decorate_config_options(CONFIG_OPTIONS)
+@click.option("--version", "-V", is_flag=True, callback=show_version, expose_value=False, is_eager=True,
+              help="Show version and exit.")
+@click.argument("template", type=click.File('r'))
+def render_command(**kwargs):
+    """ Download a sequence of recent Twitter tweets and convert these, via the given template file, to text format.
+        Twempest uses the Jinja template syntax throughout: http://jinja.pocoo.org/docs/2.10/templates/
+
+        The 'render' command name may be omitted. See also 'twempest compile --help' and 'twempest batch --help'.
+    """
+    config_dir_path, config_file_path, config = read_config(kwargs['config_path'])
+    options, auth_keys = choose_run_options(config_dir_path, config_file_path, config, cli_options=kwargs)
+    template_text = read_template(kwargs['template'])
 
     if options['dry-run']:
         for option in sorted(options.keys()):
@@ -269,17 +632,125 @@ def twempest(**kwargs):
         click.echo()
         click.echo("template =")
         click.echo(template_text)
+    elif options['watch']:
+        watch_twempest(options, auth_keys, config_dir_path, template_text,
+                       echo=echo_wrapper(click.echo, options['quiet']))
     else:
+        run_twempest(options, auth_keys, config_dir_path, template_text,
+                     echo=echo_wrapper(click.echo, options['quiet']))
+
+
+@twempest.command(name="compile", context_settings=CONTEXT_SETTINGS)
+@config_path_option
+@click.argument("template", type=click.File('r'))
+def compile_command(config_path, template):
+    """ Compile the given template file, along with any template options in the configuration file, ahead of time.
+        The compiled templates are cached in the configuration directory so that later runs can skip parsing them.
+    """
+    from jinja2.exceptions import TemplateError
+    from .twempest import compile_template, create_environment
+
+    config_dir_path, _, config = read_config(config_path)
+    template_texts = [read_template(template)]
+
+    if config.has_section('twempest'):
+        template_texts.extend(config['twempest'][o] for o in TEMPLATE_OPTIONS if config['twempest'].get(o))
+
+    template_cache_dir_path = os.path.join(config_dir_path, TEMPLATE_CACHE_DIR_NAME)
+    env = create_environment(template_cache_dir_path)
+
+    for template_text in template_texts:
+        try:
+            compile_template(env, template_text)
+        except TemplateError as e:
+            raise click.ClickException("Unable to compile template: {}".format(e))
+
+    click.echo("Compiled {} template(s) into '{}'.".format(len(template_texts), template_cache_dir_path))
+
+
+@twempest.command(name="batch", context_settings=CONTEXT_SETTINGS)
+@click.option("--accounts", "-a", default=DEFAULT_BATCH_ACCOUNTS, show_default=True, type=click.IntRange(min=1),
+              help="Maximum number of accounts to render at once.")
+@click.argument("template", type=click.File('r'))
+@click.argument("config_paths", nargs=-1, required=True)
+def batch_command(accounts, template, config_paths):
+    """ Render the tweets of several Twitter accounts with the given template file in a single run, one account per
+        Twempest configuration directory path given. Each account's options come from the twempest.conf file in its
+        directory, where its last tweet ID is also recorded. The accounts share compiled templates (cached in the first
+        directory) and image download connections (configured by the first account's download options). Accounts with
+        the dry-run option set are skipped, and those with the watch option set fail.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from .download import HttpDownloader
+
+    template_text = read_template(template)
+    runs = collections.OrderedDict()
+    dry_runs = []
+    failures = collections.OrderedDict()
+
+    for config_path in config_paths:
         try:
-            last_tweet_id = retrieve(auth_keys=auth_keys, options=options, template_text=template_text,
-                                     echo=echo_wrapper(click.echo, options['quiet']))
-        except TwempestError as e:
-            raise click.ClickException(e)
+            config_dir_path, config_file_path, config = read_config(config_path, is_strict=True)
+            options, auth_keys = choose_run_options(config_dir_path, config_file_path, config, cli_options={})
+
+            if options['watch'] is not None:
+                raise click.ClickException("The watch option cannot be used with the batch command. Run "
+                                           "'twempest --watch' for the account instead.")
+        except click.ClickException as e:
+            failures[config_path] = e.format_message()
+            continue
+
+        # Like 'twempest --dry-run', render nothing and leave the last tweet ID alone.
+        if options['dry-run']:
+            dry_runs.append(config_path)
+        else:
+            runs[config_path] = (config_dir_path, options, auth_keys)
 
-        if last_tweet_id:
+    def run_account(config_path, config_dir_path, options, auth_keys):
+        """ Render the tweets of the account with the given configuration, prefixing any warnings with the account's
+            config path. Return the RunStats for the account.
+        """
+        def echo(message=None, warning=False, **kwargs):
+            """ Prefix warning messages with the account's config path.
+            """
+            if warning:
+                message = "{}: {}".format(config_path, message)
+
+            quiet_echo(message=message, warning=warning, **kwargs)
+
+        quiet_echo = echo_wrapper(click.echo, options['quiet'])
+        stats = RunStats()
+        run_twempest(options, auth_keys, config_dir_path, template_text, echo=echo, downloader=downloader,
+                     stats=stats)
+        return stats
+
+    if runs:
+        first_options = next(iter(runs.values()))[1]
+        downloader = HttpDownloader(timeout=first_options['download-timeout'],
+                                    retries=first_options['download-retries'],
+                                    pool_size=first_options['download-workers'] * accounts)
+
+        for _, options, _ in runs.values():
+            options['template-cache'] = first_options['template-cache']
+
+        try:
+            with ThreadPoolExecutor(max_workers=accounts) as executor:
+                futures = collections.OrderedDict((config_path, executor.submit(run_account, config_path, *run))
+                                                  for config_path, run in runs.items())
+        finally:
+            downloader.close()
+
+        for config_path, future in futures.items():
             try:
-                with open(os.path.join(config_dir_path, last_tweet_id_file_name(
-                        user_id=twitter_config['consumer_key'])), 'w') as f:
-                    f.write(str(last_tweet_id))
-            except OSError as e:
-                raise click.ClickException("Unable to write last tweet ID file: {}".format(e))
+                click.echo("{}: {}".format(config_path, future.result()))
+            except click.ClickException as e:
+                failures[config_path] = e.format_message()
+
+    for config_path in dry_runs:
+        click.echo("{}: Skipped, since the dry-run option is set.".format(config_path))
+
+    for config_path, message in failures.items():
+        click.echo("{}: Failed: {}".format(config_path, message), err=True)
+
+    if failures:
+        raise click.ClickException("{} of {} account(s) failed.".format(len(failures), len(config_paths)))
@@ -0,0 +1,228 @@
+""" Twempest Twitter archive reading.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import codecs
+import datetime
+import glob
+import json
+import os
+import re
+import shutil
+
+from .errors import TwempestError
+
+
+# Size of each chunk of an archive tweets file that is read from disk at a time.
+ARCHIVE_READ_SIZE = 1024 * 1024
+# Format of the created_at timestamps in the archive, e.g., "Wed Oct 10 20:19:24 +0000 2018".
+ARCHIVE_TIMESTAMP_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+# Whitespace and commas that separate the tweet records in the archive's array.
+RECORD_SEPARATOR_RE = re.compile(r"[ \t\r\n,]*")
+
+
+class ArchiveTweet:
+    """ A lightweight stand-in for a tweepy Status built from a tweet record in a Twitter archive. The record's fields
+        become attributes, just as they do for a Status, except that the archive's string-valued IDs and counts are
+        converted to integers and the created_at timestamp to a datetime. The archive's records leave out the user, so
+        the given ArchiveUser (the archive's account) is set in its place.
+    """
+    def __init__(self, record, user=None):
+        self.in_reply_to_screen_name = None
+        self.in_reply_to_status_id = None
+        self.in_reply_to_user_id = None
+        self.entities = {}
+
+        for key, value in record.items():
+            if isinstance(value, str) and value.isdigit() and (key == 'id' or key.endswith(('_id', '_count'))):
+                value = int(value)
+
+            setattr(self, key, value)
+
+        if user is not None:
+            self.user = user
+
+        self.id = int(record['id_str'])
+        self.created_at = datetime.datetime.strptime(record['created_at'], ARCHIVE_TIMESTAMP_FORMAT)
+
+    def __repr__(self):
+        return f"ArchiveTweet(id={self.id})"
+
+
+class ArchiveUser:
+    """ A lightweight stand-in for a tweepy User built from the account record of a Twitter archive, with the user
+        attributes that the account record has.
+    """
+    def __init__(self, record):
+        self.id_str = record['accountId']
+        self.id = int(self.id_str)
+        self.screen_name = record['username']
+        self.name = record.get('accountDisplayName', self.screen_name)
+
+    def __repr__(self):
+        return f"ArchiveUser(screen_name={self.screen_name})"
+
+
+class TwitterArchive:
+    """ The tweets and images of a personal Twitter archive, which may be given as the archive's root directory, its
+        data directory, or its tweets.js file. The tweets are read straight from disk without ever holding the whole of
+        the (possibly very large) tweets file in memory.
+    """
+    def __init__(self, archive_path):
+        if os.path.isfile(archive_path):
+            data_dir_path = os.path.dirname(archive_path)
+            self.tweet_file_paths = [archive_path]
+        else:
+            data_dir_path = os.path.join(archive_path, "data")
+
+            if not os.path.isdir(data_dir_path):
+                data_dir_path = archive_path
+
+            # Large archives split the tweets across tweets.js, tweets-part1.js, tweets-part2.js, etc.
+            self.tweet_file_paths = sorted(glob.glob(os.path.join(data_dir_path, "tweets.js"))) + \
+                sorted(glob.glob(os.path.join(data_dir_path, "tweets-part*.js")))
+
+        if not self.tweet_file_paths:
+            raise TwempestError(f"Unable to find a tweets.js file in the Twitter archive '{archive_path}'.")
+
+        account_file_path = os.path.join(data_dir_path, "account.js")
+        self.user = read_archive_account(account_file_path) if os.path.isfile(account_file_path) else None
+
+        # Archived images are named with the tweet ID followed by the base name of the image's URL, and the base
+        # names are unique across all tweets.
+        self.image_file_paths = {}
+
+        for media_dir_name in ("tweets_media", "tweet_media"):
+            media_dir_path = os.path.join(data_dir_path, media_dir_name)
+
+            if os.path.isdir(media_dir_path):
+                for entry in os.scandir(media_dir_path):
+                    self.image_file_paths[entry.name.partition('-')[2]] = entry.path
+
+    def copy_image(self, url, file_path):
+        """ Copy the archived image file with the given url to the given file path. Used in place of a download
+            function, hence the signature.
+        """
+        try:
+            archive_file_path = self.image_file_paths[os.path.basename(url)]
+        except KeyError:
+            raise TwempestError(f"Unable to find archived image file for '{url}'.")
+
+        try:
+            shutil.copyfile(archive_file_path, file_path)
+        except OSError as e:
+            raise TwempestError(f"Unable to copy archived image file: {e}")
+
+    def tweets(self, since_id=None, include_rts=True):
+        """ Yield the archived tweets, oldest first, as ArchiveTweet objects, with the archive's account (if it has an
+            account.js file) as their user. Only tweets that follow the given since_id
+            are yielded, and retweets only if include_rts is True.
+        """
+        since_id = int(since_id) if since_id else 0
+        index = []
+
+        # The archive's order isn't guaranteed, so first note where each wanted tweet record lies in the files, then
+        # read the records back in ID order.
+        for file_index, tweet_file_path in enumerate(self.tweet_file_paths):
+            for record, offset, length in read_archive_records(tweet_file_path):
+                tweet_id = int(record['id_str'])
+
+                if tweet_id > since_id and (include_rts or not record['full_text'].startswith("RT @")):
+                    index.append((tweet_id, file_index, offset, length))
+
+        index.sort()
+        tweet_files = [open(p, 'rb') for p in self.tweet_file_paths]
+
+        try:
+            for tweet_id, file_index, offset, length in index:
+                tweet_files[file_index].seek(offset)
+                yield ArchiveTweet(unwrap_record(json.loads(tweet_files[file_index].read(length))), self.user)
+        except OSError as e:
+            raise TwempestError(f"Unable to read Twitter archive file: {e}")
+        finally:
+            for tweet_file in tweet_files:
+                tweet_file.close()
+
+
+def read_archive_account(file_path):
+    """ Return the ArchiveUser for the account in the given archive account file, which is a JavaScript assignment of a
+        JSON array with a single record, e.g., "window.YTD.account.part0 = [ { "account" : { ... } } ]".
+    """
+    try:
+        with open(file_path, encoding='utf-8') as f:
+            text = f.read()
+    except OSError as e:
+        raise TwempestError(f"Unable to read Twitter archive file: {e}")
+
+    try:
+        record = json.loads(text[text.index('['):])[0]
+        return ArchiveUser(record.get('account', record))
+    except (ValueError, IndexError, KeyError, AttributeError) as e:
+        raise TwempestError(f"Unable to parse Twitter archive file '{file_path}': {e}")
+
+
+def read_archive_records(file_path):
+    """ Parse the given archive tweets file one record at a time, yielding each tweet record dict along with the byte
+        offset and length of its JSON text within the file. The file is a JavaScript assignment of a JSON array, e.g.,
+        "window.YTD.tweets.part0 = [ { "tweet" : { ... } }, ... ]".
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ""
+    pos = 0
+    # Byte offset within the file of the character at buffer[pos].
+    offset = 0
+    is_eof = False
+    is_array_started = False
+
+    try:
+        with open(file_path, 'rb') as f:
+            while True:
+                if not is_array_started:
+                    array_start = buffer.find('[', pos)
+
+                    if array_start >= 0:
+                        offset += len(buffer[pos:array_start + 1].encode('utf-8'))
+                        pos = array_start + 1
+                        is_array_started = True
+                        continue
+                else:
+                    # The separators are all ASCII, so their length in bytes is the same as in characters.
+                    separator_end = RECORD_SEPARATOR_RE.match(buffer, pos).end()
+                    offset += separator_end - pos
+                    pos = separator_end
+
+                    if buffer.startswith(']', pos):
+                        return
+
+                    if pos < len(buffer):
+                        try:
+                            record, end = decoder.raw_decode(buffer, pos)
+                        except json.JSONDecodeError as e:
+                            # Most likely the record continues past the end of the buffer.
+                            if is_eof:
+                                raise TwempestError(f"Unable to parse Twitter archive file '{file_path}': {e}")
+                        else:
+                            length = len(buffer[pos:end].encode('utf-8'))
+                            yield unwrap_record(record), offset, length
+                            offset += length
+                            pos = end
+                            continue
+
+                if is_eof:
+                    raise TwempestError(f"Unable to parse Twitter archive file '{file_path}': unexpected end of file.")
+
+                chunk = f.read(ARCHIVE_READ_SIZE)
+                is_eof = not chunk
+                buffer = buffer[pos:] + text_decoder.decode(chunk, final=is_eof)
+                pos = 0
+    except OSError as e:
+        raise TwempestError(f"Unable to read Twitter archive file: {e}")
+
+
+def unwrap_record(record):
+    """ Return the tweet fields of the given archive record, which are nested within a "tweet" key in newer archives.
+    """
+    return record.get('tweet', record)
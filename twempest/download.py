@@ -0,0 +1,346 @@
+""" Twempest image downloading.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import shutil
+import threading
+
+from .errors import TwempestError
+
+
+# Size of each chunk of a downloaded file that is read from the network and written to disk.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Default seconds to wait for the server to connect or send data before giving up.
+DEFAULT_DOWNLOAD_TIMEOUT = 30.0
+# Default number of times to retry a failed download.
+DEFAULT_DOWNLOAD_RETRIES = 3
+# Retry delays grow as backoff * 2^(retry - 1) seconds.
+DOWNLOAD_RETRY_BACKOFF = 0.5
+# HTTP status codes that are worth retrying.
+DOWNLOAD_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Once the media cache grows beyond its maximum size, files are evicted until it's down to this fraction of the maximum,
+# so that the next few additions don't each have to evict another.
+MEDIA_CACHE_LOW_WATER = 0.9
+# Number of downloads that may be queued per worker before submitting another blocks the caller.
+QUEUED_DOWNLOADS_PER_WORKER = 4
+
+
+class DownloadPool:
+    """ Run downloads on a bounded pool of worker threads so that they proceed concurrently with rendering. The pool is
+        called just like the download_func(url, file_path) function that it wraps, so it may be passed in its place.
+        Any exception raised by download_func() is re-raised by the next call to the pool or to wait().
+    """
+    def __init__(self, download_func, workers):
+        self.download_func = download_func
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers * QUEUED_DOWNLOADS_PER_WORKER)
+        self.futures = []
+
+    def __call__(self, url, file_path):
+        """ Queue the download of the file at the given url to the given file path, blocking while the queue is full.
+        """
+        self.raise_failure()
+        self.slots.acquire()
+        future = self.executor.submit(self.download_func, url, file_path)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(wait=True)
+
+    def raise_failure(self, wait=False):
+        """ Forget about completed downloads, raising the earliest failure among them. If wait is True, block until all
+            of the queued downloads have completed first.
+        """
+        futures, self.futures = self.futures, []
+
+        for i, future in enumerate(futures):
+            if not wait and not future.done():
+                self.futures.append(future)
+            elif future.exception() is not None:
+                self.futures.extend(futures[i + 1:])
+                raise future.exception()
+
+    def wait(self):
+        """ Block until all queued downloads have completed, then raise the earliest failure, if any.
+        """
+        self.raise_failure(wait=True)
+
+
+class HttpDownloader:
+    """ Download files over a pooled, keep-alive HTTP session, so that successive downloads from the same host reuse
+        the same connection. Failed requests are retried with exponential backoff. Like download_func(url, file_path),
+        the downloader is called with the URL to download and the file path to write to, and it raises a TwempestError
+        exception if anything goes wrong. It is safe to call from multiple threads.
+    """
+    def __init__(self, timeout=DEFAULT_DOWNLOAD_TIMEOUT, retries=DEFAULT_DOWNLOAD_RETRIES,
+                 backoff=DOWNLOAD_RETRY_BACKOFF, pool_size=1):
+        # Imported here, since requests is slow to import and only needed once there's something to download.
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=DOWNLOAD_RETRY_STATUSES)
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __call__(self, url, file_path):
+        """ Stream the file at the given url to the given file path. The file is written under a temporary name and
+            then renamed, so a failed download never leaves a partial file behind.
+        """
+        import requests
+
+        partial_file_path = file_path + ".part"
+
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+
+                with open(partial_file_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+
+            os.replace(partial_file_path, file_path)
+        except requests.RequestException as e:
+            # Check for RequestException first, since it is also an OSError.
+            remove_partial_file(partial_file_path)
+            raise TwempestError(f"Unable to download image file: {e}")
+        except OSError as e:
+            remove_partial_file(partial_file_path)
+            raise TwempestError(f"Unable to write downloaded image file: {e}")
+
+    def close(self):
+        """ Close all of the pooled connections.
+        """
+        self.session.close()
+
+
+class MediaCache:
+    """ Local content-addressed cache of downloaded media files that is shared across runs. File contents are stored
+        once under their SHA-256 digest, and each media URL maps to the digest of its contents. Cached files are
+        verified against their digest before they are reused, and are then hard-linked (or copied, if that fails) to
+        the requested file path, so that the network is only used for media that hasn't been seen before. Whenever the
+        cache grows beyond max_bytes, the least recently used files are evicted until it is a little below it. A
+        file's last use is recorded by touching its URL's entry rather than the file itself, which may be hard-linked
+        to a published copy. Like download_func(url, file_path), the cache is called with the URL to download and the
+        file path to write to, and it uses the given download_func() to fill cache misses. The number of cache hits is
+        tallied.
+    """
+    def __init__(self, cache_dir_path, max_bytes, download_func):
+        self.blobs_dir_path = os.path.join(cache_dir_path, "blobs")
+        self.urls_dir_path = os.path.join(cache_dir_path, "urls")
+        self.max_bytes = max_bytes
+        self.download_func = download_func
+        self.lock = threading.Lock()
+        # The cached file sizes by path, least recently used first, and their total, once they've been taken stock of.
+        self.blob_sizes = None
+        self.total_bytes = 0
+        self.hits = 0
+
+        try:
+            os.makedirs(self.blobs_dir_path, exist_ok=True)
+            os.makedirs(self.urls_dir_path, exist_ok=True)
+        except OSError as e:
+            raise TwempestError(f"Unable to create media cache directory: {e}")
+
+    def __call__(self, url, file_path):
+        """ Materialize the file at the given url at the given file path, from the cache if possible. Return True if
+            the file came from the cache, rather than being downloaded.
+        """
+        url_key_path = os.path.join(self.urls_dir_path, hashlib.sha1(url.encode('utf-8')).hexdigest())
+        blob_path = self._cached_blob_path(url_key_path)
+        is_cached = blob_path is not None
+
+        if is_cached:
+            with self.lock:
+                self.hits += 1
+
+                if self.blob_sizes is not None and blob_path in self.blob_sizes:
+                    self.blob_sizes.move_to_end(blob_path)
+        else:
+            blob_path = self._add(url, url_key_path)
+
+        try:
+            link_or_copy(blob_path, file_path)
+        except OSError as e:
+            raise TwempestError(f"Unable to write downloaded image file: {e}")
+
+        return is_cached
+
+    def _add(self, url, url_key_path):
+        """ Download the file at the given url into the cache, record its digest under the given URL key path, and
+            return the path to its cached contents.
+        """
+        download_path = os.path.join(self.blobs_dir_path, f".download-{threading.get_ident()}")
+        self.download_func(url, download_path)
+
+        try:
+            digest = file_digest(download_path)
+            blob_path = self._blob_path(digest)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(download_path, blob_path)
+            write_atomically(url_key_path, digest)
+            blob_size = os.path.getsize(blob_path)
+        except OSError as e:
+            remove_partial_file(download_path)
+            raise TwempestError(f"Unable to add downloaded image file to the media cache: {e}")
+
+        with self.lock:
+            self._scan()
+            self._forget(blob_path)
+            self.blob_sizes[blob_path] = blob_size
+            self.total_bytes += blob_size
+            self._evict()
+
+        return blob_path
+
+    def _blob_path(self, digest):
+        """ Return the path to the cached contents with the given digest.
+        """
+        return os.path.join(self.blobs_dir_path, digest[:2], digest)
+
+    def _cached_blob_path(self, url_key_path):
+        """ Return the path to the verified cached contents recorded under the given URL key path, or None if there is
+            no intact copy in the cache. Mark the contents as recently used, by touching the URL key file.
+        """
+        try:
+            with open(url_key_path, 'r') as f:
+                digest = f.read().strip()
+
+            blob_path = self._blob_path(digest)
+
+            if file_digest(blob_path) != digest:
+                # Don't trust a cached file that has been modified, perhaps through one of its hard links.
+                os.unlink(blob_path)
+
+                with self.lock:
+                    self._forget(blob_path)
+
+                return None
+
+            os.utime(url_key_path)
+            return blob_path
+        except OSError:
+            return None
+
+    def _evict(self):
+        """ If the cache has grown beyond its maximum size, delete the least recently used cached files until it's down
+            to the low-water mark, but never the most recently used one (i.e., the file just added). Must be called
+            with the lock held.
+        """
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        while self.total_bytes > self.max_bytes * MEDIA_CACHE_LOW_WATER and len(self.blob_sizes) > 1:
+            blob_path, blob_size = self.blob_sizes.popitem(last=False)
+            self.total_bytes -= blob_size
+
+            try:
+                os.unlink(blob_path)
+            except OSError:
+                pass
+
+    def _forget(self, blob_path):
+        """ Drop the cached file at the given path from the stock of cached files, if it's there. Must be called with
+            the lock held.
+        """
+        if self.blob_sizes is not None and blob_path in self.blob_sizes:
+            self.total_bytes -= self.blob_sizes.pop(blob_path)
+
+    def _scan(self):
+        """ Take stock of the cached file sizes, in order of their last use, the first time only. A file was last used
+            when the latest of its URL key files was written or touched (or, failing any, when it was added). Must be
+            called with the lock held.
+        """
+        if self.blob_sizes is not None:
+            return
+
+        blob_stats = {}
+
+        for dir_path, _, file_names in os.walk(self.blobs_dir_path):
+            for file_name in file_names:
+                if not file_name.startswith('.'):
+                    path = os.path.join(dir_path, file_name)
+
+                    try:
+                        blob_stats[path] = os.stat(path)
+                    except OSError:
+                        pass
+
+        last_used = {}
+
+        with os.scandir(self.urls_dir_path) as entries:
+            for entry in entries:
+                if '.' in entry.name:
+                    # A URL key file that's still being written.
+                    continue
+
+                try:
+                    with open(entry.path, 'r') as f:
+                        blob_path = self._blob_path(f.read().strip())
+
+                    last_used[blob_path] = max(last_used.get(blob_path, 0), entry.stat().st_mtime)
+                except OSError:
+                    pass
+
+        self.blob_sizes = collections.OrderedDict(
+            (path, blob_stats[path].st_size)
+            for path in sorted(blob_stats, key=lambda p: last_used.get(p, blob_stats[p].st_mtime)))
+        self.total_bytes = sum(self.blob_sizes.values())
+
+
+def file_digest(path):
+    """ Return the SHA-256 hex digest of the contents of the file at the given path.
+    """
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def link_or_copy(source_path, target_path):
+    """ Hard link the target path to the source file, or copy the file instead if they are on different file systems
+        (or the file system doesn't support hard links).
+    """
+    try:
+        os.link(source_path, target_path)
+    except FileExistsError:
+        # Never copy over an existing file.
+        raise
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+
+def remove_partial_file(path):
+    """ Delete the partially-downloaded file at the given path, if it exists.
+    """
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def write_atomically(path, text):
+    """ Write the given text to the file at the given path, such that readers see either the old or new contents.
+    """
+    temporary_path = f"{path}.{threading.get_ident()}.tmp"
+
+    with open(temporary_path, 'w') as f:
+        f.write(text)
+
+    os.replace(temporary_path, path)
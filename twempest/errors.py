@@ -0,0 +1,9 @@
+""" Twempest exceptions.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+
+class TwempestError(Exception):
+    pass
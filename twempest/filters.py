@@ -4,13 +4,75 @@
 # This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
 # License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
 
-import inspect
+import functools
 import os
 import re
 import unicodedata
-import sys
+import weakref
 
 import jinja2
+from jinja2.utils import LRUCache
+
+
+# Hashtags, user mentions, and t.co-wrapped URLs: the usual shapes of the entity texts found in tweets. The group keeps
+# the entities in the list returned by split(), and starting each alternative with a literal character lets the regular
+# expression engine skip straight past the text in between.
+ENTITY_RE = re.compile(r"(#\w+|@\w+|https?://t\.co/\w+)")
+# Maximum number of compiled patterns for entity texts that don't fit ENTITY_RE to cache.
+ENTITY_PATTERN_CACHE_SIZE = 64
+# Maximum number of compiled tag_format templates cached for each template environment.
+TAG_TEMPLATE_CACHE_SIZE = 32
+# Compiled tag_format template caches, keyed by template environment.
+TAG_TEMPLATE_CACHES = weakref.WeakKeyDictionary()
+
+
+@functools.lru_cache(maxsize=ENTITY_PATTERN_CACHE_SIZE)
+def _entity_pattern(entity_texts):
+    """ Return a compiled regular expression that matches any of the given entity texts, longest first, but only where
+        the match isn't immediately followed by another word character (so that '#tag' doesn't match '#tagged'). This
+        is the fallback for when ENTITY_RE won't do.
+    """
+    alternatives = '|'.join(re.escape(t) + r'(?!\w)' for t in sorted(entity_texts, key=len, reverse=True))
+    return re.compile(f"({alternatives})")
+
+
+def _rewrite_entities(text, replacements):
+    """ Replace each occurrence of the entity texts in the given {entity text: replacement} dictionary with its
+        replacement, building the new text in a single pass. Only whole entities are replaced (so that '#tag' doesn't
+        match '#tagged'), and replacement text is never itself rewritten.
+    """
+    if not replacements or not any(map(text.__contains__, replacements)):
+        return text
+
+    if all(map(ENTITY_RE.fullmatch, replacements)):
+        # The common case: no need to compile a pattern just for this tweet.
+        pieces = ENTITY_RE.split(text)
+    else:
+        pieces = _entity_pattern(frozenset(replacements)).split(text)
+
+    # The odd pieces are the entity-shaped texts between the rest, which are replaced (if they're entities at all)
+    # without calling back into Python for each one, as sub() would.
+    entity_texts = pieces[1::2]
+    pieces[1::2] = map(replacements.get, entity_texts, entity_texts)
+    return ''.join(pieces)
+
+
+def _tag_template(env, tag_format):
+    """ Return the template for the given tag_format compiled by the given environment, so that it shares the
+        environment's settings and filters. Each environment keeps a bounded cache of its compiled tag templates, since
+        the same few tag formats are rendered over and over for every tweet.
+    """
+    cache = TAG_TEMPLATE_CACHES.get(env)
+
+    if cache is None:
+        cache = TAG_TEMPLATE_CACHES[env] = LRUCache(TAG_TEMPLATE_CACHE_SIZE)
+
+    template = cache.get(tag_format)
+
+    if template is None:
+        template = cache[tag_format] = env.from_string(tag_format)
+
+    return template
 
 
 @jinja2.contextfilter
@@ -19,17 +81,10 @@ def delink(ctx, text):
         object as a guide.
     """
     tweet_entities = ctx.parent['tweet'].entities
-
-    for hashtag in tweet_entities.get('hashtags', []):
-        text = text.replace('#' + hashtag['text'], hashtag['text'])
-
-    for media in tweet_entities.get('media', []):
-        text = text.replace(media['url'], '')
-
-    for url in tweet_entities.get('urls', []):
-        text = text.replace(url['url'], '')
-
-    return text
+    replacements = {'#' + hashtag['text']: hashtag['text'] for hashtag in tweet_entities.get('hashtags', [])}
+    replacements.update((media['url'], '') for media in tweet_entities.get('media', []))
+    replacements.update((url['url'], '') for url in tweet_entities.get('urls', []))
+    return _rewrite_entities(text, replacements)
 
 
 def isodate(date):
@@ -50,17 +105,18 @@ def reimage(ctx, text, tag_format, delimiter=" "):
         'alt' and 'url', using the context's tweet status object to supply the necessary values.
     """
     tweet_entities = ctx.parent['tweet'].entities
+    replacements = {}
     images = []
 
     for media in (m for m in tweet_entities.get('media', []) if m['type'] == 'photo'):
-        text = text.replace(media['url'], '')
+        replacements[media['url']] = ''
         image_url = media['media_url_https'] if media['media_url_https'] else media['media_url']
         # Use the filename without extension for the alt text since there's really nothing better that's available.
         image_alt = os.path.splitext(os.path.basename(image_url))[0]
         images.append((image_alt, image_url))
 
-    image_template = jinja2.Template(tag_format)
-    text = text.rstrip()
+    image_template = _tag_template(ctx.environment, tag_format)
+    text = _rewrite_entities(text, replacements).rstrip()
 
     for image_alt, image_url in images:
         text += delimiter + image_template.render(alt=image_alt, url=image_url)
@@ -74,25 +130,26 @@ def relink(ctx, text, tag_format):
         variables 'text' and 'url', using the context's tweet status object to supply the necessary values.
     """
     tweet_entities = ctx.parent['tweet'].entities
-    link_template = jinja2.Template(tag_format)
+    link_template = _tag_template(ctx.environment, tag_format)
+    replacements = {}
 
     for hashtag in tweet_entities.get('hashtags', []):
-        hashtag_text = hashtag['text']
-        hashtag_url = "https://twitter.com/hashtag/{}".format(hashtag_text.lower())
-        text = text.replace('#' + hashtag_text, link_template.render(text='#' + hashtag_text, url=hashtag_url))
+        hashtag_text = '#' + hashtag['text']
+        hashtag_url = "https://twitter.com/hashtag/{}".format(hashtag['text'].lower())
+        replacements[hashtag_text] = link_template.render(text=hashtag_text, url=hashtag_url)
 
     for url in tweet_entities.get('urls', []):
-        text = text.replace(url['url'], link_template.render(text=url['display_url'], url=url['expanded_url']))
+        replacements[url['url']] = link_template.render(text=url['display_url'], url=url['expanded_url'])
 
     for media in (m for m in tweet_entities.get('media', []) if m['type'] != 'photo'):
-        text = text.replace(media['url'], link_template.render(text=media['display_url'], url=media['expanded_url']))
+        replacements[media['url']] = link_template.render(text=media['display_url'], url=media['expanded_url'])
 
     for mention in tweet_entities.get('user_mentions', []):
-        mention_text = mention['screen_name']
-        mention_url = "https://twitter.com/{}".format(mention_text)
-        text = text.replace('@' + mention_text, link_template.render(text='@' + mention_text, url=mention_url))
+        mention_text = '@' + mention['screen_name']
+        mention_url = "https://twitter.com/{}".format(mention['screen_name'])
+        replacements[mention_text] = link_template.render(text=mention_text, url=mention_url)
 
-    return text
+    return _rewrite_entities(text, replacements)
 
 
 WEIRD_CHARACTERS_RE = re.compile(r"[^\w\s-]")
@@ -115,5 +172,13 @@ def slugify(ctx, text):
     return MULTIPLE_DELIMITERS_RE.sub('-', slug).strip('-')
 
 
-# Dictionary {name: function} of all filter functions in this module.
-ALL_FILTERS = {m[0]: m[1] for m in inspect.getmembers(sys.modules[__name__]) if inspect.isfunction(m[1])}
+# Dictionary {name: function} of the filter functions made available to every template. Listed explicitly, rather than
+# found by scanning the module, so that helper functions don't turn into filters by accident.
+ALL_FILTERS = {
+    'delink': delink,
+    'isodate': isodate,
+    'qescape': qescape,
+    'reimage': reimage,
+    'relink': relink,
+    'slugify': slugify,
+}
@@ -0,0 +1,195 @@
+""" Twempest pipeline: runs the stages of rendering (reading tweets, rendering them, writing them out) at the same time,
+    on an asyncio event loop, with bounded queues between them.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import asyncio
+import threading
+
+
+# Items are passed from stage to stage in batches of up to this many, to spread the cost of each hand-off.
+PIPELINE_BATCH_SIZE = 32
+# Each queue between stages holds no more than this many batches, so that a slow stage holds back the stages before it
+# rather than letting their output pile up.
+PIPELINE_QUEUE_BATCHES = 4
+
+
+def any_stop(func, batch, cancelled):
+    """ Call the given last stage function on each item of the given batch in turn, stopping at, and returning True
+        for, the first one that asks for no more items. Stop early, too, if the given cancelled event is set.
+    """
+    for item in batch:
+        if cancelled.is_set() or func(item):
+            return True
+
+    return False
+
+
+def call_in_thread(loop, threads, func, *args):
+    """ Return an asyncio future for the result of calling the given function with the given arguments in a new daemon
+        thread, which is added to the given set of threads while it runs. The thread is a daemon so that an interrupted
+        pipeline may leave it behind, still busy (e.g., fetching a page of tweets), without holding up the interpreter's
+        exit.
+    """
+    future = loop.create_future()
+
+    def set_outcome(result, exception):
+        """ Set the future's result or exception, unless it has been cancelled.
+        """
+        if not future.done():
+            if exception is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exception)
+
+    def run():
+        """ Call the function and pass its outcome back to the event loop.
+        """
+        result, exception = None, None
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            exception = e
+        finally:
+            threads.discard(thread)
+
+        try:
+            loop.call_soon_threadsafe(set_outcome, result, exception)
+        except RuntimeError:
+            # The event loop has closed, since the pipeline has been abandoned.
+            pass
+
+    thread = threading.Thread(target=run, name=f"twempest-pipeline-{func.__name__}", daemon=True)
+    threads.add(thread)
+    thread.start()
+    return future
+
+
+def process_batch(func, batch, cancelled):
+    """ Return the list of the results of calling the given function on each item of the given batch, stopping short if
+        the given cancelled event is set.
+    """
+    results = []
+
+    for item in batch:
+        if cancelled.is_set():
+            break
+
+        results.append(func(item))
+
+    return results
+
+
+def run_pipeline(items, stages, batch_size=PIPELINE_BATCH_SIZE, queue_batches=PIPELINE_QUEUE_BATCHES, threaded=True):
+    """ Pass each of the given items through the given list of stage functions in turn: the first is called with the
+        item, the next with what the first returned, and so on. The last stage returns True once it wants no more
+        items, which ends the pipeline early. Any exception raised while getting an item or by a stage is re-raised.
+
+        Getting the items and each stage run in a thread of their own, all at once, connected by queues of batches of
+        items that are bounded by the given size. Every stage takes the items in order, so the last stage sees them in
+        the same order as the items, and a slow stage soon fills its queue and holds back the stages before it. If
+        threaded is False, each item passes through all of the stages before the next item is got instead.
+
+        An interruption (e.g., Ctrl-C) or an exception stops the pipeline at once, without waiting for the threads that
+        are busy with an item to finish it; they stop before their next item. Otherwise, the pipeline returns once every
+        thread is done, so that nothing is still using the items or the stages.
+    """
+    if threaded:
+        asyncio.run(run_stages(iter(items), stages, batch_size, queue_batches))
+        return
+
+    for item in items:
+        for stage in stages:
+            item = stage(item)
+
+        if item:
+            return
+
+
+async def run_stages(items, stages, batch_size, queue_batches):
+    """ Run the pipeline (see run_pipeline()) of the given item iterator and list of stage functions on the running
+        event loop, each batch of each stage (and of the iterator) running in a thread of its own.
+    """
+    loop = asyncio.get_running_loop()
+    queues = [asyncio.Queue(maxsize=queue_batches) for _ in stages]
+    cancelled = threading.Event()
+    threads = set()
+
+    async def get_items(outbox):
+        """ Put successive batches of items into the given queue, then an empty batch once there are no more.
+        """
+        while True:
+            batch = await call_in_thread(loop, threads, take_batch, items, batch_size, cancelled)
+            await outbox.put(batch)
+
+            if not batch:
+                return
+
+    async def run_stage(func, inbox, outbox):
+        """ Pass each batch from the given inbox queue through the given stage function and into the given outbox
+            queue, until the empty batch arrives.
+        """
+        while True:
+            batch = await inbox.get()
+
+            if batch:
+                batch = await call_in_thread(loop, threads, process_batch, func, batch, cancelled)
+
+            await outbox.put(batch)
+
+            if not batch:
+                return
+
+    async def run_last_stage(func, inbox):
+        """ Pass each batch from the given inbox queue through the given last stage function, until the empty batch
+            arrives or the stage asks for no more.
+        """
+        while True:
+            batch = await inbox.get()
+
+            if not batch or await call_in_thread(loop, threads, any_stop, func, batch, cancelled):
+                return
+
+    tasks = [asyncio.ensure_future(get_items(queues[0]))]
+    tasks.extend(asyncio.ensure_future(run_stage(f, i, o)) for f, i, o in zip(stages, queues, queues[1:]))
+    tasks.append(asyncio.ensure_future(run_last_stage(stages[-1], queues[-1])))
+    pending = set(tasks)
+
+    try:
+        while tasks[-1] in pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                task.result()
+    finally:
+        # Whether the last stage is done, a stage has failed or asyncio.run() has cancelled this coroutine for Ctrl-C,
+        # have the other stages stop before their next item.
+        cancelled.set()
+
+        for task in pending:
+            task.cancel()
+
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    # The last stage is done, but an earlier stage may still be busy with an item that will never be needed. Wait for it
+    # only now, so that an interruption or failure isn't held up.
+    for thread in list(threads):
+        thread.join()
+
+
+def take_batch(items, batch_size, cancelled):
+    """ Return the list of up to the given number of the next items from the given iterator, stopping short if the given
+        cancelled event is set.
+    """
+    batch = []
+
+    for item in items:
+        batch.append(item)
+
+        if len(batch) >= batch_size or cancelled.is_set():
+            break
+
+    return batch
@@ -0,0 +1,121 @@
+""" Twempest Twitter API rate limiting.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import time
+
+import tweepy
+
+from .errors import TwempestError
+
+
+# Seconds to wait when Twitter refuses a request without saying when the rate limit resets.
+DEFAULT_RATE_LIMIT_WAIT = 60
+# Maximum number of times to wait for the rate limit to reset before giving up on a request.
+MAX_RATE_LIMIT_WAITS = 5
+# Extra seconds to wait past the reset time, to allow for any difference between our clock and Twitter's.
+RATE_LIMIT_RESET_MARGIN = 2
+# HTTP status codes with which Twitter refuses requests beyond the rate limit.
+RATE_LIMIT_STATUSES = (420, 429)
+
+
+class RateLimitBudget:
+    """ The number of requests remaining to an API endpoint in the current rate limit window, and the time (in epoch
+        seconds) at which the window resets. Both are None until Twitter has reported them.
+    """
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+
+    def update(self, headers):
+        """ Update the budget from the x-rate-limit-* headers of a response to a request that counted against it.
+        """
+        for name in ('limit', 'remaining', 'reset'):
+            value = headers.get(f"x-rate-limit-{name}")
+
+            if value is not None:
+                setattr(self, name, int(value))
+            elif name == 'remaining' and self.remaining:
+                self.remaining -= 1
+
+
+class RateLimitScheduler:
+    """ Pace requests to the Twitter API so that they stay inside each endpoint's rate limit budget, as reported by
+        the x-rate-limit-* response headers. Once an endpoint's budget is spent, or Twitter refuses a request for
+        exceeding it anyway, wait until the budget resets and carry on rather than failing. Warning messages are
+        written using the passed echo() function, if any. The number of waits and the seconds spent waiting are
+        tallied. The sleep() and clock() functions may be replaced for testing.
+    """
+    def __init__(self, api, echo=None, sleep=time.sleep, clock=time.time):
+        self.api = api
+        self.echo = echo
+        self.sleep = sleep
+        self.clock = clock
+        self.budgets = {}
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def budget(self, endpoint):
+        """ Return the RateLimitBudget for the given endpoint name.
+        """
+        return self.budgets.setdefault(endpoint, RateLimitBudget())
+
+    def call(self, endpoint, api_func, **kwargs):
+        """ Call the given tweepy API function, which requests the given endpoint name, with the given keyword
+            arguments, waiting first if the endpoint's budget is spent. Return the function's result.
+        """
+        budget = self.budget(endpoint)
+
+        for _ in range(MAX_RATE_LIMIT_WAITS + 1):
+            self.wait(endpoint)
+
+            try:
+                result = api_func(**kwargs)
+            except tweepy.TweepError as e:
+                if e.response is None or e.response.status_code not in RATE_LIMIT_STATUSES:
+                    raise
+
+                budget.update(e.response.headers)
+                budget.remaining = 0
+
+                if budget.reset is None or budget.reset <= self.clock():
+                    retry_after = e.response.headers.get('retry-after')
+                    budget.reset = self.clock() + (int(retry_after) if retry_after else DEFAULT_RATE_LIMIT_WAIT)
+
+                continue
+
+            response = getattr(self.api, 'last_response', None)
+
+            if response is not None:
+                budget.update(response.headers)
+
+            return result
+
+        raise TwempestError(f"Twitter API rate limit for '{endpoint}' was still exceeded after waiting "
+                            f"{MAX_RATE_LIMIT_WAITS} times for it to reset.")
+
+    def wait(self, endpoint):
+        """ If the given endpoint's budget is spent, sleep until it resets.
+        """
+        budget = self.budget(endpoint)
+
+        if budget.remaining is None or budget.remaining > 0 or budget.reset is None:
+            return
+
+        wait_seconds = budget.reset - self.clock() + RATE_LIMIT_RESET_MARGIN
+
+        if wait_seconds > 0:
+            if self.echo:
+                self.echo(f"Warning: Reached the Twitter API rate limit for '{endpoint}'. Waiting {wait_seconds:.0f} "
+                          f"seconds for it to reset.", warning=True)
+
+            self.sleep(wait_seconds)
+            self.waits += 1
+            self.wait_seconds += wait_seconds
+
+        # Twitter will report the fresh budget with the next response.
+        budget.remaining = None
+        budget.reset = None
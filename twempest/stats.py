@@ -0,0 +1,185 @@
+""" Twempest run statistics.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import collections
+import contextlib
+import functools
+import heapq
+import json
+import threading
+import time
+
+
+# Number of the slowest tweets listed in the profile report.
+SLOWEST_TWEETS_COUNT = 5
+# Prefix of the Prometheus metric names.
+PROMETHEUS_PREFIX = "twempest_"
+# Descriptions of the run metrics (see RunStats.metrics()), in the order they're exported.
+METRIC_DESCRIPTIONS = collections.OrderedDict([
+    ('tweets_fetched', "Tweets retrieved from Twitter, the archive or the tweet stream."),
+    ('tweets_rendered', "Tweets rendered."),
+    ('tweets_skipped', "Rendered tweets skipped for matching the --skip pattern."),
+    ('replies_excluded', "Reply tweets excluded for want of the --replies option."),
+    ('files_created', "Rendered tweet files created."),
+    ('files_appended', "Existing rendered tweet files appended to."),
+    ('images_downloaded', "Image files downloaded (or copied from the archive)."),
+    ('images_reused', "Image files taken from the image cache or already in place."),
+    ('images_failed', "Image downloads that failed."),
+    ('api_pages', "Pages of tweets requested from the Twitter API."),
+    ('rate_limit_waits', "Waits for the Twitter API rate limit to reset."),
+    ('bytes_downloaded', "Bytes of image files downloaded."),
+    ('bytes_written', "Bytes of rendered tweets written to files."),
+    ('duration_seconds', "Wall time of the run."),
+])
+
+
+class PhaseTiming:
+    """ Total wall time spent in one phase of a run (e.g., rendering or downloading), and the number of calls.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+
+
+class RunStats:
+    """ Tally of what a run of Twempest did, filled in by render() when passed one. Also keeps the wall time spent in
+        each phase of the run and the slowest tweets to render, for the --profile report. Phases may be timed from
+        multiple threads (e.g., image downloads) at once.
+    """
+    def __init__(self):
+        self.tweets_rendered = 0
+        self.tweets_skipped = 0
+        self.images_downloaded = 0
+        self.last_tweet_id = None
+        self.tweets_fetched = 0
+        self.replies_excluded = 0
+        self.files_created = 0
+        self.files_appended = 0
+        self.images_cached = 0
+        self.images_existing = 0
+        self.images_failed = 0
+        self.api_pages = 0
+        self.rate_limit_waits = 0
+        self.bytes_downloaded = 0
+        self.bytes_written = 0
+        self.phases = collections.OrderedDict()
+        self.slowest_tweets = []
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f"{self.tweets_rendered} tweet(s) rendered, {self.tweets_skipped} skipped, " \
+               f"{self.images_downloaded} image(s) downloaded, last tweet ID {self.last_tweet_id or 'unchanged'}"
+
+    def add_phase_time(self, name, seconds, calls=1):
+        """ Add the given number of seconds and calls to the named phase.
+        """
+        with self.lock:
+            timing = self.phases.get(name)
+
+            if timing is None:
+                timing = self.phases[name] = PhaseTiming()
+
+            timing.calls += calls
+            timing.seconds += seconds
+
+    def add_tweet_time(self, tweet_id, seconds):
+        """ Record the number of seconds it took to render and write the tweet with the given ID, keeping only the
+            slowest tweets.
+        """
+        if len(self.slowest_tweets) < SLOWEST_TWEETS_COUNT:
+            heapq.heappush(self.slowest_tweets, (seconds, tweet_id))
+        elif seconds > self.slowest_tweets[0][0]:
+            heapq.heapreplace(self.slowest_tweets, (seconds, tweet_id))
+
+    def metrics(self):
+        """ Return the dictionary {name: value} of the run metrics described by METRIC_DESCRIPTIONS.
+        """
+        values = {
+            'images_reused': self.images_cached + self.images_existing,
+            'duration_seconds': round(time.perf_counter() - self.started, 6),
+        }
+        return collections.OrderedDict((n, values[n] if n in values else getattr(self, n)) for n in METRIC_DESCRIPTIONS)
+
+    def metrics_json(self, succeeded, timestamp=None):
+        """ Return the run metrics as a JSON document, along with whether the run succeeded, when it finished (in epoch
+            seconds), the last tweet ID and the time spent in each phase.
+        """
+        document = collections.OrderedDict([('succeeded', succeeded), ('timestamp', timestamp or time.time()),
+                                            ('last_tweet_id', self.last_tweet_id)])
+        document.update(self.metrics())
+        document['phases'] = collections.OrderedDict((n, {'calls': t.calls, 'seconds': round(t.seconds, 6)})
+                                                     for n, t in self.phases.items())
+        return json.dumps(document, indent=2) + "\n"
+
+    def metrics_prometheus(self, succeeded, timestamp=None):
+        """ Return the run metrics in the Prometheus text exposition format, for the node exporter's textfile collector.
+            Tweet IDs are too big for Prometheus' floating point values, so the last tweet ID is left out.
+        """
+        lines = []
+
+        def add_metric(name, description, samples):
+            """ Add the named gauge with the given description and list of (labels, value) samples.
+            """
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}{name} {description}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} gauge")
+            lines.extend(f"{PROMETHEUS_PREFIX}{name}{labels} {value}" for labels, value in samples)
+
+        add_metric('last_run_succeeded', "Whether the last run succeeded (1) or failed (0).", [("", int(succeeded))])
+        add_metric('last_run_timestamp_seconds', "When the last run finished, in epoch seconds.",
+                   [("", timestamp or time.time())])
+
+        for name, value in self.metrics().items():
+            add_metric(name, METRIC_DESCRIPTIONS[name], [("", value)])
+
+        add_metric('phase_calls', "Calls of each phase of the run.",
+                   [(f'{{phase="{n}"}}', t.calls) for n, t in self.phases.items()])
+        add_metric('phase_seconds', "Wall time spent in each phase of the run.",
+                   [(f'{{phase="{n}"}}', round(t.seconds, 6)) for n, t in self.phases.items()])
+        return "\n".join(lines) + "\n"
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time the body of the context as a call of the named phase.
+        """
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add_phase_time(name, time.perf_counter() - start)
+
+    def profile_report(self):
+        """ Return the --profile report: a table of the time spent in each phase, then the bytes downloaded and written,
+            and the slowest tweets.
+        """
+        wall_seconds = time.perf_counter() - self.started
+        lines = [f"{'Phase':24} {'Calls':>9} {'Seconds':>10} {'% of run':>9}"]
+
+        for name, timing in self.phases.items():
+            lines.append(f"{name:24} {timing.calls:9} {timing.seconds:10.3f} "
+                         f"{timing.seconds / wall_seconds if wall_seconds else 0:9.1%}")
+
+        lines.append(f"{'Wall time':24} {'':9} {wall_seconds:10.3f}")
+        lines.append("")
+        lines.append(f"{self.bytes_downloaded:,} byte(s) downloaded, {self.bytes_written:,} byte(s) written.")
+
+        if self.slowest_tweets:
+            lines.append("Slowest tweets:")
+            slowest_tweets = sorted(self.slowest_tweets, reverse=True)
+            lines.extend(f"  {tweet_id:>20} {seconds:10.3f}" for seconds, tweet_id in slowest_tweets)
+
+        return "\n".join(lines)
+
+    def timed(self, name, func):
+        """ Return a wrapper of the given function that times each of its calls as the named phase.
+        """
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+
+        return timed_func
@@ -0,0 +1,224 @@
+""" Twempest tweet store: a local, append-only collection of retrieved tweets, indexed by ID.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import calendar
+import contextlib
+import mmap
+import os
+import pickle
+import struct
+
+from .errors import TwempestError
+from .view import TweetView
+
+
+# The store's files, within its directory.
+STORE_DATA_FILE_NAME = "tweets.dat"
+STORE_INDEX_FILE_NAME = "tweets.idx"
+# Identifies a tweet store index file.
+STORE_INDEX_MAGIC = b"TWEMPEST-INDEX-1\n"
+# Each index entry is the tweet ID, its created time (in epoch seconds), and the offset and length of the pickled tweet
+# in the data file. The entries are sorted by tweet ID.
+INDEX_ENTRY = struct.Struct(">QqQI")
+
+
+class TweetStore:
+    """ Local store of tweets in the directory at the given path, which is created if need be. Tweets are pickled (as
+        TweetView objects) one after another onto the end of a data file, and a separate index file lists their IDs,
+        created times and data file locations sorted by ID. Both files are memory-mapped for reading, so finding a
+        range of tweets by ID or by date takes a binary search of the index, and only the tweets in the range are
+        unpickled. Tweets are added in transactions (see adding()), which leave the store as it was if they fail.
+    """
+    def __init__(self, dir_path):
+        self.data_file_path = os.path.join(dir_path, STORE_DATA_FILE_NAME)
+        self.index_file_path = os.path.join(dir_path, STORE_INDEX_FILE_NAME)
+        self.data = None
+        self.index = None
+
+        try:
+            os.makedirs(dir_path, exist_ok=True)
+
+            if not os.path.exists(self.index_file_path):
+                with open(self.data_file_path, 'wb'):
+                    pass
+
+                write_index(self.index_file_path, [])
+        except OSError as e:
+            raise TwempestError(f"Unable to write tweet store: {e}")
+
+        self._map()
+
+    def __contains__(self, tweet_id):
+        i = self._bisect(0, tweet_id)
+        return i < len(self) and self._entry(i)[0] == tweet_id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return (len(self.index) - len(STORE_INDEX_MAGIC)) // INDEX_ENTRY.size
+
+    @contextlib.contextmanager
+    def adding(self):
+        """ Return a context that yields an add(tweets) function, which appends each of the given tweets that isn't
+            already in the store. The added tweets are only indexed, and so become part of the store, once the context
+            exits normally. If it exits with an exception instead, the data file is cut back to where it was.
+        """
+        entries = []
+        added_ids = set()
+
+        try:
+            data_file = open(self.data_file_path, 'ab')
+        except OSError as e:
+            raise TwempestError(f"Unable to write tweet store: {e}")
+
+        committed_size = data_file.tell()
+
+        def add(tweets):
+            """ Append the given tweets to the data file, noting their index entries.
+            """
+            for tweet in tweets:
+                if tweet.id in added_ids or tweet.id in self:
+                    continue
+
+                record = pickle.dumps(TweetView(tweet), protocol=pickle.HIGHEST_PROTOCOL)
+                entries.append((tweet.id, epoch_seconds(tweet.created_at), data_file.tell(), len(record)))
+                data_file.write(record)
+                added_ids.add(tweet.id)
+
+        try:
+            try:
+                yield add
+                data_file.flush()
+                os.fsync(data_file.fileno())
+            except BaseException:
+                data_file.truncate(committed_size)
+                raise
+            finally:
+                data_file.close()
+
+            if entries:
+                write_index(self.index_file_path, sorted(self._entries() + entries))
+                self._map()
+        except OSError as e:
+            raise TwempestError(f"Unable to write tweet store: {e}")
+
+    def _bisect(self, field, value):
+        """ Return the position of the first index entry whose given field (0 for the ID, 1 for the created time) is
+            no less than the given value.
+        """
+        low, high = 0, len(self)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self._entry(middle)[field] < value:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def close(self):
+        """ Unmap the store's files.
+        """
+        for mapped in (self.data, self.index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+        self.data = self.index = None
+
+    def _entries(self):
+        """ Return the list of all of the index entries.
+        """
+        return [self._entry(i) for i in range(len(self))]
+
+    def _entry(self, i):
+        """ Return the (tweet ID, created time, data offset, data length) index entry at the given position.
+        """
+        return INDEX_ENTRY.unpack_from(self.index, len(STORE_INDEX_MAGIC) + i * INDEX_ENTRY.size)
+
+    def _map(self):
+        """ Memory-map the store's files afresh, for reading.
+        """
+        self.close()
+
+        try:
+            with open(self.index_file_path, 'rb') as f:
+                self.index = map_file(f)
+
+            with open(self.data_file_path, 'rb') as f:
+                self.data = map_file(f)
+        except OSError as e:
+            raise TwempestError(f"Unable to read tweet store: {e}")
+
+        if self.index[:len(STORE_INDEX_MAGIC)] != STORE_INDEX_MAGIC:
+            raise TwempestError(f"Unable to read tweet store: '{self.index_file_path}' is not a tweet store index.")
+
+    @property
+    def max_id(self):
+        """ The ID of the newest tweet in the store, or None if it's empty.
+        """
+        return self._entry(len(self) - 1)[0] if len(self) else None
+
+    def tweets(self, since_id=None, max_id=None, since=None, until=None):
+        """ Yield the stored tweets, oldest first, that follow the given since_id and go no further than the given
+            max_id, and that were created at or after the given since datetime and before the given until datetime
+            (naive datetimes are taken to be UTC). Tweet IDs increase with time, so either range is found by a binary
+            search of the index.
+        """
+        start = self._bisect(0, int(since_id) + 1) if since_id else 0
+        end = self._bisect(0, int(max_id) + 1) if max_id else len(self)
+
+        if since is not None:
+            start = max(start, self._bisect(1, epoch_seconds(since)))
+
+        if until is not None:
+            end = min(end, self._bisect(1, epoch_seconds(until)))
+
+        for i in range(start, end):
+            _, _, offset, length = self._entry(i)
+
+            try:
+                yield pickle.loads(self.data[offset:offset + length])
+            except (pickle.UnpicklingError, EOFError, ValueError) as e:
+                raise TwempestError(f"Unable to read tweet store: {e}")
+
+
+def epoch_seconds(dt):
+    """ Return the given datetime (UTC if naive) as seconds since the epoch.
+    """
+    return calendar.timegm(dt.utctimetuple())
+
+
+def map_file(f):
+    """ Return a read-only memory map of the given open file, or an empty bytes object if the file is empty (which
+        can't be mapped).
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return b""
+
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_index(file_path, entries):
+    """ Replace the index file at the given path with the given list of sorted entries, atomically.
+    """
+    temporary_file_path = file_path + ".tmp"
+
+    with open(temporary_file_path, 'wb') as f:
+        f.write(STORE_INDEX_MAGIC)
+
+        for entry in entries:
+            f.write(INDEX_ENTRY.pack(*entry))
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temporary_file_path, file_path)
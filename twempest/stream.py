@@ -0,0 +1,161 @@
+""" Twempest tweet streams: the rendered tweet statuses, serialized one record at a time.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import os
+import pickle
+import struct
+
+from .errors import TwempestError
+
+
+# Default file name of the --pickle tweet stream, in the current working directory.
+PICKLE_FILE_NAME = "twempest.p"
+# Identifies a tweet stream file, as opposed to a single pickled list of tweets written by earlier versions.
+STREAM_MAGIC = b"TWEMPEST-STREAM-1\n"
+# Each record is the tweet ID and the length of the pickled tweet that follows.
+RECORD_HEADER = struct.Struct(">QI")
+
+
+class TweetStreamReader:
+    """ Read the tweets in the stream file at the given path lazily, a record at a time. A file holding a single pickled
+        list of tweets, as written by earlier versions of Twempest, may be read too, though it has to be loaded whole.
+        A record cut short by a crash while the stream was being written marks the end of the stream.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+        try:
+            with open(file_path, 'rb') as f:
+                magic = f.read(len(STREAM_MAGIC))
+        except OSError as e:
+            raise TwempestError(f"Unable to read tweet stream: {e}")
+
+        self.is_legacy = magic != STREAM_MAGIC
+
+    def __iter__(self):
+        return self.tweets()
+
+    def find(self, tweet_id):
+        """ Return the tweet with the given ID, or None if it isn't in the stream. Only that one tweet is unpickled.
+        """
+        return next(self.tweets(tweet_id=tweet_id), None)
+
+    def records(self):
+        """ Yield the (tweet ID, pickled tweet reader function) pair for each record in the stream. Skipping the tweets
+            that aren't needed is as cheap as not calling the reader function.
+        """
+        try:
+            with open(self.file_path, 'rb') as f:
+                if self.is_legacy:
+                    for tweet in pickle.load(f):
+                        yield tweet.id, lambda t=tweet: t
+
+                    return
+
+                f.seek(len(STREAM_MAGIC))
+
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+
+                    if len(header) < RECORD_HEADER.size:
+                        return
+
+                    tweet_id, length = RECORD_HEADER.unpack(header)
+                    offset = f.tell()
+
+                    if offset + length > os.fstat(f.fileno()).st_size:
+                        return
+
+                    yield tweet_id, lambda o=offset, n=length: read_pickled_tweet(f, o, n)
+                    f.seek(offset + length)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            raise TwempestError(f"Unable to read tweet stream: {e}")
+
+    def tweets(self, since_id=None, tweet_id=None):
+        """ Yield the tweets in the stream, in the order they were written. Only tweets that follow the given since_id
+            are yielded, or only the tweet with the given tweet_id.
+        """
+        since_id = int(since_id) if since_id else 0
+        tweet_id = int(tweet_id) if tweet_id else None
+
+        for record_id, read_tweet in self.records():
+            if record_id > since_id and (tweet_id is None or record_id == tweet_id):
+                yield read_tweet()
+
+
+class TweetStreamWriter:
+    """ Write tweets to the stream file at the given path, one record per tweet, flushing each as it's written so that
+        the stream is complete up to the last tweet rendered even if Twempest doesn't finish. The tweets are appended to
+        an existing stream (after cutting off any record left incomplete by a crash), so that a resumed run or a
+        later --watch check adds to it. A new or empty file, or one that isn't a stream (e.g., a single pickled list
+        of tweets written by earlier versions), is started afresh.
+    """
+    def __init__(self, file_path):
+        try:
+            self.file = open(file_path, 'a+b')
+            self.file.seek(0)
+
+            if self.file.read(len(STREAM_MAGIC)) == STREAM_MAGIC:
+                self.file.truncate(complete_stream_length(self.file))
+            else:
+                self.file.truncate(0)
+                self.file.write(STREAM_MAGIC)
+        except OSError as e:
+            raise TwempestError(f"Unable to write tweet stream: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Close the stream file.
+        """
+        try:
+            self.file.close()
+        except OSError as e:
+            raise TwempestError(f"Unable to write tweet stream: {e}")
+
+    def write(self, tweet):
+        """ Append the given tweet to the stream.
+        """
+        data = pickle.dumps(tweet, protocol=pickle.HIGHEST_PROTOCOL)
+
+        try:
+            self.file.write(RECORD_HEADER.pack(tweet.id, len(data)))
+            self.file.write(data)
+            self.file.flush()
+        except OSError as e:
+            raise TwempestError(f"Unable to write tweet stream: {e}")
+
+
+def complete_stream_length(f):
+    """ Return the length of the given open stream file up to the end of its last complete record.
+    """
+    length = len(STREAM_MAGIC)
+    file_size = os.fstat(f.fileno()).st_size
+
+    while length + RECORD_HEADER.size <= file_size:
+        f.seek(length)
+        _, record_length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+
+        if length + RECORD_HEADER.size + record_length > file_size:
+            break
+
+        length += RECORD_HEADER.size + record_length
+
+    return length
+
+
+def read_pickled_tweet(f, offset, length):
+    """ Unpickle the tweet of the given byte length at the given offset in the given open stream file.
+    """
+    try:
+        f.seek(offset)
+        return pickle.loads(f.read(length))
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+        raise TwempestError(f"Unable to read tweet stream: {e}")
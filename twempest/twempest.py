@@ -4,94 +4,410 @@
 # This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
 # License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
 
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
+import itertools
 import jinja2
 from jinja2.exceptions import TemplateError
+import jinja2.meta
 import os
 import pickle
-import pytz
-import tweepy
+import tempfile
+import time
 import tzlocal
-import urllib.request as request
 
+from .archive import TwitterArchive
+from .download import DownloadPool, HttpDownloader, MediaCache
+from .errors import TwempestError
 from .filters import ALL_FILTERS
+from .pipeline import run_pipeline
+from .stats import RunStats
+from .store import TweetStore
+from .stream import TweetStreamReader, TweetStreamWriter
+from .view import TweetView
+
+
+TIMELINE_PAGE_SIZE = 200
+# Rate limited API endpoint that serves the user timeline.
+TIMELINE_ENDPOINT = "statuses/user_timeline"
+# Number of tweets sent to a rendering worker process at a time, and the number of chunks per worker in flight at once.
+RENDER_CHUNK_SIZE = 100
+RENDER_CHUNKS_PER_JOB = 2
+# Maximum number of rendered tweet files to keep open at once, and the write buffer size for each.
+MAX_OPEN_RENDER_FILES = 32
+RENDER_FILE_BUFFER_SIZE = 64 * 1024
+
+# The outcome of rendering a single tweet (see TweetRenderer.render()). The render_file_path is None when rendering to
+# the console, image_downloads is the list of (URL, file path) images to download if the tweet isn't skipped, and
+# render_seconds is how long the rendering took.
+RenderedTweet = collections.namedtuple('RenderedTweet', "tweet text render_file_path image_downloads is_skipped "
+                                                        "render_seconds")
+
+# The TweetRenderer belonging to a rendering worker process (see render_in_parallel()).
+worker_renderer = None
+
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """ File system cache of compiled template bytecode that never lets a problem with the cache stop the template from
+        being rendered, and that writes atomically so that concurrent runs never see a partially-written cache file.
+    """
+    def load_bytecode(self, bucket):
+        try:
+            super().load_bytecode(bucket)
+        except OSError:
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        cache_file_path = self._get_cache_filename(bucket)
+        temporary_file_path = f"{cache_file_path}.{os.getpid()}.tmp"
+
+        try:
+            with open(temporary_file_path, 'wb') as f:
+                bucket.write_bytecode(f)
+
+            os.replace(temporary_file_path, cache_file_path)
+        except OSError:
+            try:
+                os.unlink(temporary_file_path)
+            except OSError:
+                pass
+
+
+class PathTemplate:
+    """ Template for one of the path options. Many paths don't depend upon the tweet being rendered at all (e.g., a
+        fixed directory), so the template is only rendered once in that case.
+    """
+    def __init__(self, env, text):
+        self.template = compile_template(env, text)
+        self.is_tweet_invariant = is_tweet_invariant(env, text)
+        self.rendered = None
+
+    def render(self, **kwargs):
+        """ Render the template with the given context variables, or return the previous rendering if the template is
+            tweet-invariant.
+        """
+        if not self.is_tweet_invariant:
+            return self.template.render(**kwargs)
+
+        if self.rendered is None:
+            self.rendered = self.template.render(**kwargs)
+
+        return self.rendered
+
+
+class RenderFilePool:
+    """ Bounded pool of open, buffered rendered tweet files, so that successive tweets rendered to the same file don't
+        each pay to open and close it. The least recently written file is closed (and so flushed) to make room for
+        another when the pool is full, and all of the files are closed along with the pool. Raise all errors as
+        TwempestError.
+    """
+    def __init__(self, max_open=MAX_OPEN_RENDER_FILES):
+        self.max_open = max_open
+        self.files = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except TwempestError:
+            # Don't mask whatever went wrong in the first place.
+            if exc_type is None:
+                raise
+
+    def close(self):
+        """ Close all of the open files, raising the first error, if any, after trying them all.
+        """
+        error = None
+
+        while self.files:
+            try:
+                self._close_oldest()
+            except TwempestError as e:
+                error = error or e
+
+        if error:
+            raise error
+
+    def _close_oldest(self):
+        """ Close the least recently written file.
+        """
+        _, f = self.files.popitem(last=False)
+
+        try:
+            f.close()
+        except OSError as e:
+            raise TwempestError(f"Unable to write rendered tweet: {e}")
+
+    def flush(self):
+        """ Flush all of the open files, without closing them.
+        """
+        try:
+            for f in self.files.values():
+                f.flush()
+        except OSError as e:
+            raise TwempestError(f"Unable to write rendered tweet: {e}")
+
+    def write(self, path, text):
+        """ Append the given text to the file at the given path, opening it first if necessary.
+        """
+        f = self.files.get(path)
+
+        try:
+            if f is None:
+                if len(self.files) >= self.max_open:
+                    self._close_oldest()
+
+                f = self.files[path] = open(path, 'a', buffering=RENDER_FILE_BUFFER_SIZE)
+            else:
+                self.files.move_to_end(path)
+
+            f.write(text)
+        except OSError as e:
+            raise TwempestError(f"Unable to write rendered tweet: {e}")
+
+
+class TweetRenderer:
+    """ Render individual tweets with the given options and template text. This is all of the rendering work that
+        doesn't touch the file system, so that it can be done in parallel by worker processes. If given a RunStats and
+        the profile option is set, time each call of each filter too.
+    """
+    def __init__(self, options, template_text, stats=None):
+        self.options = options
+
+        # The template cache directory is only known when run from the command line.
+        if stats and options.get('profile'):
+            # Don't leave the timed filters behind in the shared environment.
+            env = create_environment(options.get('template-cache'))
+            env.filters.update({n: stats.timed(f"filter {n}", f) for n, f in ALL_FILTERS.items()})
+        else:
+            env = shared_environment(options.get('template-cache'))
+        self.template = compile_template(env, template_text)
+
+        self.image_dir_path_template = PathTemplate(env, options['image-path']) if options['image-path'] else None
+        self.image_url_path_template = PathTemplate(env, options['image-url']) if options['image-url'] else None
+        self.render_file_name_template = PathTemplate(env, options['render-file']) if options['render-file'] else None
+        self.render_dir_path_template = PathTemplate(env, options['render-path'])
+
+        self.local_tz = tzlocal.get_localzone()
+
+    def render(self, tweet):
+        """ Render the given tweet, returning a RenderedTweet, or None if the tweet is a reply that should be excluded.
+            The given tweet is left as it is; the RenderedTweet has a TweetView of it instead, with its created time in
+            the local time zone and its entities (any rewritten image URLs included) built in from the start.
+        """
+        start = time.perf_counter()
+        tweet = TweetView(tweet, self.local_tz)
+
+        if not self.options['replies'] and getattr(tweet, 'in_reply_to_status_id', None) and tweet.text[0] == '@':
+            return None
+
+        render_file_path = None
+        image_downloads = []
+
+        if self.render_file_name_template:
+            render_dir_path = os.path.abspath(self.render_dir_path_template.render(tweet=tweet))
+            render_file_name = self.render_file_name_template.render(tweet=tweet)
+            render_file_path = os.path.join(render_dir_path, render_file_name)
+
+            if self.options['image-path']:
+                # Only work out where the images will go for now. They aren't downloaded unless the tweet survives the
+                # --skip pattern.
+                entities, image_downloads = rewritten_image_entities(tweet, self.image_dir_path_template,
+                                                                     self.image_url_path_template, render_file_name)
+
+                if image_downloads:
+                    tweet = TweetView(tweet, entities=entities)
 
+        text = self.template.render(tweet=tweet)
+        is_skipped = self.options['skip'] is not None and self.options['skip'].search(text) is not None
+        return RenderedTweet(tweet=tweet, text=text, render_file_path=render_file_path, image_downloads=image_downloads,
+                             is_skipped=is_skipped, render_seconds=time.perf_counter() - start)
 
-PICKLE_FILE_NAME = "twempest.p"
 
+class TextLoader(jinja2.BaseLoader):
+    """ Template loader for templates given as text rather than as files. Each template is named for the SHA-1 digest of
+        its text, which lets the environment's bytecode cache recognize templates that it has compiled before.
+    """
+    def __init__(self):
+        self.sources = {}
+
+    def add(self, text):
+        """ Add the given template text and return its template name.
+        """
+        name = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        self.sources[name] = text
+        return name
 
-class TwempestError(Exception):
-    pass
+    def get_source(self, environment, name):
+        try:
+            # The text for a name never changes, so the template is always up to date.
+            return self.sources[name], None, lambda: True
+        except KeyError:
+            raise jinja2.TemplateNotFound(name)
 
 
 def authenticate_twitter_api(consumer_key, consumer_secret, access_token, access_token_secret):
     """ Return the Twitter API object for the given authentication credentials.
     """
+    # Imported here, since tweepy is slow to import and only needed when talking to Twitter.
+    import tweepy
+
     auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
     auth.set_access_token(access_token, access_token_secret)
     return tweepy.API(auth)
 
 
-def cleanup_downloaded_images(downloaded_image_file_paths, echo):
-    """ Clean up any downloaded images for the skipped tweet. Clunky, but simpler than avoiding downloading in the first
-        place. Warn of any image files that couldn't be deleted using the passed echo() function but continue on
-        regardless.
+def compile_template(env, text):
+    """ Return the template for the given text, compiled by the given environment (see create_environment()). The
+        bytecode cache is used, if possible, to skip parsing and compiling the text all over again.
+    """
+    return env.get_template(env.loader.add(text))
+
+
+def create_environment(bytecode_cache_dir_path=None):
+    """ Return a new template environment with all of the custom filters. Cache compiled template bytecode in the given
+        directory, unless it is None or can't be created.
     """
-    for path in downloaded_image_file_paths:
+    bytecode_cache = None
+
+    if bytecode_cache_dir_path:
         try:
-            os.unlink(path)
-        except OSError as e:
-            echo(f"Warning: Unable to delete downloaded image file: {e}", warning=True)
+            os.makedirs(bytecode_cache_dir_path, exist_ok=True)
+            bytecode_cache = BytecodeCache(bytecode_cache_dir_path)
+        except OSError:
+            pass
+
+    env = jinja2.Environment(loader=TextLoader(), bytecode_cache=bytecode_cache)
+    env.filters.update(ALL_FILTERS)
+    return env
 
 
 def download_from_url(url, file_path):
     """ Download the file at the given url and store it at the given file path. Raise a TwempestError exception if
-        anything goes wrong.
+        anything goes wrong. Use an HttpDownloader directly to reuse connections across multiple downloads.
     """
+    downloader = HttpDownloader()
+
     try:
-        request.urlretrieve(url, file_path)
-    except request.URLError as e:
-        raise TwempestError(f"Unable to download image file: {e}")
-    except OSError as e:
-        raise TwempestError(f"Unable to write downloaded image file: {e}")
+        downloader(url, file_path)
+    finally:
+        downloader.close()
 
 
-def download_images(tweet, image_dir_path_template, image_url_path_template, render_file_name, download_func, echo):
-    """ Download any images for the given tweet, storing them in the rendered image directory path template and updating
-        their URLs with the rendered image URL path template. Echo any skipped images that already exist to the console
-        using the passed echo() function. Return the list of file paths for the downloaded images.
+def download_image_files(image_downloads, download_func, echo, created_dir_paths=None, queued_file_paths=None):
+    """ Download each of the given (URL, file path) image downloads, creating the file's directory if necessary (see
+        make_dirs()). Echo any skipped images that already exist to the console using the passed echo() function. An
+        image whose file path is in the given set of queued file paths is taken to exist already, since a download pool
+        may not have finished writing it yet. Add the downloaded file paths to that set and return them as a list.
     """
     downloaded_image_file_paths = []
-    image_dir_path = os.path.abspath(image_dir_path_template.render(tweet=tweet))
-    os.makedirs(image_dir_path, exist_ok=True)
+    created_dir_paths = set() if created_dir_paths is None else created_dir_paths
+    queued_file_paths = set() if queued_file_paths is None else queued_file_paths
 
-    for i, media in enumerate(m for m in tweet.entities.get('media', []) if m['type'] == 'photo'):
-        image_download_url = media['media_url_https'] if media['media_url_https'] else media['media_url']
-        image_file_name = f"{os.path.splitext(render_file_name)[0]}-{i}" \
-                          f"{os.path.splitext(os.path.basename(image_download_url))[1]}"
-        image_file_path = os.path.join(image_dir_path, image_file_name)
-        image_url_path = image_url_path_template.render(tweet=tweet).rstrip('/') + '/' + image_file_name
-
-        # Inject the downloaded image URL into the tweet status object and backup the original media URL(s).
-        is_https = image_url_path.lower().startswith("https")
-        media['original_media_url_https'] = media['media_url_https']
-        media['media_url_https'] = image_url_path if is_https else None
-        media['original_media_url'] = media['media_url']
-        media['media_url'] = image_url_path if not is_https else None
-
-        if os.path.exists(image_file_path):
+    for image_download_url, image_file_path in image_downloads:
+        if image_file_path in queued_file_paths or os.path.exists(image_file_path):
             echo(f"Warning: Skipping existing image file '{image_file_path}'.", warning=True)
             continue
 
+        make_dirs(os.path.dirname(image_file_path), created_dir_paths)
+        queued_file_paths.add(image_file_path)
         download_func(image_download_url, image_file_path)
         downloaded_image_file_paths.append(image_file_path)
 
     return downloaded_image_file_paths
 
 
-def render(tweets, options, template_text, download_func, echo):
+def fetch_timeline_pages(api, since_id, include_rts, tweet_mode, scheduler=None, stats=None):
+    """ Yield successive pages of tweets, newest first, from the authorized user's timeline that follow the given since
+        ID. Unlike tweepy.Cursor, which holds on to every page it has fetched, only the current page is referenced.
+        The requests are paced by the given RateLimitScheduler (or a new one) to stay inside the API's rate limit, and
+        timed and tallied in the given RunStats, if any.
+    """
+    from .ratelimit import RateLimitScheduler
+
+    scheduler = scheduler or RateLimitScheduler(api)
+    stats = stats or RunStats()
+    max_id = None
+
+    while True:
+        waits, wait_seconds = scheduler.waits, scheduler.wait_seconds
+
+        with stats.phase('fetch'):
+            page = scheduler.call(TIMELINE_ENDPOINT, api.user_timeline, since_id=since_id, max_id=max_id,
+                                  count=TIMELINE_PAGE_SIZE, include_rts=include_rts, tweet_mode=tweet_mode)
+
+        stats.api_pages += 1
+
+        if scheduler.waits > waits:
+            stats.rate_limit_waits += scheduler.waits - waits
+            stats.add_phase_time('rate limit wait', scheduler.wait_seconds - wait_seconds, scheduler.waits - waits)
+
+        if not page:
+            return
+
+        yield page
+        max_id = min(tweet.id for tweet in page) - 1
+
+
+def init_render_worker(options, template_text):
+    """ Initialize a rendering worker process with its own TweetRenderer.
+    """
+    global worker_renderer
+    worker_renderer = TweetRenderer(options, template_text)
+
+
+def is_tweet_invariant(env, text):
+    """ Return True if the given template text renders the same for every tweet, as far as can be told from the parsed
+        template: it neither refers to the tweet context variable, nor uses a filter (like slugify) that quietly reads
+        the tweet from the template context.
+    """
+    ast = env.parse(text)
+
+    if 'tweet' in jinja2.meta.find_undeclared_variables(ast):
+        return False
+
+    return not any(getattr(env.filters.get(f.name), 'contextfilter', False) for f in ast.find_all(jinja2.nodes.Filter))
+
+
+def make_dirs(path, created_dir_paths):
+    """ Create the directory at the given path, along with any missing parent directories, unless it's in the given set
+        of directory paths that were already created. Add the path to that set.
+    """
+    if path not in created_dir_paths:
+        os.makedirs(path, exist_ok=True)
+        created_dir_paths.add(path)
+
+
+def oldest_first(pages):
+    """ Yield the tweets from the given newest-first sequence of pages in oldest-first order. Each page is spilled to an
+        anonymous temporary file as it arrives, so only a single page is ever held in memory, regardless of the size of
+        the backlog.
+    """
+    offsets = []
+
+    with tempfile.TemporaryFile() as spool:
+        for page in pages:
+            offsets.append(spool.tell())
+            pickle.dump(list(page), spool, protocol=pickle.HIGHEST_PROTOCOL)
+
+        for offset in reversed(offsets):
+            spool.seek(offset)
+            yield from reversed(pickle.load(spool))
+
+
+def render(tweets, options, template_text, download_func, echo, checkpoint=None, stats=None):
     """ Render the given tweets using the supplied template text. Also download images if requested. Write any warning
-        messages to the console using the passed echo() function, and raise all errors as TwempestError.
+        messages to the console using the passed echo() function, and raise all errors as TwempestError. If given, call
+        checkpoint(last_tweet_id) every so often (see the checkpoint-every and checkpoint-seconds options), once
+        everything up to and including that tweet has been written and downloaded, and tally the rendered tweets and
+        time each phase of rendering in the given RunStats.
     """
+    stats = stats or RunStats()
+
     def write_to_console(text):
         """ Write the given text to the console with a following blank line.
         """
@@ -102,13 +418,10 @@ def render(tweets, options, template_text, download_func, echo):
         """ Return a function that will write text to a file at the given path.
         """
         def write_to_file_inner(text):
-            """ Write the given text to the outer function's file path.
+            """ Write the given text to the outer function's file path, via the pool of open files.
             """
-            try:
-                with open(path, 'a') as f:
-                    f.write(text)
-            except OSError as oe:
-                raise TwempestError(f"Unable to write rendered tweet: {oe}")
+            render_files.write(path, text)
+            stats.bytes_written += len(text.encode('utf-8'))
 
         return write_to_file_inner
 
@@ -118,104 +431,383 @@ def render(tweets, options, template_text, download_func, echo):
         """
         pass
 
-    env = jinja2.Environment()
-    env.filters.update(ALL_FILTERS)
-    template = env.from_string(template_text)
+    def timed_download(url, file_path):
+        """ Download the given URL to the given file path, timing the download and tallying it, along with its size,
+            or its failure. A download that the image cache serves (i.e., download_func() returns True) is tallied as
+            cached, and its size left out.
+        """
+        try:
+            with stats.phase('download'):
+                is_cached = download_func(url, file_path)
+        except Exception:
+            with stats.lock:
+                stats.images_failed += 1
 
-    image_dir_path_template = env.from_string(options['image-path']) if options['image-path'] else None
-    image_url_path_template = env.from_string(options['image-url']) if options['image-url'] else None
-    render_file_name_template = env.from_string(options['render-file']) if options['render-file'] else None
-    render_dir_path_template = env.from_string(options['render-path'])
+            raise
 
-    gmt_tz = pytz.timezone('UTC')
-    local_tz = tzlocal.get_localzone()
+        if is_cached:
+            with stats.lock:
+                stats.images_cached += 1
 
-    count_remaining = options['count']
-    last_tweet_id = None
-    pickle_tweets = []
+            return
 
-    for tweet in tweets:
-        # If the tweet mode was extended when it was retrieved, there will only be a full_text attribute so copy its
-        # value to the expected text attribute.
-        if not hasattr(tweet, 'text'):
-            tweet.text = tweet.full_text
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = 0
 
-        # Replace UTC created time with local time.
-        if tweet.created_at.tzinfo is None:
-            tweet.created_at = gmt_tz.localize(tweet.created_at)
+        with stats.lock:
+            stats.images_downloaded += 1
+            stats.bytes_downloaded += size
 
-        tweet.created_at = tweet.created_at.astimezone(local_tz)
+    # Compile the templates here even when rendering in parallel, so that any syntax errors are raised up front. The
+    # worker processes can't time the filters for this process's RunStats, though.
+    renderer = TweetRenderer(options, template_text, stats if options['jobs'] == 1 else None)
 
-        if not options['replies'] and tweet.in_reply_to_status_id and tweet.text[0] == '@':
-            continue
+    count_remaining = options['count']
+    last_tweet_id = None
+    tweet_stream = None
+    created_dir_paths = set()
+    opened_file_paths = set()
+    queued_file_paths = set()
+    uncheckpointed_count = 0
+    last_checkpoint_time = time.monotonic()
+
+    def write_rendered_tweet(rendered_tweet):
+        """ Write the given rendered tweet (or None, for an excluded reply) to its file or the console and queue its
+            image downloads, checkpointing as need be. Return True once the count of tweets has been rendered.
+        """
+        nonlocal count_remaining, last_tweet_id, tweet_stream, uncheckpointed_count, last_checkpoint_time
+        stats.tweets_fetched += 1
 
-        if render_file_name_template:
-            render_dir_path = os.path.abspath(render_dir_path_template.render(tweet=tweet))
-            os.makedirs(render_dir_path, exist_ok=True)
-            render_file_name = render_file_name_template.render(tweet=tweet)
-            render_file_path = os.path.join(render_dir_path, render_file_name)
-            downloaded_image_file_paths = download_images(tweet, image_dir_path_template,
-                                                          image_url_path_template, render_file_name,
-                                                          download_func, echo) if options['image-path'] else []
+        if rendered_tweet is None:
+            stats.replies_excluded += 1
+            return False
 
-            if not options['append'] and os.path.exists(render_file_path):
-                echo(f"Warning: Skipping existing file '{render_file_path}'. Use --append to append rendered tweets "
-                     f"instead.", warning=True)
+        start = time.perf_counter()
+        stats.add_phase_time('render', rendered_tweet.render_seconds)
+        tweet = rendered_tweet.tweet
+
+        if rendered_tweet.render_file_path:
+            make_dirs(os.path.dirname(rendered_tweet.render_file_path), created_dir_paths)
+
+            if not options['append'] and os.path.exists(rendered_tweet.render_file_path):
+                echo(f"Warning: Skipping existing file '{rendered_tweet.render_file_path}'. Use --append to append "
+                     f"rendered tweets instead.", warning=True)
                 write_func = write_to_void
             else:
-                write_func = write_to_file(render_file_path)
+                write_func = write_to_file(rendered_tweet.render_file_path)
         else:
-            downloaded_image_file_paths = []
             write_func = write_to_console
 
-        rendered_tweet = template.render(tweet=tweet)
-
-        if options['skip'] and options['skip'].search(rendered_tweet) is not None:
+        if rendered_tweet.is_skipped:
             ellipses = "..." if len(tweet.text) > 30 else ""
             echo(f"Warning: Skipping tweet ID {tweet.id} ('{tweet.text[:30]}{ellipses}') because its rendered form "
                  f"matches the --skip pattern.", warning=True)
-            cleanup_downloaded_images(downloaded_image_file_paths, echo)
-            continue
 
-        write_func(rendered_tweet)
+            stats.tweets_skipped += 1
+            return False
+
+        image_file_paths = download_image_files(rendered_tweet.image_downloads, download_pool, echo, created_dir_paths,
+                                                queued_file_paths)
+
+        if rendered_tweet.render_file_path and write_func is not write_to_void and \
+                rendered_tweet.render_file_path not in opened_file_paths:
+            opened_file_paths.add(rendered_tweet.render_file_path)
+
+            if os.path.exists(rendered_tweet.render_file_path):
+                stats.files_appended += 1
+            else:
+                stats.files_created += 1
+
+        with stats.phase('write'):
+            write_func(rendered_tweet.text)
+
         last_tweet_id = tweet.id
+        stats.tweets_rendered += 1
+        stats.images_existing += len(rendered_tweet.image_downloads) - len(image_file_paths)
+        stats.last_tweet_id = last_tweet_id
 
-        # Check the count here as the list has already been "filtered" by this point and so the count remaining reflects
-        # the actual number of tweets left to render.
+        # Check the count here as the list has already been "filtered" by this point and so the count remaining
+        # reflects the actual number of tweets left to render.
         count_remaining -= 1
-        pickle_tweets.append(tweet)
 
-        if count_remaining == 0:
-            break
+        if options['pickle']:
+            with stats.phase('pickle'):
+                tweet_stream = write_tweet_stream(tweet_stream, tweet, options['pickle-file'], echo)
 
-    if not last_tweet_id:
-        echo("Warning: No tweets were retrieved.", warning=True)
-    elif options['pickle']:
+        stats.add_tweet_time(tweet.id, rendered_tweet.render_seconds + time.perf_counter() - start)
+
+        if checkpoint:
+            uncheckpointed_count += 1
+
+            if uncheckpointed_count >= options['checkpoint-every'] or \
+                    time.monotonic() - last_checkpoint_time >= options['checkpoint-seconds']:
+                with stats.phase('checkpoint'):
+                    download_pool.wait()
+                    render_files.flush()
+                    checkpoint(last_tweet_id)
+
+                uncheckpointed_count = 0
+                last_checkpoint_time = time.monotonic()
+
+        return count_remaining == 0
+
+    # Reading the tweets, rendering them and writing them out each run in a pipeline stage of their own, so that, e.g.,
+    # the next tweets are rendered while the last ones are written. The rendering workers of a parallel run are a
+    # stage of their own already.
+    if options['jobs'] > 1:
+        tweets = render_in_parallel(tweets, options, template_text, options['jobs'])
+        stages = [write_rendered_tweet]
+    else:
+        stages = [renderer.render, write_rendered_tweet]
+
+    with DownloadPool(timed_download, options['download-workers']) as download_pool, RenderFilePool() as render_files:
         try:
-            with open(PICKLE_FILE_NAME, "wb") as pf:
-                pickle.dump(pickle_tweets, pf)
-        except OSError as e:
-            echo(f"Warning: Unable to serialize the rendered tweets to '{PICKLE_FILE_NAME}' in the current working "
-                 f"directory: {e}", warning=True)
+            # Rendering to the console alone leaves no file or network I/O to overlap, and cProfile only sees the
+            # thread it's started in, so run the stages one after another then.
+            is_threaded = bool(options['render-file'] or options['image-path']) and not options['cprofile-file']
+            run_pipeline(tweets, stages, threaded=is_threaded)
+        finally:
+            # Stop any retrieval or parallel rendering that is still underway, unless an interrupted pipeline has left
+            # it running in a thread of its own.
+            try:
+                if hasattr(tweets, 'close'):
+                    tweets.close()
+            except ValueError:
+                pass
+
+            if tweet_stream:
+                tweet_stream.close()
+
+        with stats.phase('flush'):
+            download_pool.wait()
+            render_files.close()
+
+    # Polling for new tweets often turns up none, which isn't worth a warning.
+    if not last_tweet_id and not options['watch']:
+        echo("Warning: No tweets were retrieved.", warning=True)
 
     return last_tweet_id
 
 
-def retrieve(auth_keys, options, template_text, echo):
+def render_chunk(tweets):
+    """ Render the given chunk of tweets in a worker process (see render_in_parallel()) and return the list of results.
+    """
+    return [worker_renderer.render(tweet) for tweet in tweets]
+
+
+def render_in_parallel(tweets, options, template_text, jobs):
+    """ Render the given tweets in chunks on a pool of the given number of worker processes, each with its own
+        TweetRenderer. Yield the results of TweetRenderer.render() in the original order of the tweets. Only a few
+        chunks per worker are in flight at once, so the tweets are consumed no faster than the results are.
+    """
+    # Send the workers slim views rather than whole tweepy Status objects, which are slow to pickle.
+    tweets = (TweetView(tweet) for tweet in tweets)
+    chunks = iter(lambda: list(itertools.islice(tweets, RENDER_CHUNK_SIZE)), [])
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_render_worker,
+                                   initargs=(options, template_text))
+    pending = collections.deque()
+
+    try:
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                pending.append(executor.submit(render_chunk, chunk))
+
+            while pending and (chunk is None or len(pending) >= jobs * RENDER_CHUNKS_PER_JOB):
+                yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+        executor.shutdown(wait=True)
+
+
+def render_with_downloads(tweets, options, template_text, echo, checkpoint=None, downloader=None, stats=None):
+    """ Render the given tweets using the supplied template text and rendering options, downloading any images over
+        HTTP (via the image cache, if there is one). Use the given HttpDownloader, which is left open, or else a new one
+        of its own.
+    """
+    stats = stats or RunStats()
+    own_downloader = None
+
+    if downloader is None:
+        downloader = own_downloader = HttpDownloader(timeout=options['download-timeout'],
+                                                     retries=options['download-retries'],
+                                                     pool_size=options['download-workers'])
+
+    download_func = downloader
+
+    try:
+        if options['image-cache']:
+            download_func = MediaCache(os.path.expanduser(options['image-cache']),
+                                       max_bytes=options['image-cache-size'] * 1024 * 1024, download_func=downloader)
+
+        return render(tweets, options, template_text, download_func, echo, checkpoint, stats)
+    finally:
+        if own_downloader:
+            own_downloader.close()
+
+
+def replay(stream_path, options, template_text, echo, checkpoint=None, downloader=None, stats=None):
+    """ Using the given rendering options, render the tweets saved to the tweet stream (or legacy pickle) file at the
+     given path by an earlier --pickle run, without contacting the Twitter API.
+    """
+    stats = stats or RunStats()
+    reader = TweetStreamReader(os.path.expanduser(stream_path))
+    tweets = timed_tweets(reader.tweets(since_id=options['since-id']), stats, 'read')
+
+    try:
+        return render_with_downloads(tweets, options, template_text, echo, checkpoint, downloader, stats)
+    except TemplateError as e:
+        raise TwempestError(f"Unable to render template: {e}")
+
+
+def retrieve(auth_keys, options, template_text, echo, checkpoint=None, downloader=None, stats=None, scheduler=None):
     """ Using the given authorization credentials and rendering options, retrieve and render the tweets from the
-     authorized user's timeline.
+     authorized user's timeline. The API requests go through the given RateLimitScheduler, if any, so that successive
+     retrievals can share its authenticated API and rate limit budget.
     """
-    api = authenticate_twitter_api(**auth_keys)
+    import tweepy
+    from .ratelimit import RateLimitScheduler
+
+    scheduler = scheduler or RateLimitScheduler(authenticate_twitter_api(**auth_keys), echo)
     tweet_mode = 'normal' if options['abbreviated'] else 'extended'
 
+    if options['store']:
+        # The store keeps the whole timeline, retweets and all, so only tweets newer than its newest need be fetched.
+        def fetch_pages(since_id):
+            """ Return the pages of timeline tweets, retweets included, that follow the given since ID.
+            """
+            return fetch_timeline_pages(scheduler.api, since_id=since_id, include_rts=True, tweet_mode=tweet_mode,
+                                        scheduler=scheduler, stats=stats)
+
+        tweets = stored_tweets(os.path.expanduser(options['store']), fetch_pages, since_id=options['since-id'],
+                               include_rts=options['retweets'], stats=stats)
+    else:
+        # The timeline is retrieved newest first, but must be rendered oldest first.
+        tweets = oldest_first(fetch_timeline_pages(scheduler.api, since_id=options['since-id'],
+                                                   include_rts=options['retweets'], tweet_mode=tweet_mode,
+                                                   scheduler=scheduler, stats=stats))
+
     try:
-        tweets = reversed(list(tweepy.Cursor(api.user_timeline, since_id=options['since-id'],
-                                             include_rts=options['retweets'], tweet_mode=tweet_mode).items()))
+        return render_with_downloads(tweets, options, template_text, echo, checkpoint, downloader, stats)
     except tweepy.TweepError as e:
         raise TwempestError(f"Unable to retrieve tweets. Twitter API responded with '{e.response}'. "
                             f"See https://dev.twitter.com/overview/api/response-codes for an explanation.")
+    except TemplateError as e:
+        raise TwempestError(f"Unable to render template: {e}")
+
+
+def retrieve_archive(archive_path, options, template_text, echo, checkpoint=None, stats=None):
+    """ Using the given rendering options, render the tweets from the Twitter archive at the given path. Images are
+     copied from the archive rather than downloaded.
+    """
+    stats = stats or RunStats()
+    archive = TwitterArchive(os.path.expanduser(archive_path))
+    tweets = timed_tweets(archive.tweets(since_id=options['since-id'], include_rts=options['retweets']), stats, 'read')
 
     try:
-        return render(tweets, options, template_text, download_from_url, echo)
+        return render(tweets, options, template_text, archive.copy_image, echo, checkpoint, stats)
     except TemplateError as e:
         raise TwempestError(f"Unable to render template: {e}")
+
+
+def rewritten_image_entities(tweet, image_dir_path_template, image_url_path_template, render_file_name):
+    """ Return a copy of the entities of the given tweet, with the URLs of any images replaced by the rendered image URL
+        path template (and the originals kept alongside), and the list of (URL, file path) image downloads that are
+        needed to store the images in the rendered image directory path template. The tweet itself is left as it is.
+    """
+    entities = dict(tweet.entities)
+    image_downloads = []
+
+    if 'media' not in entities:
+        return entities, image_downloads
+
+    entities['media'] = [dict(m) for m in entities['media']]
+    image_dir_path = os.path.abspath(image_dir_path_template.render(tweet=tweet))
+
+    for i, media in enumerate(m for m in entities['media'] if m['type'] == 'photo'):
+        # A replayed tweet has already been rendered once, so start again from its original media URLs.
+        if 'original_media_url' in media:
+            media['media_url_https'] = media['original_media_url_https']
+            media['media_url'] = media['original_media_url']
+
+        image_download_url = media['media_url_https'] if media['media_url_https'] else media['media_url']
+        image_file_name = f"{os.path.splitext(render_file_name)[0]}-{i}" \
+                          f"{os.path.splitext(os.path.basename(image_download_url))[1]}"
+        image_file_path = os.path.join(image_dir_path, image_file_name)
+        image_url_path = image_url_path_template.render(tweet=tweet).rstrip('/') + '/' + image_file_name
+
+        # Inject the downloaded image URL into the media entity and backup the original media URL(s).
+        is_https = image_url_path.lower().startswith("https")
+        media['original_media_url_https'] = media['media_url_https']
+        media['media_url_https'] = image_url_path if is_https else None
+        media['original_media_url'] = media['media_url']
+        media['media_url'] = image_url_path if not is_https else None
+
+        image_downloads.append((image_download_url, image_file_path))
+
+    return entities, image_downloads
+
+
+@functools.lru_cache(maxsize=None)
+def shared_environment(bytecode_cache_dir_path=None):
+    """ Return the template environment for the given bytecode cache directory path (see create_environment()), which
+        is created the first time only. Runs in the same process that share an environment compile each template once.
+    """
+    return create_environment(bytecode_cache_dir_path)
+
+
+def stored_tweets(store_path, fetch_pages, since_id, include_rts, stats=None):
+    """ Add the tweets from fetch_pages(since_id), which returns pages of tweets that follow the given ID, to the
+        TweetStore at the given path, asking only for the tweets that are newer than both the given since ID and the
+        newest tweet already in the store. Then yield the stored tweets that follow the given since ID, oldest first,
+        leaving out retweets unless include_rts is True. Reading the stored tweets is timed in the given RunStats.
+    """
+    stats = stats or RunStats()
+
+    with TweetStore(store_path) as store:
+        with store.adding() as add:
+            for page in fetch_pages(max(int(since_id or 0), store.max_id or 0) or None):
+                with stats.phase('store'):
+                    add(page)
+
+        for tweet in timed_tweets(store.tweets(since_id=since_id), stats, 'read'):
+            if include_rts or getattr(tweet, 'retweeted_status', None) is None:
+                yield tweet
+
+
+def timed_tweets(tweets, stats, name):
+    """ Yield the given tweets, timing how long each one takes to arrive as a call of the named phase of the given
+        RunStats.
+    """
+    tweets = iter(tweets)
+
+    while True:
+        with stats.phase(name):
+            tweet = next(tweets, None)
+
+        if tweet is None:
+            return
+
+        yield tweet
+
+
+def write_tweet_stream(tweet_stream, tweet, file_path, echo):
+    """ Append the given tweet to the given TweetStreamWriter, first creating it at the given file path if it's None.
+        Return the writer, or False if writing to the stream has failed, in which case a warning is written using the
+        passed echo() function and any further tweets are ignored.
+    """
+    if tweet_stream is False:
+        return False
+
+    try:
+        if tweet_stream is None:
+            tweet_stream = TweetStreamWriter(file_path)
+
+        tweet_stream.write(tweet)
+        return tweet_stream
+    except TwempestError as e:
+        echo(f"Warning: Unable to serialize the rendered tweets to '{file_path}': {e}", warning=True)
+        return False
@@ -0,0 +1,105 @@
+""" Twempest tweet views: slim, read-only copies of the tweet status fields that templates use.
+"""
+
+# This file is part of Twempest. Copyright 2018 Dave Rogers <info@yukondude.com>. Licensed under the GNU General Public
+# License, version 3. Refer to the attached LICENSE file or see <http://www.gnu.org/licenses/> for details.
+
+import pytz
+
+
+# The tweet and user fields documented by the Twitter API that are copied into views, less the raw JSON payload and
+# the API object that a tweepy Status or User carries along with it.
+TWEET_FIELDS = ('id', 'id_str', 'created_at', 'text', 'full_text', 'display_text_range', 'source', 'truncated',
+                'in_reply_to_status_id', 'in_reply_to_status_id_str', 'in_reply_to_user_id', 'in_reply_to_user_id_str',
+                'in_reply_to_screen_name', 'user', 'coordinates', 'place', 'is_quote_status', 'quoted_status_id',
+                'quoted_status_id_str', 'quoted_status', 'retweeted_status', 'quote_count', 'reply_count',
+                'retweet_count', 'favorite_count', 'entities', 'extended_entities', 'favorited', 'retweeted',
+                'possibly_sensitive', 'lang')
+USER_FIELDS = ('id', 'id_str', 'name', 'screen_name', 'location', 'url', 'description', 'protected', 'verified',
+               'followers_count', 'friends_count', 'listed_count', 'favourites_count', 'statuses_count', 'created_at',
+               'profile_image_url', 'profile_image_url_https', 'profile_banner_url', 'lang')
+
+
+class ReadOnlyView:
+    """ Base for views whose fields, listed in __slots__, are set once when the view is built. A field that the
+        original object lacks is left unset, so that it's undefined in templates just as it was before.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __repr__(self):
+        return f"{type(self).__name__}(id={getattr(self, 'id', None)})"
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
+class TweetView(ReadOnlyView):
+    """ A slim, read-only view of the given tweet (a tweepy Status, an archived tweet or another view) with the same
+        attribute paths for templates and filters: tweet.text, tweet.entities, tweet.user.screen_name, and so on. The
+        text is always set, from the full_text of an extended tweet if need be, and the created_at time is converted to
+        the given time zone, if any. The view has its own copies of the media entities, which are never shared with
+        the original tweet, and the given entities, if any, replace the tweet's own (e.g., with rewritten image URLs).
+    """
+    __slots__ = TWEET_FIELDS + ('author', )
+
+    def __init__(self, tweet, tz=None, entities=None):
+        def set_field(field_name, field_value):
+            """ Set the named field, which is otherwise read-only.
+            """
+            object.__setattr__(self, field_name, field_value)
+
+        for name in TWEET_FIELDS:
+            try:
+                value = getattr(tweet, name)
+            except AttributeError:
+                continue
+
+            if value is None or isinstance(value, dict) and name not in ('entities', 'extended_entities'):
+                # tweepy leaves some nested objects (e.g., quoted_status) as plain JSON dictionaries.
+                pass
+            elif name == 'user':
+                value = UserView(value)
+            elif name in ('quoted_status', 'retweeted_status'):
+                value = TweetView(value, tz)
+            elif name in ('entities', 'extended_entities') and 'media' in value:
+                value = dict(value, media=[dict(m) for m in value['media']])
+
+            set_field(name, value)
+
+        if entities is not None:
+            set_field('entities', entities)
+
+        if not hasattr(self, 'text'):
+            set_field('text', self.full_text)
+
+        if hasattr(self, 'user'):
+            set_field('author', self.user)
+
+        if tz and getattr(self, 'created_at', None):
+            created_at = self.created_at
+
+            # Twitter's times are in UTC.
+            if created_at.tzinfo is None:
+                created_at = pytz.utc.localize(created_at)
+
+            set_field('created_at', created_at.astimezone(tz))
+
+
+class UserView(ReadOnlyView):
+    """ A slim, read-only view of the given Twitter user (a tweepy User or another view).
+    """
+    __slots__ = USER_FIELDS
+
+    def __init__(self, user):
+        for name in USER_FIELDS:
+            try:
+                object.__setattr__(self, name, getattr(user, name))
+            except AttributeError:
+                pass